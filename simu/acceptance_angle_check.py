@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from pathlib import Path
+import numpy as np
+import click
+from parallel_helpers import run_in_processes, get_seeds
+from mhd_helpers import memmap_mhd
+from stats_helpers import read_stats_file
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+def run_check_nema001(
+    acceptance_angle, skip_policy, output_dir, threads, nb_slices, seed
+):
+    # executed in its own process (Geant4 can only be run once per process)
+    from nema001_spatial_resolution import run_simulation
+
+    simu_name = "aa_check_nema001"
+    outputs = run_simulation(
+        "X",
+        4.6,
+        100.0,
+        "1_source",
+        False,
+        "lehr",
+        "Tc99m",
+        number_of_threads=threads,
+        simu_name=simu_name,
+        output_dir=output_dir,
+        random_seed=seed,
+        time_slice=(0, nb_slices),
+        acceptance_angle=acceptance_angle,
+        skip_policy=skip_policy,
+        use_cache=False,
+    )
+    return {"projections": [outputs["projection"]], "stats": outputs["stats"]}
+
+
+def run_check_test003(
+    acceptance_angle, skip_policy, output_dir, threads, nb_slices, seed
+):
+    # executed in its own process, a few angles of the rotation
+    import opengate as gate
+    from test003_iec_phantom_rotation import set_test003_simulation
+    from spect_helpers import add_acceptance_angle_stats
+
+    sec = gate.g4_units.s
+    simu_name = "aa_check_test003"
+    nb_angles = 60
+    sim = gate.Simulation()
+    set_test003_simulation(
+        sim,
+        simu_name,
+        threads,
+        300 * sec / nb_slices,
+        nb_angles,
+        [0, 15, 30, 45],
+        acceptance_angle,
+        skip_policy,
+    )
+    sim.random_seed = seed
+    sim.output_dir = Path(output_dir)
+    sim.progress_bar = False
+    sim.run()
+    stats = Path(output_dir) / f"{simu_name}_stats.txt"
+    if acceptance_angle:
+        add_acceptance_angle_stats(sim, stats)
+    return {
+        "projections": [
+            str(Path(output_dir) / f"{simu_name}_projection_{i}.mhd") for i in range(2)
+        ],
+        "stats": str(stats),
+    }
+
+
+check_scenarios = {"nema001": run_check_nema001, "test003": run_check_test003}
+
+
+def rebin(img, factor):
+    # sum blocks of factor x factor pixels (more counts per pixel for the chi2)
+    ny, nx = img.shape[0] // factor, img.shape[1] // factor
+    img = img[: ny * factor, : nx * factor]
+    return img.reshape(ny, factor, nx, factor).sum(axis=(1, 3))
+
+
+def compare_projections(unbiased_files, biased_files, factor=4):
+    """
+    Compare each slice of the biased and unbiased projections: z-score of the
+    total counts and chi2/ndf of the (rebinned) images. Both are expected to
+    be Poisson samples of the same image.
+    """
+    results = []
+    for fu, fb in zip(unbiased_files, biased_files):
+        u, _ = memmap_mhd(fu)
+        b, _ = memmap_mhd(fb)
+        for s in range(u.shape[0]):
+            iu = rebin(np.asarray(u[s], dtype=np.float64), factor)
+            ib = rebin(np.asarray(b[s], dtype=np.float64), factor)
+            nu, nb = iu.sum(), ib.sum()
+            z = (nb - nu) / np.sqrt(max(nu + nb, 1))
+            m = (iu + ib) > 0
+            chi2 = np.sum((ib[m] - iu[m]) ** 2 / (ib[m] + iu[m]))
+            results.append(
+                {
+                    "filename": str(fb),
+                    "slice": s,
+                    "counts_unbiased": float(nu),
+                    "counts_biased": float(nb),
+                    "z": float(z),
+                    "chi2_ndf": float(chi2 / max(m.sum(), 1)),
+                }
+            )
+    return results
+
+
+def get_efficiency(stats):
+    # emitted primaries and counts per second of simulation
+    emitted = stats["NumberOfEvents"] + stats.get("SkippedEvents", 0)
+    return {
+        "events": stats["NumberOfEvents"],
+        "emitted": emitted,
+        "elapsed": stats["ElapsedTime"],
+        "emitted_per_sec": emitted / stats["ElapsedTime"],
+    }
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--scenario", "-s", default="nema001", help="nema001 or test003")
+@click.option(
+    "--skip_policy",
+    default="SkipEvents",
+    help="Acceptance angle: SkipEvents or ZeroEnergy",
+)
+@click.option("--threads", "-t", default=4, help="Nb of threads per simulation")
+@click.option(
+    "--nb_slices",
+    default=20,
+    help="Simulate 1/nb_slices of the acquisition time",
+)
+@click.option("--seed", default=None, type=int, help="Base seed (default: random)")
+@click.option("--max_z", default=3.0, help="Max z-score of the total counts")
+@click.option("--max_chi2", default=1.5, help="Max chi2/ndf of the images")
+@click.option("--output_folder", "-o", default="output/aa_check")
+def go(scenario, skip_policy, threads, nb_slices, seed, max_z, max_chi2, output_folder):
+    """
+    Run the same acquisition with and without acceptance angle and check that
+    the projections are statistically compatible, then report the speedup
+    """
+    output_folder = Path(output_folder) / scenario
+    seeds = get_seeds(seed, 2)
+    tasks = []
+    for i, aa in enumerate([False, True]):
+        tasks.append(
+            {
+                "acceptance_angle": aa,
+                "skip_policy": skip_policy,
+                "output_dir": str(output_folder / ("biased" if aa else "unbiased")),
+                "threads": threads,
+                "nb_slices": nb_slices,
+                "seed": seeds[i],
+            }
+        )
+    outputs = [None, None]
+    for i, outcome in run_in_processes(check_scenarios[scenario], tasks, 2):
+        if outcome["status"] != "done":
+            raise RuntimeError(f"Simulation {i} failed: {outcome['error']}")
+        outputs[i] = outcome["result"]
+
+    # compatibility
+    results = compare_projections(outputs[0]["projections"], outputs[1]["projections"])
+    ok = True
+    for r in results:
+        valid = abs(r["z"]) <= max_z and r["chi2_ndf"] <= max_chi2
+        ok &= valid
+        print(
+            f"{Path(r['filename']).name} slice {r['slice']}: "
+            f"counts {r['counts_unbiased']:.0f} vs {r['counts_biased']:.0f} "
+            f"(z = {r['z']:.2f}), chi2/ndf = {r['chi2_ndf']:.2f} "
+            f"{'' if valid else ' <-- NOT COMPATIBLE'}"
+        )
+
+    # speedup
+    eff = [get_efficiency(read_stats_file(o["stats"])) for o in outputs]
+    speedup = eff[0]["elapsed"] / eff[1]["elapsed"]
+    print(
+        f"Emitted primaries: {eff[0]['emitted']} vs {eff[1]['emitted']} "
+        f"({eff[1]['events']} tracked with acceptance angle)"
+    )
+    print(f"Speedup (same acquisition time) = {speedup:.1f}")
+    print("Acceptance angle check " + ("PASSED" if ok else "FAILED"))
+
+    report = {
+        "scenario": scenario,
+        "skip_policy": skip_policy,
+        "passed": bool(ok),
+        "speedup": speedup,
+        "efficiency": eff,
+        "slices": results,
+    }
+    with open(output_folder / "aa_check.json", "w") as f:
+        json.dump(report, f, indent=2)
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import numpy as np
+
+# mass attenuation coefficients (cm2/g, NIST XCOM, with coherent scattering)
+mass_attenuation_energies_keV = [100, 150, 200, 300, 400]
+mass_attenuation = {
+    "water": [0.1707, 0.1505, 0.1370, 0.1186, 0.1061],
+    "pmma": [0.1658, 0.1463, 0.1331, 0.1153, 0.1031],
+    "polystyrene": [0.1624, 0.1435, 0.1307, 0.1132, 0.1013],
+    "air": [0.1541, 0.1356, 0.1233, 0.1067, 0.0955],
+    "carbon": [0.1514, 0.1347, 0.1229, 0.1066, 0.0955],
+}
+
+# material name -> (composition in the table above, density g/cm3)
+materials = {
+    "G4_AIR": ("air", 0.00120479),
+    "G4_WATER": ("water", 1.0),
+    "IEC_PLASTIC": ("pmma", 1.18),
+    "G4_PLEXIGLASS": ("pmma", 1.19),
+    "G4_POLYSTYRENE": ("polystyrene", 1.06),
+    "G4_LUNG_ICRP": ("water", 1.04),
+    "G4_CARBON": ("carbon", 2.0),
+    "G4_Galactic": ("air", 0.0),
+}
+
+
+def get_linear_attenuation(material, energy_keV):
+    """
+    Linear attenuation coefficient (1/mm) of a material at this energy.
+    Unknown materials are considered as water.
+    """
+    if material not in materials:
+        print(f"Warning: unknown material {material}, water is used")
+    composition, density = materials.get(material, ("water", 1.0))
+    mu_rho = np.interp(
+        energy_keV, mass_attenuation_energies_keV, mass_attenuation[composition]
+    )
+    # cm2/g * g/cm3 = 1/cm
+    return mu_rho * density / 10.0
+
+
+def voxelize_simulation(sim, size, spacing):
+    """
+    Voxelize the geometry of the simulation (heads removed by the caller) on
+    a grid (size, spacing) centred on the world origin, with the same axes as
+    Geant4 (image z, y, x). Return the label image (numpy) and a dict
+    {volume name: label}.
+    """
+    half = np.array(size) * np.array(spacing) / 2.0
+    extent = (list(-half), list(half))
+    labels, image = sim.voxelize_geometry(extent=extent, spacing=spacing)
+    import itk
+
+    return itk.array_view_from_image(image).copy(), labels
+
+
+def get_attenuation_map(sim, label_image, labels, energy_keV, exclude="^spect"):
+    """
+    Linear attenuation map (1/mm) from the materials of the labelled volumes.
+    The volumes matching the exclude regex (the spect heads) are replaced by
+    the world material.
+    """
+    mu = np.zeros(label_image.shape, dtype=np.float32)
+    pattern = re.compile(exclude)
+    for name, label in labels.items():
+        if name == sim.world.name or pattern.search(name):
+            material = sim.world.material
+        else:
+            material = sim.volume_manager.get_volume(name).material
+        mu[label_image == label] = get_linear_attenuation(material, energy_keV)
+    return mu
+
+
+def get_activity_map(label_image, labels, source_volumes, concentrations=None):
+    """
+    Activity map (arbitrary units, per voxel) for the volumes whose name
+    matches the source_volumes regex (default concentration: 1 for all)
+    """
+    activity = np.zeros(label_image.shape, dtype=np.float32)
+    pattern = re.compile(source_volumes)
+    names = sorted(n for n in labels if pattern.search(n))
+    for i, name in enumerate(names):
+        c = 1.0 if concentrations is None else concentrations[i]
+        activity[label_image == labels[name]] = c
+    return activity, names
+
+
+def to_rotation_frame(volume, rotation_axis):
+    """
+    Volume (z, y, x) to the frame of RotationProjector (rotation around the
+    first axis). Around X, the detector at angle 0 is along +Z.
+    """
+    if rotation_axis == "Z":
+        return volume
+    if rotation_axis == "X":
+        return np.ascontiguousarray(volume.transpose(2, 1, 0))
+    raise ValueError(f"Unknown rotation axis {rotation_axis}")
+
+
+def get_rotation_frame_axes(rotation_axis, angle_deg):
+    """
+    World directions of the rotation axis and of the v axis (along the
+    detector) of RotationProjector at this angle, in the frame of
+    to_rotation_frame
+    """
+    a = np.deg2rad(angle_deg)
+    if rotation_axis == "Z":
+        return np.array([0.0, 0.0, 1.0]), np.array([-np.sin(a), np.cos(a), 0.0])
+    if rotation_axis == "X":
+        return np.array([1.0, 0.0, 0.0]), np.array([0.0, np.cos(a), -np.sin(a)])
+    raise ValueError(f"Unknown rotation axis {rotation_axis}")
+
+
+def get_rotation_frame_angle(rotation_axis, position):
+    # angle (deg) of RotationProjector of a detector at this world position
+    x, y, z = position
+    if rotation_axis == "Z":
+        return np.rad2deg(np.arctan2(y, x))
+    if rotation_axis == "X":
+        return np.rad2deg(np.arctan2(y, z))
+    raise ValueError(f"Unknown rotation axis {rotation_axis}")
+
+
+def get_projection_geometry(sim, rotation_axis):
+    """
+    Angle (RotationProjector) of each projection of the simulation, and the
+    world directions of the image columns and rows, from the volume of each
+    DigitizerProjectionActor (one per head) at each run and its
+    detector_orientation_matrix (columns: local axes of the image x, y, z).
+    Order: all runs of head 0, then head 1, etc.
+    """
+    from spect_helpers import get_volume_world_transforms
+
+    nb_runs = len(sim.run_timing_intervals)
+    angles = []
+    axes = []
+    for a in sim.actor_manager.actors.values():
+        if type(a).__name__ != "DigitizerProjectionActor":
+            continue
+        o = np.asarray(a.detector_orientation_matrix, dtype=np.float64)
+        rotations, translations = get_volume_world_transforms(
+            sim, a.attached_to, nb_runs
+        )
+        for r, t in zip(rotations, translations):
+            angles.append(get_rotation_frame_angle(rotation_axis, t))
+            axes.append((r @ o[:, 0], r @ o[:, 1]))
+    return np.array(angles), axes
+
+
+def get_image_orientation(columns, rows, rotation_axis, angle_deg):
+    """
+    (axial_axis, flip, flip_axial) of to_image_orientation for an image whose
+    columns and rows follow these world directions
+    """
+    axial, v = get_rotation_frame_axes(rotation_axis, angle_deg)
+    if abs(columns @ axial) > abs(rows @ axial):
+        return 1, bool(rows @ v < 0), bool(columns @ axial < 0)
+    return 0, bool(columns @ v < 0), bool(rows @ axial < 0)
+
+
+def compare_projections(mc, analytic, spacing):
+    """
+    Compare the MC and analytic projections (nb_proj, rows, cols), the
+    analytic projections are scaled to the MC total counts. For each
+    projection: normalized RMSE, correlation and centre of mass shift (mm),
+    to check the orientation and positions.
+    """
+    mc = np.asarray(mc, dtype=np.float64)
+    analytic = np.asarray(analytic, dtype=np.float64)
+    scale = mc.sum() / analytic.sum()
+    analytic = analytic * scale
+    rows = np.arange(mc.shape[1])[:, None]
+    cols = np.arange(mc.shape[2])[None, :]
+    results = []
+    for i in range(len(mc)):
+        a, m = analytic[i], mc[i]
+        nrmse = np.sqrt(np.mean((a - m) ** 2)) / max(m.max(), 1e-12)
+        corr = np.corrcoef(a.ravel(), m.ravel())[0, 1]
+        com = []
+        for img in (m, a):
+            t = max(img.sum(), 1e-12)
+            com.append([(img * rows).sum() / t, (img * cols).sum() / t])
+        shift = (np.array(com[1]) - np.array(com[0])) * np.array(spacing[::-1])
+        results.append(
+            {
+                "projection": i,
+                "nrmse": float(nrmse),
+                "correlation": float(corr),
+                "shift_rows_mm": float(shift[0]),
+                "shift_cols_mm": float(shift[1]),
+            }
+        )
+    return scale, results
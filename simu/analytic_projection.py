@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import time
+from pathlib import Path
+import numpy as np
+import click
+from mhd_helpers import write_mhd
+from recon_helpers import read_projections, RotationProjector
+from analytic_helpers import *
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+# scenario: module, set function, nb of heads, nb of angles per head,
+# rotation axis of the gantry
+analytic_scenarios = {
+    "test002": ("test002_iec_phantom", "set_test002_simulation", 1, 1, "X"),
+    "test003": ("test003_iec_phantom_rotation", "set_test003_simulation", 2, 60, "Z"),
+}
+
+# same as the intevo digitizer (add_digitizer_intevo_lu177)
+intevo_size = 128
+intevo_spacing = 4.7951998710632
+
+
+def get_projection_filenames(folder, simu_name, nb_heads, suffix="projection"):
+    # same names as the DigitizerProjectionActor outputs of the tests
+    if nb_heads == 1:
+        return [Path(folder) / f"{simu_name}_{suffix}.mhd"]
+    return [Path(folder) / f"{simu_name}_{suffix}_{h}.mhd" for h in range(nb_heads)]
+
+
+def to_image_orientation(projection, axial_axis, flip, flip_axial=False):
+    # (z, v) of the projector -> (rows, cols) of the projection image
+    if flip:
+        projection = projection[:, ::-1]
+    if flip_axial:
+        projection = projection[::-1, :]
+    if axial_axis == 1:
+        projection = projection.T
+    return np.ascontiguousarray(projection)
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def go():
+    """
+    Analytic (attenuated, depth-dependent blurred, parallel) projections of
+    the test002/test003 geometry, for quick checks instead of Monte Carlo
+    """
+    pass
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--scenario", "-s", default="test003", help="test002 or test003")
+@click.option("--output_folder", "-o", default="output", help="Output folder")
+@click.option("--simu_name", "-n", default=None, help="Default: scenario name")
+@click.option("--energy", "-e", default=208.0, help="Photon energy (keV)")
+@click.option(
+    "--source_volumes",
+    default=r"sphere_\d+mm$",
+    help="Regex of the source volume names",
+)
+@click.option("--psf", is_flag=True, default=False, help="Collimator response")
+@click.option("--sigma0", default=0.9, help="PSF sigma at the detector (mm)")
+@click.option("--alpha", default=0.025, help="PSF sigma slope with the distance")
+@click.option("--radius", default=400.0, help="Detector distance (mm)")
+@click.option(
+    "--axial_axis",
+    default=None,
+    type=int,
+    help="Image axis along the rotation axis (default: from the digitizer)",
+)
+@click.option(
+    "--flip/--no_flip",
+    default=None,
+    help="Flip the other axis (default: from the digitizer)",
+)
+@click.option("--threads", "-t", default=None, type=int, help="Nb of threads")
+def project(
+    scenario,
+    output_folder,
+    simu_name,
+    energy,
+    source_volumes,
+    psf,
+    sigma0,
+    alpha,
+    radius,
+    axial_axis,
+    flip,
+    threads,
+):
+    """
+    Voxelize the geometry of the scenario and compute the projections
+    """
+    import importlib
+    import opengate as gate
+
+    t = time.time()
+    module_name, function_name, nb_heads, nb_angles, axis = analytic_scenarios[
+        scenario
+    ]
+    if simu_name is None:
+        simu_name = scenario
+
+    # same geometry as the Monte Carlo simulation
+    sim = gate.Simulation()
+    set_simulation = getattr(importlib.import_module(module_name), function_name)
+    set_simulation(sim, simu_name, 1)
+    n = intevo_size
+    s = intevo_spacing
+    label_image, labels = voxelize_simulation(sim, [n, n, n], [s, s, s])
+    mu = get_attenuation_map(sim, label_image, labels, energy)
+    activity, names = get_activity_map(label_image, labels, source_volumes)
+    print(f"Geometry voxelized in {time.time() - t:.1f} s, sources: {names}")
+
+    # projections, with the angles and image orientation of the digitizer
+    angles, image_axes = get_projection_geometry(sim, axis)
+    if len(angles) != nb_heads * nb_angles:
+        raise ValueError(
+            f"{len(angles)} projections in the {scenario} digitizer, "
+            f"{nb_heads * nb_angles} expected"
+        )
+    orientations = []
+    for angle, (columns, rows) in zip(angles, image_axes):
+        o = get_image_orientation(columns, rows, axis, angle)
+        if axial_axis is not None:
+            o = (axial_axis, o[1], o[2])
+        if flip is not None:
+            o = (o[0], flip, o[2])
+        orientations.append(o)
+    for o in sorted(set(orientations)):
+        print(f"Image orientation (axial_axis, flip, flip_axial): {o}")
+    mu = to_rotation_frame(mu, axis)
+    activity = to_rotation_frame(activity, axis)
+    psf_args = (radius, sigma0, alpha) if psf else (None, None, None)
+    projector = RotationProjector(
+        angles, n, n, s, *psf_args, nb_threads=threads, mu=mu
+    )
+    projections = projector.forward(activity, range(len(angles)))
+    projections = np.array(
+        [to_image_orientation(p, *o) for p, o in zip(projections, orientations)]
+    )
+    print(f"{len(angles)} projections computed in {time.time() - t:.1f} s")
+
+    # one stack per head, (one energy window)
+    origin = [-(n - 1) / 2 * s, -(n - 1) / 2 * s, 0]
+    filenames = get_projection_filenames(
+        output_folder, simu_name, nb_heads, "analytic_projection"
+    )
+    for h, f in enumerate(filenames):
+        p = projections[h * nb_angles : (h + 1) * nb_angles]
+        write_mhd(f, p, [s, s, 1], origin)
+        print(f"Analytic projections written to {f}")
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--scenario", "-s", default="test003", help="test002 or test003")
+@click.option("--output_folder", "-o", default="output", help="Output folder")
+@click.option("--simu_name", "-n", default=None, help="Default: scenario name")
+@click.option("--window", "-w", default=5, help="MC energy window (5 is peak 208)")
+@click.option("--nb_ene_win", default=7, help="Number of energy windows")
+@click.option("--max_shift", default=5.0, help="Max centre of mass shift (mm)")
+def compare(scenario, output_folder, simu_name, window, nb_ene_win, max_shift):
+    """
+    Compare the analytic projections to the Monte Carlo ones
+    """
+    _, _, nb_heads, _, _ = analytic_scenarios[scenario]
+    if simu_name is None:
+        simu_name = scenario
+    mc, spacing = read_projections(
+        get_projection_filenames(output_folder, simu_name, nb_heads),
+        window,
+        nb_ene_win,
+    )
+    analytic, _ = read_projections(
+        get_projection_filenames(
+            output_folder, simu_name, nb_heads, "analytic_projection"
+        ),
+        0,
+        1,
+    )
+    scale, results = compare_projections(mc, analytic, spacing)
+    for r in results:
+        flag = ""
+        if max(abs(r["shift_rows_mm"]), abs(r["shift_cols_mm"])) > max_shift:
+            flag = " <-- SHIFT"
+        print(
+            f"Projection {r['projection']:3d}: corr = {r['correlation']:.3f}  "
+            f"nrmse = {r['nrmse']:.3f}  shift = ({r['shift_rows_mm']:.1f}, "
+            f"{r['shift_cols_mm']:.1f}) mm{flag}"
+        )
+    corr = np.mean([r["correlation"] for r in results])
+    print(f"Mean correlation = {corr:.3f}, scaling = {scale:.4g}")
+    output = Path(output_folder) / f"{simu_name}_analytic_comparison.json"
+    with open(output, "w") as f:
+        json.dump({"scaling": scale, "projections": results}, f, indent=2)
+    print(f"Comparison written to {output}")
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
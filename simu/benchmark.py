@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import platform
+import resource
+import time
+from pathlib import Path
+import click
+from parallel_helpers import run_in_processes
+from stats_helpers import read_stats_file
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+# scenario: module, set function, production duration (sec)
+benchmark_scenarios = {
+    "test001": ("test001_no_phantom", "set_test001_simulation", 300),
+    "test002": ("test002_iec_phantom", "set_test002_simulation", 300),
+    "test003": ("test003_iec_phantom_rotation", "set_test003_simulation", 300),
+}
+
+
+def run_benchmark_scenario(
+    scenario, number_of_threads, duration, output_dir, digitizer="full"
+):
+    # executed in its own process (Geant4 can only be run once per process)
+    import importlib
+    import opengate as gate
+    from redigitizer_helpers import project_intevo_singles
+    from spect_helpers import get_singles_transforms
+
+    sec = gate.g4_units.s
+    module_name, function_name, _ = benchmark_scenarios[scenario]
+    set_simulation = getattr(importlib.import_module(module_name), function_name)
+
+    # create the simulation
+    t = time.time()
+    sim = gate.Simulation()
+    simu_name = f"bench_{scenario}"
+    stats = set_simulation(
+        sim, simu_name, number_of_threads, duration * sec, digitizer=digitizer
+    )
+    sim.output_dir = Path(output_dir)
+    sim.progress_bar = False
+    build_time = time.time() - t
+
+    # go
+    t = time.time()
+    sim.run()
+    wall_time = time.time() - t
+
+    # fast digitizer: the projection is part of the cost
+    projection_time = 0
+    if digitizer == "fast":
+        t = time.time()
+        project_intevo_singles(
+            sorted(Path(output_dir).glob(f"{simu_name}_singles*.root")),
+            Path(output_dir) / f"{simu_name}_projection.mhd",
+            len(sim.run_timing_intervals),
+            get_singles_transforms(sim),
+        )
+        projection_time = time.time() - t
+
+    # results
+    s = read_stats_file(Path(output_dir) / f"{simu_name}_stats.txt")
+    try:
+        init_time = stats.counts.init / sec
+    except (AttributeError, KeyError):
+        init_time = None
+    return {
+        "scenario": scenario,
+        "threads": number_of_threads,
+        "digitizer": digitizer,
+        "duration": duration,
+        "events": s.get("NumberOfEvents"),
+        "pps": s.get("PPS"),
+        "wall_time": wall_time,
+        "projection_time": projection_time,
+        "us_per_event": get_time_per_event(wall_time + projection_time, s),
+        "build_time": build_time,
+        "init_time": init_time,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "opengate": getattr(gate, "__version__", None),
+    }
+
+
+def get_time_per_event(total_time, stats):
+    # wall time per event in microseconds (includes the digitizer cost)
+    events = stats.get("NumberOfEvents")
+    if not events:
+        return None
+    return 1e6 * total_time / events
+
+
+def get_baseline_key(record):
+    key = f"{record['scenario']}_t{record['threads']}"
+    # (records without digitizer mode are full digitizer records)
+    digitizer = record.get("digitizer", "full")
+    if digitizer != "full":
+        key += f"_{digitizer}"
+    return key
+
+
+def get_digitizer_gains(records):
+    """
+    Wall time per event of the lean/fast digitizer modes relative to the full
+    digitizer, for each scenario and number of threads run with both
+    """
+    full = {
+        (r["scenario"], r["threads"]): r
+        for r in records
+        if r.get("digitizer", "full") == "full"
+    }
+    gains = []
+    for r in records:
+        f = full.get((r["scenario"], r["threads"]))
+        if r.get("digitizer", "full") == "full" or f is None:
+            continue
+        if r["us_per_event"] is None or f["us_per_event"] is None:
+            continue
+        gains.append(
+            f"{r['scenario']} {r['threads']} threads {r['digitizer']}: "
+            f"{r['us_per_event']:.2f} us/event vs full {f['us_per_event']:.2f} "
+            f"({100 * (r['us_per_event'] / f['us_per_event'] - 1):.1f}%)"
+        )
+    return gains
+
+
+def check_regression(record, baseline, tolerance):
+    """
+    Return a message if the PPS is lower than the baseline minus tolerance
+    """
+    key = get_baseline_key(record)
+    if key not in baseline or record["pps"] is None:
+        return None
+    ref = baseline[key]["pps"]
+    if record["pps"] < ref * (1 - tolerance):
+        return (
+            f"REGRESSION {key}: PPS = {record['pps']:.0f} vs baseline {ref:.0f} "
+            f"({100 * (record['pps'] / ref - 1):.1f}%)"
+        )
+    return None
+
+
+def read_json(filename, default):
+    filename = Path(filename)
+    if not filename.exists():
+        return default
+    with open(filename) as f:
+        return json.load(f)
+
+
+def write_json(filename, data):
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "--scenario",
+    "-s",
+    multiple=True,
+    default=list(benchmark_scenarios.keys()),
+    help="Scenario(s) to run: test001, test002, test003",
+)
+@click.option(
+    "--threads", "-t", multiple=True, type=int, default=[1, 4], help="Nb of threads"
+)
+@click.option(
+    "--duration_factor",
+    "-f",
+    default=0.1,
+    help="Fraction of the production acquisition time to simulate",
+)
+@click.option(
+    "--digitizer",
+    "-d",
+    multiple=True,
+    type=click.Choice(["full", "lean", "fast"]),
+    default=["full"],
+    help="Digitizer mode(s) (see add_digitizer_intevo_lu177)",
+)
+@click.option("--output_dir", "-o", default="benchmark", help="Output folder")
+@click.option(
+    "--history", default="benchmark/history.json", help="Json history of all results"
+)
+@click.option(
+    "--baseline", default="benchmark/baseline.json", help="Json reference PPS"
+)
+@click.option(
+    "--tolerance", default=0.1, help="Relative PPS drop flagged as regression"
+)
+@click.option(
+    "--update_baseline", is_flag=True, default=False, help="Store results as baseline"
+)
+def go(
+    scenario,
+    threads,
+    duration_factor,
+    digitizer,
+    output_dir,
+    history,
+    baseline,
+    tolerance,
+    update_baseline,
+):
+    # one benchmark after the other, never concurrently
+    tasks = []
+    for s in scenario:
+        for t in threads:
+            for d in digitizer:
+                tasks.append(
+                    {
+                        "scenario": s,
+                        "number_of_threads": t,
+                        "duration": benchmark_scenarios[s][2] * duration_factor,
+                        "output_dir": str(Path(output_dir) / f"{s}_t{t}_{d}"),
+                        "digitizer": d,
+                    }
+                )
+    records = []
+    for i, outcome in run_in_processes(run_benchmark_scenario, tasks, 1):
+        if outcome["status"] != "done":
+            print(f"{tasks[i]['scenario']} failed: {outcome['error']}")
+            continue
+        r = outcome["result"]
+        r["date"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        r["host"] = platform.node()
+        records.append(r)
+        print(
+            f"{r['scenario']} {r['threads']} threads {r['digitizer']}: "
+            f"PPS = {r['pps']}  wall = {r['wall_time']:.1f} s  "
+            f"projection = {r['projection_time']:.1f} s  init = {r['init_time']}  "
+            f"RSS = {r['peak_rss_mb']:.0f} MB"
+        )
+
+    # history
+    h = read_json(history, [])
+    h.extend(records)
+    write_json(history, h)
+    print(f"History written to {history}")
+
+    # digitizer cost per event
+    for g in get_digitizer_gains(records):
+        print(g)
+
+    # regressions
+    b = read_json(baseline, {})
+    regressions = [check_regression(r, b, tolerance) for r in records]
+    regressions = [r for r in regressions if r is not None]
+    for r in regressions:
+        print(r)
+    if update_baseline:
+        for r in records:
+            b[get_baseline_key(r)] = r
+        write_json(baseline, b)
+        print(f"Baseline written to {baseline}")
+    if regressions:
+        raise SystemExit(1)
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+cache_index_filename = "cache_index.json"
+
+# the outputs that are files or folders (the others are names or values)
+cached_output_files = [
+    "output_dir",
+    "projection",
+    "stats",
+    "singles",
+    "lines",
+    "sources",
+    "profile",
+]
+
+
+def get_simulation_key(sim, extra=None):
+    """
+    Hash of the complete configuration of the simulation (geometry, sources,
+    physics, actors/digitizer, timing, seed policy) and of the extra
+    parameters. The output folder is not part of the key, nor the nb of
+    threads: the activity of each source for all the threads is, the
+    per-thread activities are not (rounded, the division by the nb of threads
+    is not exact).
+    """
+    from spect_helpers import get_source_activities
+
+    config = {
+        "simulation": sim.to_dictionary(),
+        "run_timing_intervals": sim.run_timing_intervals,
+        "random_seed": sim.random_seed,
+        "source_activities": {
+            k: float(f"{a:.12g}") for k, a in get_source_activities(sim).items()
+        },
+        "extra": extra,
+    }
+    config = remove_keys(config, ["output_dir", "number_of_threads", "activity"])
+    s = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+def remove_keys(d, keys):
+    if isinstance(d, dict):
+        return {k: remove_keys(v, keys) for k, v in d.items() if k not in keys}
+    if isinstance(d, (list, tuple)):
+        return [remove_keys(v, keys) for v in d]
+    return d
+
+
+@contextmanager
+def locked_cache_index(cache_root):
+    """
+    Read/modify/write the index, locked against concurrent processes (sweeps)
+    """
+    cache_root = Path(cache_root)
+    cache_root.mkdir(parents=True, exist_ok=True)
+    with open(cache_root / f"{cache_index_filename}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        filename = cache_root / cache_index_filename
+        index = {}
+        if filename.exists():
+            with open(filename) as f:
+                index = json.load(f)
+        yield index
+        tmp = filename.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp, filename)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def get_folder_size(folder):
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+def find_cached_result(cache_root, key):
+    """
+    Return the outputs of a finished simulation with the same key, or None.
+    Entries whose files have been removed are dropped from the index.
+    """
+    with locked_cache_index(cache_root) as index:
+        if key not in index:
+            return None
+        entry = index[key]
+        outputs = entry["outputs"]
+        files = [outputs[k] for k in cached_output_files if outputs.get(k)]
+        if not all(Path(f).exists() for f in files):
+            del index[key]
+            return None
+        entry["last_used"] = time.time()
+        return entry["outputs"]
+
+
+def add_cached_result(cache_root, key, outputs):
+    with locked_cache_index(cache_root) as index:
+        # the files of older results in the same folder have been overwritten
+        for k in list(index):
+            if index[k]["outputs"]["output_dir"] == outputs["output_dir"]:
+                del index[k]
+        index[key] = {
+            "outputs": outputs,
+            "size": get_folder_size(outputs["output_dir"]),
+            "created": time.time(),
+            "last_used": time.time(),
+        }
+
+
+def evict_cached_results(cache_root, max_size):
+    """
+    Remove the least recently used output folders until the total size of the
+    cached results is below max_size (bytes). Only folders inside cache_root
+    are removed. Return the list of removed folders.
+    """
+    cache_root = Path(cache_root).resolve()
+    removed = []
+    with locked_cache_index(cache_root) as index:
+        # (entries whose folder is already gone take no space)
+        for key in list(index):
+            if not Path(index[key]["outputs"]["output_dir"]).exists():
+                index.pop(key)
+        total = sum(e["size"] for e in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_used"]):
+            if total <= max_size:
+                break
+            folder = Path(index[key]["outputs"]["output_dir"]).resolve()
+            if cache_root not in folder.parents:
+                continue
+            try:
+                shutil.rmtree(folder)
+            except OSError as e:
+                print(f"Cannot remove {folder}: {e}")
+                continue
+            total -= index.pop(key)["size"]
+            removed.append(str(folder))
+    return removed
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+from scipy.optimize import minimize
+from redigitizer_helpers import fwhm_to_sigma, get_energy_resolution
+from nema_fwhm_helpers import get_line_orientation, locate_sources
+
+# sub-pixel binning of the model profiles
+oversampling = 4
+
+
+class LineSpreadModel:
+    """
+    Fast surrogate of the digitizer for the calibration: the un-blurred stored
+    singles are binned once into line spread profiles (perpendicular to the
+    line source), the spatial blur is then a 1D gaussian convolution. The
+    energy blur uses fixed random deviates (common random numbers) so that
+    the model is a deterministic function of the parameters.
+    """
+
+    def __init__(
+        self, singles, energy_blur, channels, size, spacing, line_axis, seed=0
+    ):
+        self.energy_blur = dict(energy_blur)
+        self.channels = channels
+        # position perpendicular to the line source
+        if line_axis == 0:
+            self.pos = singles["x"].astype(np.float64)
+            self.nb_pixels, self.spacing = size[0], spacing[0]
+        else:
+            self.pos = singles["y"].astype(np.float64)
+            self.nb_pixels, self.spacing = size[1], spacing[1]
+        self.energy = singles["energy"].astype(np.float64)
+        rng = np.random.default_rng(seed)
+        self.z = rng.standard_normal(len(self.energy))
+        self.shift = 0.0
+
+    def blurred_energy(self, resolution):
+        eb = {**self.energy_blur, "resolution": resolution}
+        r = get_energy_resolution(self.energy, **eb)
+        return self.energy * (1 + r * fwhm_to_sigma * self.z)
+
+    def profiles(self, fwhm, resolution):
+        """
+        Line spread profiles (nb_channels, nb_pixels) for the given spatial
+        FWHM (mm) and energy resolution (at the reference energy)
+        """
+        energy = self.blurred_energy(resolution)
+        n = self.nb_pixels * oversampling
+        s = self.spacing / oversampling
+        i = np.floor((self.pos + self.shift) / s + n / 2.0).astype(np.int64)
+        inside = (i >= 0) & (i < n)
+        profiles = []
+        for c in self.channels:
+            m = inside & (energy >= c["min"]) & (energy < c["max"])
+            p = np.bincount(i[m], minlength=n).astype(np.float64)
+            if fwhm > 0:
+                p = gaussian_filter1d(p, fwhm * fwhm_to_sigma / s, mode="constant")
+            profiles.append(p.reshape(self.nb_pixels, oversampling).sum(axis=1))
+        return np.array(profiles)
+
+    def align(self, ref_profile, channel=0):
+        # shift the singles so that the centroids of the peaks are the same
+        self.shift = 0.0
+        p = self.profiles(0.0, self.energy_blur["resolution"])[channel]
+        self.shift = (centroid(ref_profile) - centroid(p)) * self.spacing
+
+
+def centroid(profile, half_width=30):
+    c = locate_sources(profile, 1)[0]
+    a, b = max(0, c - half_width), min(len(profile), c + half_width + 1)
+    x = np.arange(a, b)
+    return np.sum(x * profile[a:b]) / np.sum(profile[a:b])
+
+
+def get_reference_profiles(ref_images, line_axis=None):
+    """
+    Line spread profiles of the reference images (list of 2D arrays, one for
+    each calibrated energy window)
+    """
+    if line_axis is None:
+        line_axis = get_line_orientation(ref_images[0])
+    profiles = np.array([img.sum(axis=line_axis) for img in ref_images])
+    return profiles.astype(np.float64), line_axis
+
+
+def get_chi2(ref, model, window):
+    """
+    Chi2 between the reference and the model profiles (nb_channels, nb_pixels)
+    in the window, the model is scaled to the total counts of the reference
+    (same factor for all channels so that the window ratios are fitted)
+    """
+    r = ref[:, window]
+    m = model[:, window]
+    scale = r.sum() / max(m.sum(), 1e-12)
+    var = np.maximum(r + scale**2 * m, 1)
+    return np.sum((r - scale * m) ** 2 / var)
+
+
+def fit_digitizer_blur(model, ref_profiles, x0, bounds, half_width=40):
+    """
+    Fit the spatial FWHM and the energy resolution of the digitizer so that
+    the model matches the reference profiles. The uncertainties are computed
+    from the numerical hessian of the chi2 (cov = 2 H^-1).
+    """
+    c = locate_sources(ref_profiles.sum(axis=0), 1)[0]
+    window = slice(max(0, c - half_width), c + half_width + 1)
+    model.align(ref_profiles.sum(axis=0))
+    x0 = np.asarray(x0, dtype=np.float64)
+    scale = x0.copy()
+
+    def f(u):
+        x = np.clip(u * scale, [b[0] for b in bounds], [b[1] for b in bounds])
+        return get_chi2(ref_profiles, model.profiles(*x), window)
+
+    res = minimize(
+        f, np.ones(len(x0)), method="Nelder-Mead", options={"xatol": 1e-3}
+    )
+    x = res.x * scale
+    h = get_hessian(f, res.x, 0.02) / np.outer(scale, scale)
+    try:
+        cov = 2 * np.linalg.inv(h)
+        err = np.sqrt(np.abs(np.diag(cov)))
+    except np.linalg.LinAlgError:
+        err = np.full(len(x), np.nan)
+    ndf = np.count_nonzero(ref_profiles[:, window]) - len(x) - 1
+    return {
+        "spatial_blur_fwhm": float(x[0]),
+        "spatial_blur_fwhm_error": float(err[0]),
+        "energy_resolution": float(x[1]),
+        "energy_resolution_error": float(err[1]),
+        "chi2": float(res.fun),
+        "ndf": int(ndf),
+        "nb_evaluations": int(res.nfev),
+    }
+
+
+def get_hessian(f, x, step):
+    # central finite differences (relative steps, the chi2 is not smooth at
+    # the scale of one single)
+    n = len(x)
+    h = np.zeros((n, n))
+    e = np.eye(n) * step
+    f0 = f(x)
+    for i in range(n):
+        for j in range(i, n):
+            if i == j:
+                h[i, i] = (f(x + e[i]) - 2 * f0 + f(x - e[i])) / step**2
+            else:
+                h[i, j] = (
+                    f(x + e[i] + e[j])
+                    - f(x + e[i] - e[j])
+                    - f(x - e[i] + e[j])
+                    + f(x - e[i] - e[j])
+                ) / (4 * step**2)
+                h[j, i] = h[i, j]
+    return h
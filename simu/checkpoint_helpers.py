@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import random
+from pathlib import Path
+
+
+class Checkpoint:
+    """
+    Manifest of the finished sub-simulations (time slices, angle chunks) of
+    an acquisition, rewritten atomically after each one. A restarted job with
+    the same parameters skips the finished ones, and reuses the same base
+    seed so that the seed sequence (and the final outputs) are the same as
+    for an uninterrupted run.
+    """
+
+    def __init__(self, filename, parameters, seed=None, resume=False):
+        self.filename = Path(filename)
+        self.parameters = json.loads(json.dumps(parameters))
+        if resume and self.filename.exists():
+            with open(self.filename) as f:
+                data = json.load(f)
+            if data["parameters"] != self.parameters:
+                raise ValueError(
+                    f"Cannot resume {self.filename}: different parameters "
+                    f"{data['parameters']} != {self.parameters}"
+                )
+            if seed is not None and seed != data["seed"]:
+                raise ValueError(
+                    f"Cannot resume {self.filename}: seed {seed} != {data['seed']}"
+                )
+            self.seed = data["seed"]
+            self.done = data["done"]
+        else:
+            # the base seed is drawn once and kept for the restarts
+            self.seed = seed if seed is not None else random.randrange(2**31)
+            self.done = {}
+            self.write()
+
+    def write(self):
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.filename.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(
+                {"parameters": self.parameters, "seed": self.seed, "done": self.done},
+                f,
+                indent=2,
+            )
+        os.replace(tmp, self.filename)
+
+    def is_done(self, key):
+        return str(key) in self.done
+
+    def get(self, key):
+        return self.done[str(key)]
+
+    def add(self, key, result):
+        self.done[str(key)] = result
+        self.write()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from pathlib import Path
+import click
+from parallel_helpers import run_in_processes, get_seeds
+from acceptance_angle_check import compare_projections
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+def run_test001(digitizer, output_dir, threads, duration, seed):
+    # executed in its own process (Geant4 can only be run once per process)
+    import opengate as gate
+    from test001_no_phantom import set_test001_simulation
+    from redigitizer_helpers import project_intevo_singles
+    from spect_helpers import get_singles_transforms
+
+    sec = gate.g4_units.s
+    simu_name = f"fast_check_{digitizer}"
+    sim = gate.Simulation()
+    set_test001_simulation(sim, simu_name, threads, duration * sec, digitizer)
+    sim.random_seed = seed
+    sim.output_dir = Path(output_dir)
+    sim.progress_bar = False
+    sim.run()
+    projection = Path(output_dir) / f"{simu_name}_projection.mhd"
+    if digitizer == "fast":
+        project_intevo_singles(
+            sorted(Path(output_dir).glob(f"{simu_name}_singles*.root")),
+            projection,
+            len(sim.run_timing_intervals),
+            get_singles_transforms(sim),
+            seed,
+        )
+    return str(projection)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--threads", "-t", default=4, help="Nb of threads per simulation")
+@click.option("--duration", "-d", default=30.0, help="Acquisition time (sec)")
+@click.option("--seed", default=None, type=int, help="Base seed (default: random)")
+@click.option("--max_z", default=3.0, help="Max z-score of the total counts")
+@click.option("--max_chi2", default=1.5, help="Max chi2/ndf of the images")
+@click.option("--output_folder", "-o", default="output/fast_check")
+def go(threads, duration, seed, max_z, max_chi2, output_folder):
+    """
+    Run a short test001 with the full and the fast intevo digitizer and check
+    that the projections (7 energy windows) are statistically compatible
+    """
+    output_folder = Path(output_folder)
+    seeds = get_seeds(seed, 2)
+    tasks = []
+    for i, digitizer in enumerate(["full", "fast"]):
+        tasks.append(
+            {
+                "digitizer": digitizer,
+                "output_dir": str(output_folder / digitizer),
+                "threads": threads,
+                "duration": duration,
+                "seed": seeds[i],
+            }
+        )
+    outputs = [None, None]
+    for i, outcome in run_in_processes(run_test001, tasks, 2):
+        if outcome["status"] != "done":
+            raise RuntimeError(f"Simulation {i} failed: {outcome['error']}")
+        outputs[i] = outcome["result"]
+
+    # compatibility, slice by slice
+    results = compare_projections([outputs[0]], [outputs[1]])
+    ok = True
+    for r in results:
+        valid = abs(r["z"]) <= max_z and r["chi2_ndf"] <= max_chi2
+        ok &= valid
+        print(
+            f"slice {r['slice']}: "
+            f"counts {r['counts_unbiased']:.0f} (full) vs {r['counts_biased']:.0f} "
+            f"(fast) (z = {r['z']:.2f}), chi2/ndf = {r['chi2_ndf']:.2f} "
+            f"{'' if valid else ' <-- NOT COMPATIBLE'}"
+        )
+    print("Fast digitizer check " + ("PASSED" if ok else "FAILED"))
+
+    report = {"passed": bool(ok), "projections": outputs, "slices": results}
+    with open(output_folder / "fast_check.json", "w") as f:
+        json.dump(report, f, indent=2)
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
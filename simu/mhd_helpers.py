@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+import numpy as np
+
+# MetaImage element types <-> numpy
+mhd_element_types = {
+    "MET_CHAR": np.int8,
+    "MET_UCHAR": np.uint8,
+    "MET_SHORT": np.int16,
+    "MET_USHORT": np.uint16,
+    "MET_INT": np.int32,
+    "MET_UINT": np.uint32,
+    "MET_LONG_LONG": np.int64,
+    "MET_ULONG_LONG": np.uint64,
+    "MET_FLOAT": np.float32,
+    "MET_DOUBLE": np.float64,
+}
+
+
+def get_mhd_element_type(dtype):
+    dtype = np.dtype(dtype).newbyteorder("=")
+    for k, v in mhd_element_types.items():
+        if np.dtype(v) == dtype:
+            return k
+    raise ValueError(f"Unsupported dtype for mhd: {dtype}")
+
+
+def read_mhd_header(filename):
+    """
+    Read the header of a mhd file as a dict of strings
+    """
+    header = {}
+    with open(filename) as f:
+        for line in f:
+            if "=" not in line:
+                continue
+            k, v = line.split("=", 1)
+            header[k.strip()] = v.strip()
+    return header
+
+
+def write_mhd(filename, array, spacing, origin=None, direction=None):
+    """
+    Write a numpy array (z, y, x) as a mhd/raw image.
+    Spacing and origin are given in (x, y, z) order as in itk.
+    """
+    filename = Path(filename)
+    array = np.ascontiguousarray(array)
+    if array.ndim == 2:
+        array = array[np.newaxis]
+    raw_filename = filename.with_suffix(".raw")
+    write_mhd_header(
+        filename, array.shape, array.dtype, spacing, origin, direction, raw_filename
+    )
+    array.tofile(raw_filename)
+
+
+def write_mhd_header(
+    filename, shape, dtype, spacing, origin=None, direction=None, raw_filename=None
+):
+    """
+    Write only the mhd header, shape is (z, y, x) and the data are expected in
+    the raw_filename (default: same name with .raw extension).
+    """
+    filename = Path(filename)
+    if raw_filename is None:
+        raw_filename = filename.with_suffix(".raw")
+    dim = len(shape)
+    spacing = list(spacing) + [1.0] * (dim - len(spacing))
+    if origin is None:
+        origin = [0.0] * dim
+    origin = list(origin) + [0.0] * (dim - len(origin))
+    if direction is None:
+        direction = np.eye(dim).flatten()
+    lines = [
+        "ObjectType = Image",
+        f"NDims = {dim}",
+        "BinaryData = True",
+        f"BinaryDataByteOrderMSB = {np.dtype(dtype).byteorder == '>'}",
+        "CompressedData = False",
+        f"TransformMatrix = {' '.join(str(float(d)) for d in direction)}",
+        f"Offset = {' '.join(str(float(o)) for o in origin[:dim])}",
+        f"CenterOfRotation = {' '.join(['0'] * dim)}",
+        "AnatomicalOrientation = RAI",
+        f"ElementSpacing = {' '.join(str(float(s)) for s in spacing[:dim])}",
+        f"DimSize = {' '.join(str(int(s)) for s in reversed(shape))}",
+        f"ElementType = {get_mhd_element_type(dtype)}",
+        f"ElementDataFile = {Path(raw_filename).name}",
+    ]
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def get_mhd_geometry(header):
+    """
+    Return (spacing, origin, direction) from a mhd header, itk (x, y, z) order
+    """
+    spacing = [float(s) for s in header.get("ElementSpacing", "1 1 1").split()]
+    origin = [float(s) for s in header.get("Offset", "0 0 0").split()]
+    ndims = int(header.get("NDims", len(spacing)))
+    direction = header.get("TransformMatrix", None)
+    if direction is None:
+        direction = np.eye(ndims).flatten()
+    else:
+        direction = [float(s) for s in direction.split()]
+    return spacing, origin, direction
+
+
+def memmap_mhd(filename, mode="r"):
+    """
+    Memory-map the raw data behind a mhd header, without reading it.
+    Return (array (z, y, x) in native dtype, header).
+    """
+    filename = Path(filename)
+    header = read_mhd_header(filename)
+    if header.get("CompressedData", "False").lower() == "true":
+        raise ValueError(f"Cannot memory-map compressed mhd data: {filename}")
+    data_file = header["ElementDataFile"]
+    if data_file == "LOCAL":
+        raise ValueError(f"Cannot memory-map LOCAL mhd data: {filename}")
+    dtype = np.dtype(mhd_element_types[header["ElementType"]])
+    msb = header.get("BinaryDataByteOrderMSB", header.get("ElementByteOrderMSB"))
+    if msb is not None and msb.lower() == "true":
+        dtype = dtype.newbyteorder(">")
+    else:
+        dtype = dtype.newbyteorder("<")
+    shape = tuple(int(s) for s in reversed(header["DimSize"].split()))
+    offset = int(header.get("HeaderSize", 0))
+    array = np.memmap(
+        filename.parent / data_file, dtype=dtype, mode=mode, offset=offset, shape=shape
+    )
+    return array, header
+
+
+def check_same_geometry(headers, keys=("DimSize", "ElementSpacing", "Offset")):
+    """
+    Raise a ValueError if the mhd headers do not share the same geometry
+    """
+    for k in keys:
+        values = [np.array(h.get(k, "0").split(), dtype=float) for h in headers]
+        for v in values[1:]:
+            if v.shape != values[0].shape or not np.allclose(v, values[0]):
+                raise ValueError(f"Inconsistent {k} in mhd headers: {values}")
+
+
+def sum_mhd_images(filenames, output_filename):
+    """
+    Sum images (e.g. projections of independent sub-simulations) slice by
+    slice, after checking that they share the same geometry. The sum is
+    accumulated in float64 (exact for counts) and written in the input dtype.
+    """
+    images = []
+    headers = []
+    for f in filenames:
+        img, header = memmap_mhd(f)
+        images.append(img)
+        headers.append(header)
+    check_same_geometry(
+        headers, ("DimSize", "ElementSpacing", "Offset", "TransformMatrix")
+    )
+    if len(set(h["ElementType"] for h in headers)) != 1:
+        raise ValueError(f"Inconsistent ElementType in {filenames}")
+    spacing, origin, direction = get_mhd_geometry(headers[0])
+    output_filename = Path(output_filename)
+    raw_filename = output_filename.with_suffix(".raw")
+    shape = images[0].shape
+    dtype = images[0].dtype
+    write_mhd_header(output_filename, shape, dtype, spacing, origin, direction)
+    out = np.memmap(raw_filename, dtype=dtype, mode="w+", shape=shape)
+    for z in range(shape[0]):
+        s = np.zeros(shape[1:], dtype=np.float64)
+        for img in images:
+            s += img[z]
+        out[z] = s
+    out.flush()
+    return output_filename
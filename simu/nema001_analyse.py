@@ -1,89 +1,124 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import opengate
-import SimpleITK as sitk
-import numpy as np
-from matplotlib import pyplot as plt
+import json
 from pathlib import Path
 import click
+from nema_fwhm_helpers import (
+    analyse_projection_file,
+    summarize_results,
+    write_profiles_csv,
+    write_summary_json,
+)
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
 
 @click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument("projections", nargs=-1)
 @click.option(
-    "--source_orientation", "-s", default="Y", help="Orientation of the source X or Y"
+    "--manifest",
+    "-m",
+    default=None,
+    help="Sweep manifest (json), analyse the projections of all done simulations",
 )
-@click.option("--fwhm_blur", default=6.3, help="FWHM spatial blur in digitizer")
 @click.option(
-    "--distance",
-    "-d",
-    default=10 * opengate.g4_units.cm,
-    help="Distance source-detector",
+    "--slice",
+    "-s",
+    "slices",
+    multiple=True,
+    type=int,
+    help="Slice(s) of the stack to analyse, e.g. 1 for the peak window (default: all)",
 )
-def go(source_orientation, fwhm_blur, distance):
-
-    ref = Path("references")
+@click.option(
+    "--orientation",
+    default="auto",
+    help="Line source along the image Y or X axis, or auto",
+)
+@click.option("--nb_sources", default=1, help="Number of parallel line sources")
+@click.option(
+    "--half_width", default=60, help="Half width of the profiles (pixels)"
+)
+@click.option("--band", default=1, help="Nb of pixels along the line per profile")
+@click.option("--output", "-o", default="nema001_analysis", help="Output prefix")
+@click.option(
+    "--plot",
+    is_flag=True,
+    default=False,
+    help="Also save a png of the FWHM/FWTM along the line (no display needed)",
+)
+def go(
+    projections,
+    manifest,
+    slices,
+    orientation,
+    nb_sources,
+    half_width,
+    band,
+    output,
+    plot,
+):
+    """
+    NEMA line spread analysis: peak position, FWHM and FWTM of all the
+    profiles along the line source(s) of the projections
+    """
+    filenames = list(projections)
+    if manifest is not None:
+        with open(manifest) as f:
+            m = json.load(f)
+        filenames += [
+            e["outputs"]["projection"]
+            for e in m["simulations"]
+            if e["status"] == "done"
+        ]
+    line_axis = {"auto": None, "Y": 0, "X": 1}[orientation]
 
-    # read the reference image
-    ref_img = sitk.ReadImage(ref / f"{source_orientation.lower()}_10cm.mhd")
-    ref_img_array = sitk.GetArrayFromImage(ref_img)
-    print(f"Ref image = {ref_img_array.shape}")
-    s = ref_img.GetSpacing()[1]
-    # 4 slices : 2 x heads and 2 x energy windows
-    # get the first slice = first head and peak
-    ref_img_array = ref_img_array[0]
-    print(f"Ref image = {ref_img_array.shape}")
-    total = ref_img_array.sum()
+    results = []
+    for f in filenames:
+        results += analyse_projection_file(
+            f,
+            slices if slices else None,
+            line_axis=line_axis,
+            nb_sources=nb_sources,
+            half_width=half_width,
+            band=band,
+        )
+    summary = summarize_results(results)
+    for s in summary:
+        if s["nb_profiles"] > 0:
+            print(
+                f"{Path(s['filename']).name} slice {s['slice']} source {s['source']}: "
+                f"FWHM = {s['fwhm_mean']:.2f} +/- {s['fwhm_std']:.2f} mm  "
+                f"FWTM = {s['fwtm_mean']:.2f} +/- {s['fwtm_std']:.2f} mm"
+            )
 
-    # dump img
-    img = sitk.GetImageFromArray(ref_img_array)
-    img.SetSpacing([s, s, 1])
-    img.SetOrigin([0, 0, 0])
-    sitk.WriteImage(img, ref / f"{source_orientation.lower()}_10cm_peak.mhd")
+    write_profiles_csv(f"{output}_profiles.csv", results)
+    write_summary_json(f"{output}_summary.json", summary)
+    print(f"Results written to {output}_profiles.csv and {output}_summary.json")
 
-    # read the simulated image
-    simu_name = f"nema001_{source_orientation}_blur_{fwhm_blur:.2f}_d_{distance:.2f}"
-    f = Path("output") / simu_name
-    img = sitk.ReadImage(f / f"{simu_name}_projection.mhd")
-    img_array = sitk.GetArrayFromImage(img)
-    print(f"Simu image = {img_array.shape}")
-    # get the peak energy window
-    img_array = img_array[1]
-    print(f"Simu image = {img_array.shape}")
-    # scaling
-    scaling = total / img_array.sum()
-    print(f"Scaling factor: {scaling}")
-    img_array = img_array * scaling
+    if plot:
+        plot_results(results, f"{output}.png")
 
-    # dump img
-    img = sitk.GetImageFromArray(img_array)
-    img.SetSpacing([s, s, 1])
-    img.SetOrigin([0, 0, 0])
-    sitk.WriteImage(img, f / f"{simu_name}_projection_peak.mhd")
 
-    # prepare plot
-    fig, ax = plt.subplots(ncols=1, nrows=1, figsize=(15, 5))
+def plot_results(results, filename):
+    import matplotlib
 
-    # get the central pixel profile
-    a = 256 - 60
-    b = 256 + 60
-    x = np.arange(start=a, stop=b) * s
-    w = 2
-    c = 256
-    if source_orientation == "Y":
-        y = np.sum(ref_img_array[c - w : c + w, a:b], axis=0)
-        ax.plot(x, y, label="ref")
-        y = np.sum(img_array[c - w : c + w, a:b], axis=0)
-        ax.plot(x, y, label="simu")
-    if source_orientation == "X":
-        y = np.sum(ref_img_array[a:b, c - w : c + w], axis=1)
-        ax.plot(x, y, label="ref")
-        y = np.sum(img_array[a:b, c - w : c + w], axis=1)
-        ax.plot(x, y, label="simu")
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
 
-    plt.legend()
-    plt.show()
+    fig, ax = plt.subplots(ncols=2, nrows=1, figsize=(15, 5))
+    for r in results:
+        v = r["valid"]
+        label = f"{Path(r['filename']).stem} {r['slice']}"
+        ax[0].plot(r["position"][v], r["fwhm"][v], ".", label=label)
+        ax[1].plot(r["position"][v], r["fwtm"][v], ".", label=label)
+    ax[0].set_ylabel("FWHM (mm)")
+    ax[1].set_ylabel("FWTM (mm)")
+    for a in ax:
+        a.set_xlabel("position along the line (mm)")
+    if len(results) <= 10:
+        ax[0].legend()
+    fig.savefig(filename)
+    print(f"Plot written to {filename}")
 
 
 # --------------------------------------------------------------------------
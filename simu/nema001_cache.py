@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import tempfile
+from pathlib import Path
+import click
+from cache_helpers import *
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def go():
+    """
+    Manage the cache of finished simulations (index in cache_index.json)
+    """
+    pass
+
+
+@go.command(name="list", context_settings=CONTEXT_SETTINGS)
+@click.option("--cache_root", "-r", default="planar_spatial_res")
+def list_results(cache_root):
+    """
+    List the cached results, least recently used first
+    """
+    with locked_cache_index(cache_root) as index:
+        entries = sorted(index.items(), key=lambda e: e[1]["last_used"])
+    total = 0
+    for key, e in entries:
+        last = time.strftime("%Y-%m-%d %H:%M", time.localtime(e["last_used"]))
+        print(
+            f"{key[:12]}  {e['size'] / 1e6:10.1f} MB  {last}  {e['outputs']['output_dir']}"
+        )
+        total += e["size"]
+    print(f"{len(entries)} results, {total / 1e9:.2f} GB")
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--cache_root", "-r", default="planar_spatial_res")
+@click.option("--max_size", "-m", required=True, type=float, help="In GB")
+def evict(cache_root, max_size):
+    """
+    Remove the least recently used results until the size is below max_size
+    """
+    removed = evict_cached_results(cache_root, max_size * 1e9)
+    for f in removed:
+        print(f"Removed {f}")
+    print(f"{len(removed)} results removed")
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+def check():
+    """
+    Round trip of the cache index in a temporary folder: a result that has
+    been added is found (and not dropped), until one of its files is removed
+    """
+    with tempfile.TemporaryDirectory() as cache_root:
+        output_dir = Path(cache_root) / "a"
+        output_dir.mkdir()
+        outputs = {
+            "acquisition_time": 1.0,
+            "simu_name": "check",
+            "output_dir": str(output_dir),
+            "projection": str(output_dir / "check_projection.mhd"),
+            "stats": str(output_dir / "check_stats.txt"),
+            "singles": None,
+            "interactions": str(output_dir / "check"),
+        }
+        for k in ["projection", "stats"]:
+            Path(outputs[k]).touch()
+        add_cached_result(cache_root, "key", outputs)
+        found = find_cached_result(cache_root, "key") == outputs
+        found_again = find_cached_result(cache_root, "key") == outputs
+        Path(outputs["stats"]).unlink()
+        dropped = find_cached_result(cache_root, "key") is None
+    ok = found and found_again and dropped
+    print(f"found {found}, found again {found_again}, dropped {dropped}")
+    print("Cache check " + ("PASSED" if ok else "FAILED"))
+    if not ok:
+        raise SystemExit(1)
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import numpy as np
+import click
+from mhd_helpers import memmap_mhd, get_mhd_geometry
+from redigitizer_helpers import read_singles, get_digitizer_preset, mm
+from calibration_helpers import (
+    LineSpreadModel,
+    get_reference_profiles,
+    fit_digitizer_blur,
+)
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument("singles_file")
+@click.argument("reference")
+@click.option(
+    "--window",
+    "-w",
+    "windows",
+    multiple=True,
+    default=["0:peak140"],
+    help="Reference slice and digitizer channel compared, e.g. 0:peak140 "
+    "(repeatable, add the scatter window to constrain the energy resolution)",
+)
+@click.option(
+    "--preset", "-p", default="Tc99m", help="Digitizer: Tc99m, Lu177 or I131"
+)
+@click.option("--fwhm_blur", default=None, type=float, help="Initial FWHM (mm)")
+@click.option(
+    "--energy_resolution", default=None, type=float, help="Initial resolution"
+)
+@click.option("--half_width", default=40, help="Half width of the fit (pixels)")
+@click.option("--seed", default=0, help="Seed of the energy blur deviates")
+@click.option("--output", "-o", default=None, help="Output json")
+def go(
+    singles_file,
+    reference,
+    windows,
+    preset,
+    fwhm_blur,
+    energy_resolution,
+    half_width,
+    seed,
+    output,
+):
+    """
+    Fit the spatial FWHM and the energy resolution of the digitizer to a
+    reference acquisition, using the singles stored by a simulation of the
+    same acquisition (nema001_spatial_resolution --store_singles, then
+    redigitize.py convert)
+    """
+    t = time.time()
+    p = get_digitizer_preset(preset, spectrum_channel=True)
+    channels = {c["name"]: c for c in p["channels"]}
+
+    # reference profiles (on the same grid as the model)
+    ref, header = memmap_mhd(reference)
+    spacing, _, _ = get_mhd_geometry(header)
+    size = [ref.shape[-1], ref.shape[-2]]
+    if size != p["size"] or not np.allclose(spacing[:2], p["spacing"], rtol=1e-4):
+        raise click.UsageError(
+            f"{reference}: {size} pixels of {spacing[:2]} mm, the {preset} digitizer "
+            f"has {p['size']} pixels of {p['spacing']} mm"
+        )
+    ref_slices = [int(w.split(":")[0]) for w in windows]
+    ref_channels = [channels[w.split(":")[1]] for w in windows]
+    ref_profiles, line_axis = get_reference_profiles(
+        [np.asarray(ref[s], dtype=np.float64) for s in ref_slices]
+    )
+
+    # surrogate model
+    singles = read_singles(singles_file)
+    print(f"{len(singles['energy'])} singles, line source axis {line_axis}")
+    model = LineSpreadModel(
+        singles,
+        p["energy_blur"],
+        ref_channels,
+        p["size"],
+        p["spacing"],
+        line_axis,
+        seed,
+    )
+
+    # fit
+    x0 = [
+        fwhm_blur * mm if fwhm_blur is not None else p["spatial_blur_fwhm"],
+        (
+            energy_resolution
+            if energy_resolution is not None
+            else p["energy_blur"]["resolution"]
+        ),
+    ]
+    bounds = [(0.1 * mm, 30 * mm), (0.01, 0.5)]
+    r = fit_digitizer_blur(model, ref_profiles, x0, bounds, half_width)
+    r.update(
+        {
+            "preset": preset,
+            "energy_blur": {**p["energy_blur"], "resolution": r["energy_resolution"]},
+            "windows": list(windows),
+            "reference": reference,
+            "singles": singles_file,
+        }
+    )
+    print(
+        f"Spatial blur FWHM = {r['spatial_blur_fwhm']:.3f} "
+        f"+/- {r['spatial_blur_fwhm_error']:.3f} mm"
+    )
+    print(
+        f"Energy resolution = {r['energy_resolution']:.4f} "
+        f"+/- {r['energy_resolution_error']:.4f}"
+    )
+    print(f"chi2/ndf = {r['chi2']:.1f}/{r['ndf']}  ({r['nb_evaluations']} evaluations)")
+    print(f"Done in {time.time() - t:.1f} s")
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(r, f, indent=2)
+        print(f"Parameters written to {output}")
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
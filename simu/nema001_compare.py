@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import csv
+import re
+from pathlib import Path
+import numpy as np
+import click
+from parallel_helpers import run_in_processes, get_available_cores
+from mhd_helpers import memmap_mhd, get_mhd_geometry
+from nema_fwhm_helpers import analyse_line_source, summarize_results
+from uncertainty_helpers import get_uncertainty_filenames
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+# name of the nema001 simulations (see nema001_spatial_resolution), with the
+# optional suffix of the sweeps (see nema001_sweep.get_sweep_simu_name)
+simu_name_pattern = re.compile(
+    r"nema001_(?P<orientation>[XY])_blur_(?P<fwhm_blur>[\d.]+)_d_(?P<distance>[\d.]+)"
+    r"(_(?P<collimator>[^_]+)_(?P<radionuclide>[^_]+)"
+    r"(?P<two_sources>_2sources)?(?P<scatter>_scatter)?)?$"
+)
+
+# configuration of the references without suffix
+default_reference_configuration = {
+    "collimator": "lehr",
+    "radionuclide": "Tc99m",
+    "two_sources": False,
+    "scatter": False,
+}
+
+
+def is_sub_simulation(filename):
+    """
+    Partial projection of a split or convergence acquisition (split_xxx
+    folders): its parent folder has the checkpoint or the merged projection
+    """
+    parent = Path(filename).parent.parent
+    return (parent / "checkpoint.json").exists() or (
+        parent / Path(filename).name
+    ).exists()
+
+
+def find_simulations(roots):
+    """
+    All nema001 projections found in the output trees, with the parameters
+    read from the simulation name
+    """
+    simulations = []
+    for root in roots:
+        for f in sorted(Path(root).glob("**/*_projection.mhd")):
+            m = simu_name_pattern.match(f.name[: -len("_projection.mhd")])
+            if m is None or is_sub_simulation(f):
+                continue
+            p = m.groupdict()
+            s = {
+                "filename": str(f),
+                "orientation": p["orientation"],
+                "fwhm_blur": float(p["fwhm_blur"]),
+                "distance": float(p["distance"]),
+                **default_reference_configuration,
+            }
+            if p["collimator"] is not None:
+                s["collimator"] = p["collimator"]
+                s["radionuclide"] = p["radionuclide"]
+                s["two_sources"] = p["two_sources"] is not None
+                s["scatter"] = p["scatter"] is not None
+            simulations.append(s)
+    return simulations
+
+
+def get_reference_filename(references, s):
+    """
+    e.g. references/x_10cm.mhd for the X source at 100 mm (lehr, Tc99m),
+    references/x_10cm_megp_Lu177_scatter.mhd for another configuration
+    """
+    name = f"{s['orientation'].lower()}_{s['distance'] / 10:g}cm"
+    if any(s[k] != v for k, v in default_reference_configuration.items()):
+        name += f"_{s['collimator']}_{s['radionuclide']}"
+        name += "_2sources" if s["two_sources"] else ""
+        name += "_scatter" if s["scatter"] else ""
+    return Path(references) / f"{name}.mhd"
+
+
+def pair_simulations(simulations, references):
+    """
+    Group the simulations by reference: {reference filename: [simulations]}.
+    Simulations without reference are ignored.
+    """
+    pairs = {}
+    for s in simulations:
+        ref = get_reference_filename(references, s)
+        if ref.exists():
+            pairs.setdefault(str(ref), []).append(s)
+    return pairs
+
+
+def load_reference(filename, ref_slice):
+    img, header = memmap_mhd(filename)
+    spacing, _, _ = get_mhd_geometry(header)
+    img = np.array(img[ref_slice], dtype=np.float64)
+    analysis = analyse_line_source(img, spacing)
+    return img, spacing, analysis
+
+
+def compare_images(ref, img, spacing, ref_analysis, img_variance=None):
+    """
+    Compare a simulated projection to the reference (both 2D arrays). The
+    simulation is scaled to the total counts of the reference. The variance
+    of the simulation is its batch variance map when given, Poisson otherwise.
+    """
+    if img.sum() <= 0:
+        raise ValueError("empty simulated projection")
+    scaling = ref.sum() / img.sum()
+    img = img * scaling
+    # variance of the difference (reference + scaled simulation)
+    if img_variance is None:
+        var = ref + scaling * img
+    else:
+        var = ref + scaling**2 * img_variance
+    m = var > 0
+    chi2 = np.sum((img[m] - ref[m]) ** 2 / var[m]) / m.sum()
+    nrmse = np.sqrt(np.mean((img - ref) ** 2)) / ref.max()
+
+    # line spread profiles, normalized to unit area
+    axis = ref_analysis["line_axis"]
+    ref_profile = ref.sum(axis=axis)
+    img_profile = img.sum(axis=axis)
+    residuals = (img_profile - ref_profile) / ref_profile.sum()
+
+    # resolution
+    img_analysis = analyse_line_source(img, spacing, line_axis=axis)
+    ref_summary = summarize_results([{**ref_analysis, "filename": "", "slice": 0}])[0]
+    img_summary = summarize_results([{**img_analysis, "filename": "", "slice": 0}])[0]
+    delta = {}
+    for k in ("peak_mean", "fwhm_mean", "fwtm_mean"):
+        if ref_summary[k] is None or img_summary[k] is None:
+            delta[k] = np.nan
+        else:
+            delta[k] = img_summary[k] - ref_summary[k]
+
+    return {
+        "scaling": scaling,
+        "chi2": chi2,
+        "nrmse": nrmse,
+        "profile_residual_rms": np.sqrt(np.mean(residuals**2)),
+        "profile_residual_max": np.abs(residuals).max(),
+        "ref_fwhm": ref_summary["fwhm_mean"],
+        "fwhm": img_summary["fwhm_mean"],
+        "delta_fwhm": delta["fwhm_mean"],
+        "ref_fwtm": ref_summary["fwtm_mean"],
+        "fwtm": img_summary["fwtm_mean"],
+        "delta_fwtm": delta["fwtm_mean"],
+        "delta_peak": delta["peak_mean"],
+    }
+
+
+def compare_to_reference(reference, simulations, ref_slice, sim_slice):
+    # executed in a worker process, the reference is loaded once for the task
+    ref, spacing, ref_analysis = load_reference(reference, ref_slice)
+    rows = []
+    for s in simulations:
+        img, _ = memmap_mhd(s["filename"])
+        img = np.array(img[sim_slice], dtype=np.float64)
+        row = {**s, "reference": reference}
+        if img.shape != ref.shape:
+            row["error"] = f"shape {img.shape} != reference {ref.shape}"
+        elif img.sum() <= 0:
+            row["error"] = "empty simulated projection"
+        else:
+            variance = get_uncertainty_filenames(s["filename"])[0]
+            if variance.exists():
+                variance, _ = memmap_mhd(variance)
+                variance = np.array(variance[sim_slice], dtype=np.float64)
+            else:
+                variance = None
+            row["batch_variance"] = variance is not None
+            row.update(compare_images(ref, img, spacing, ref_analysis, variance))
+        rows.append(row)
+    return rows
+
+
+def write_results_table(filename, rows):
+    keys = []
+    for r in rows:
+        keys += [k for k in r if k not in keys]
+    with open(filename, "w", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=keys)
+        w.writeheader()
+        for r in rows:
+            w.writerow(
+                {k: f"{v:.6g}" if isinstance(v, float) else v for k, v in r.items()}
+            )
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "--roots",
+    "-r",
+    multiple=True,
+    default=["output", "planar_spatial_res"],
+    help="Output trees to search for nema001 projections",
+)
+@click.option("--references", default="references", help="References folder")
+@click.option("--ref_slice", default=0, help="Reference slice (head 1, peak)")
+@click.option("--sim_slice", default=1, help="Simulation slice (peak window)")
+@click.option("--processes", "-j", default=None, type=int, help="Nb of processes")
+@click.option("--output", "-o", default="nema001_comparison.csv", help="Results table")
+def go(roots, references, ref_slice, sim_slice, processes, output):
+    """
+    Compare all nema001 simulations of the output trees with their reference
+    """
+    simulations = find_simulations(roots)
+    pairs = pair_simulations(simulations, references)
+    n = sum(len(s) for s in pairs.values())
+    print(f"{len(simulations)} simulations found, {n} with a reference")
+    if processes is None:
+        processes = get_available_cores()
+
+    # one task per group of simulations with the same reference
+    chunk_size = max(1, -(-n // processes))
+    tasks = []
+    for ref, sims in pairs.items():
+        for i in range(0, len(sims), chunk_size):
+            tasks.append(
+                {
+                    "reference": ref,
+                    "simulations": sims[i : i + chunk_size],
+                    "ref_slice": ref_slice,
+                    "sim_slice": sim_slice,
+                }
+            )
+    rows = []
+    for i, outcome in run_in_processes(compare_to_reference, tasks, processes):
+        if outcome["status"] != "done":
+            print(f"Comparison with {tasks[i]['reference']} failed: {outcome['error']}")
+            continue
+        rows += outcome["result"]
+    rows.sort(key=lambda r: r["filename"])
+    for r in rows:
+        if "error" in r:
+            print(f"{r['filename']}: {r['error']}")
+        else:
+            print(
+                f"{Path(r['filename']).name}: chi2 = {r['chi2']:.3f}  "
+                f"dFWHM = {r['delta_fwhm']:.2f} mm  dFWTM = {r['delta_fwtm']:.2f} mm"
+            )
+    write_results_table(output, rows)
+    print(f"Results written to {output}")
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
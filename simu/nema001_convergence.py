@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from pathlib import Path
+import numpy as np
+import click
+from parallel_helpers import split_cores, get_seeds, get_available_cores
+from mhd_helpers import memmap_mhd, get_mhd_geometry
+from stats_helpers import read_stats_file, write_stats_file
+from nema_fwhm_helpers import analyse_line_source
+from nema001_split import run_split_simulations, merge_split_outputs
+from checkpoint_helpers import Checkpoint
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+def get_counts_uncertainty(img):
+    """
+    Relative (Poisson) uncertainty of the total counts of the projection
+    """
+    n = float(np.sum(img, dtype=np.float64))
+    return 1 / np.sqrt(n) if n > 0 else np.inf, n
+
+
+def get_fwhm_uncertainty(img, spacing):
+    """
+    Relative uncertainty of the mean FWHM of the line source: standard error
+    of the FWHM of the (statistically independent) profiles along the line
+    """
+    r = analyse_line_source(img, spacing)
+    fwhm = r["fwhm"][r["valid"]]
+    if len(fwhm) < 2:
+        return np.inf, np.nan
+    mean = np.mean(fwhm)
+    return np.std(fwhm, ddof=1) / np.sqrt(len(fwhm)) / mean, mean
+
+
+convergence_targets = {
+    "counts": lambda img, spacing: get_counts_uncertainty(img),
+    "fwhm": get_fwhm_uncertainty,
+}
+
+
+def check_convergence(projection, target, window):
+    """
+    Relative uncertainty of the target (counts or fwhm) in the given slice
+    (energy window) of the merged projection, and the target value
+    """
+    img, header = memmap_mhd(projection)
+    spacing, _, _ = get_mhd_geometry(header)
+    rel, value = convergence_targets[target](
+        np.asarray(img[window], dtype=np.float64), spacing
+    )
+    return float(rel), float(value)
+
+
+def add_normalization_stats(stats_filename, outputs):
+    """
+    Record the simulated acquisition time (sum of the chunks) and the total
+    activity in the merged stats file
+    """
+    stats = read_stats_file(stats_filename)
+    stats["AcquisitionTime"] = sum(o["acquisition_time"] for o in outputs)
+    stats["Activity"] = outputs[0]["activity"]
+    write_stats_file(stats_filename, stats)
+    return stats
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--source_orientation", "-s", default="X", help="X or Y")
+@click.option("--fwhm_blur", default=4.6, help="FWHM spatial blur in digitizer")
+@click.option("--distance", "-d", default=0.0, help="Distance source-detector in mm")
+@click.option("--source_config", "-c", default="1_source", help="1_source or 2_sources")
+@click.option("--scatter", "-sc", default=False, help="Set PMMA plates")
+@click.option("--collimator", "-col", default="lehr", help="lehr, megp, hegp or plexi")
+@click.option("--radionuclide", "-rad", default="Tc99m", help="Tc99m, Lu177, ...")
+@click.option("--target", default="counts", help="counts or fwhm")
+@click.option("--precision", "-p", default=0.01, help="Relative uncertainty to reach")
+@click.option("--window", "-w", default=1, help="Slice of the projection (1: peak)")
+@click.option(
+    "--nb_chunks",
+    "-n",
+    default=100,
+    help="The full acquisition (5 min) is split in nb_chunks",
+)
+@click.option("--min_chunks", default=2, help="Min nb of chunks before stopping")
+@click.option("--cores", default=None, type=int, help="Nb of cores (default: all)")
+@click.option("--seed", default=None, type=int, help="Base seed (default: random)")
+@click.option(
+    "--uncertainty",
+    "-u",
+    is_flag=True,
+    default=False,
+    help="Also write the per-pixel variance/uncertainty maps (chunks as batches)",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Restart from the chunks done by a previous (interrupted) job",
+)
+def go(
+    source_orientation,
+    fwhm_blur,
+    distance,
+    source_config,
+    scatter,
+    collimator,
+    radionuclide,
+    target,
+    precision,
+    window,
+    nb_chunks,
+    min_chunks,
+    cores,
+    seed,
+    uncertainty,
+    resume,
+):
+    """
+    Run the acquisition by chunks of time and stop as soon as the relative
+    uncertainty of the target is below the precision (at most the full
+    acquisition time). The chunks of one batch run in parallel.
+    """
+    parameters = {
+        "source_orientation": source_orientation,
+        "fwhm_blur": fwhm_blur,
+        "distance": distance,
+        "source_config": source_config,
+        "scatter": scatter,
+        "collimator": collimator,
+        "radionuclide": radionuclide,
+    }
+    simu_name = f"nema001_{source_orientation}_blur_{fwhm_blur:.2f}_d_{distance:.2f}"
+    output_dir = Path("planar_spatial_res") / f"{simu_name}_convergence"
+
+    # layout: one batch = one chunk per process
+    if cores is None:
+        cores = get_available_cores()
+    nb_processes, nb_threads = split_cores(nb_chunks, cores)
+    checkpoint = Checkpoint(
+        output_dir / "checkpoint.json",
+        # (the nb of threads changes the seeds of the threads, the nb of
+        # processes only the size of the batches)
+        {**parameters, "nb_chunks": nb_chunks, "nb_threads": nb_threads},
+        seed,
+        resume,
+    )
+    seeds = get_seeds(checkpoint.seed, nb_chunks)
+    print(
+        f"Target: {target} at {precision:.2%}, batches of {nb_processes} chunks "
+        f"(1/{nb_chunks} of the acquisition time each)"
+    )
+
+    # go
+    outputs = []
+    history = []
+
+    def merge_and_check():
+        merged = merge_split_outputs(
+            outputs, simu_name, output_dir, uncertainty and len(outputs) > 1
+        )
+        rel, value = check_convergence(merged["projection"], target, window)
+        acquisition_time = sum(o["acquisition_time"] for o in outputs)
+        history.append(
+            {
+                "nb_chunks": len(outputs),
+                "acquisition_time": acquisition_time,
+                "value": value,
+                "relative_uncertainty": rel,
+            }
+        )
+        print(
+            f"{len(outputs)}/{nb_chunks} chunks ({acquisition_time:.1f} s): "
+            f"{target} = {value:.4g}, relative uncertainty = {rel:.2%}"
+        )
+        return merged, rel <= precision and len(outputs) >= min_chunks
+
+    # (as in run_split_simulations, a chunk without its projection is run again)
+    while (
+        len(outputs) < nb_chunks
+        and checkpoint.is_done(len(outputs))
+        and Path(checkpoint.get(len(outputs))["projection"]).exists()
+    ):
+        outputs.append(checkpoint.get(len(outputs)))
+    converged = False
+    if outputs:
+        # (the previous job may have converged, or done all the chunks)
+        print(f"Resume after {len(outputs)} chunks")
+        merged, converged = merge_and_check()
+    while len(outputs) < nb_chunks and not converged:
+        indices = range(len(outputs), min(len(outputs) + nb_processes, nb_chunks))
+        slices = [(i, nb_chunks) for i in indices]
+        outputs += run_split_simulations(
+            parameters,
+            simu_name,
+            slices,
+            [seeds[i] for i in indices],
+            output_dir,
+            nb_processes,
+            nb_threads,
+            checkpoint,
+        )
+        merged, converged = merge_and_check()
+
+    # normalization and report
+    stats = add_normalization_stats(merged["stats"], outputs)
+    report = {
+        "parameters": parameters,
+        "target": target,
+        "precision": precision,
+        "window": window,
+        "converged": bool(converged),
+        "acquisition_time": stats["AcquisitionTime"],
+        "activity": stats["Activity"],
+        "projection": merged["projection"],
+        "stats": merged["stats"],
+        "history": history,
+    }
+    with open(output_dir / f"{simu_name}_convergence.json", "w") as f:
+        json.dump(report, f, indent=2)
+    status = "reached" if converged else "NOT reached"
+    print(
+        f"Target {status} after {stats['AcquisitionTime']:.1f} s of acquisition "
+        f"({stats['Activity']:.3g} Bq)"
+    )
+    print(f"Merged projection: {merged['projection']}")
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
@@ -7,22 +7,105 @@ from spect_helpers import *
 from pathlib import Path
 
 
-def set_nema001_simulation(sim, simu_name, scatter, collimator, rad):
+def add_nema001_digitizer(
+    sim, crystal, simu_name, rad, store_singles=False, tags=False
+):
+    """
+    Digitizer for the given radionuclide, return the spatial blur module.
+    (optionally keep the singles for offline re-digitization, with tags)
+    """
+    singles_filename = f"{simu_name}_singles.root" if store_singles else None
+    if rad == "Lu177":
+        digit = add_digitizer_lu177_wip(
+            sim, crystal.name, "digitizer", False, singles_filename, tags
+        )
+    elif rad == "Tc99m":
+        digit = add_digitizer_tc99m_wip(
+            sim, crystal.name, "digitizer", False, singles_filename, tags
+        )
+    else:
+        digit = add_digitizer_tc99m_wip(
+            sim, crystal.name, "digitizer", False, singles_filename, tags
+        )  # to be set for other radionuclide
+
+    proj = digit.find_module("projection")
+    proj.output_filename = f"{simu_name}_projection.mhd"
+    print(f"Projection size: {proj.size}")
+    print(f"Projection spacing: {proj.spacing} mm")
+    print(f"Projection output: {proj.get_output_path()}")
+    return digit.find_module("digitizer_sp_blur")
+
+
+def set_nema001_options(sim, simu_name, number_of_threads):
+    """
+    Threads, output folder and world of all the nema001 simulations
+    """
+    m = gate.g4_units.m
+    sim.number_of_threads = number_of_threads
+    sim.progress_bar = True
+    sim.output_dir = Path("planar_spatial_res") / simu_name
+    world = sim.world
+    world.size = [2 * m, 2 * m, 2 * m]
+    world.material = "G4_AIR"
+
+
+def add_nema001_phantom(sim, scatter):
+    """
+    Line source phantom and (fake) table, with the PMMA plates when scatter is
+    True. Return the glass tube and the top plates (None without scatter).
+    """
+    cm = gate.g4_units.cm
+    table = add_fake_table(sim, "table")
+    table.translation = [0, 20.65 * cm, 0]
+    glass_tube = add_phantom_spatial_resolution(sim, "phantom", scatter)
+    top_plates = None
+    if scatter is True:
+        top_plates, bottom_plates = add_PMMA_plates(sim, "PMMA_plates")
+        top_plates.translation = [0, 5.075 * cm, 0]
+        bottom_plates.translation = [0,  -2.575* cm, 0]
+        table.translation = [0, 31.2 * cm, 0]
+    return glass_tube, top_plates
+
+
+def set_nema001_physics(sim, crystal=None):
+    mm = gate.g4_units.mm
+    sim.physics_manager.physics_list_name = "G4EmStandardPhysics_option3"
+    sim.physics_manager.set_production_cut("world", "all", 10 * mm)
+    sim.physics_manager.set_production_cut("phantom", "all", 2 * mm)
+    if crystal is not None:
+        sim.physics_manager.set_production_cut(crystal.name, "all", 2 * mm)
+
+
+def add_nema001_stats(sim, simu_name):
+    stats = sim.add_actor("SimulationStatisticsActor", "stats")
+    stats.track_types_flag = True
+    stats.output_filename = f"{simu_name}_stats.txt"
+    return stats
+
+
+def set_nema001_simulation(
+    sim,
+    simu_name,
+    scatter,
+    collimator,
+    rad,
+    number_of_threads=30,
+    store_singles=False,
+    acceptance_angle=False,
+    skip_policy="SkipEvents",
+    tags=False,
+    lines=None,
+):
 
     # main options
     # sim.visu = True
     sim.visu_type = "vrml_file_only"
     sim.visu_filename = "spatial_resolution.wrl"
-    sim.number_of_threads = 30
-    sim.progress_bar = True
-    sim.output_dir = Path("planar_spatial_res") / simu_name
+    set_nema001_options(sim, simu_name, number_of_threads)
 
     # units
     sec = gate.g4_units.s
     min = gate.g4_units.min
-    mm = gate.g4_units.mm
-    cm = gate.g4_units.cm
-    m = gate.g4_units.m
     Bq = gate.g4_units.Bq
 
     # acquisition param
@@ -33,11 +116,6 @@ def set_nema001_simulation(sim, simu_name, scatter, collimator, rad):
         activity = 100 * Bq
         sim.number_of_threads = 1
 
-    # world
-    world = sim.world
-    world.size = [2 * m, 2 * m, 2 * m]
-    world.material = "G4_AIR"
-
     # spect head
     head, colli, crystal = nm670.add_spect_head(
         sim,
@@ -50,68 +128,61 @@ def set_nema001_simulation(sim, simu_name, scatter, collimator, rad):
     #nm670.rotate_gantry(head, radius=0 * cm, start_angle_deg=0)
 
     # phantom + (fake) table
-    table = add_fake_table(sim, "table")
-    table.translation = [0, 20.65 * cm, 0]
-    glass_tube = add_phantom_spatial_resolution(sim, "phantom", scatter)
-    if scatter is True:
-        top_plates, bottom_plates = add_PMMA_plates(sim, "PMMA_plates")
-        top_plates.translation = [0, 5.075 * cm, 0]
-        bottom_plates.translation = [0,  -2.575* cm, 0]
-        table.translation = [0, 31.2 * cm, 0]
+    glass_tube, _ = add_nema001_phantom(sim, scatter)
 
     # source with AA to speedup
     # setup for 1 source
+    aa_volumes = [head.name] if acceptance_angle else None
     container = sim.volume_manager.get_volume(f"phantom_source_container")
-    src = add_source_spatial_resolution(sim, "source", container, rad) # , [head.name]
+    src = add_source_spatial_resolution(
+        sim, "source", container, rad, aa_volumes, skip_policy, lines
+    )
     src.activity = activity
 
     # physics
-    sim.physics_manager.physics_list_name = "G4EmStandardPhysics_option3"
-    sim.physics_manager.set_production_cut("world", "all", 10 * mm)
-    sim.physics_manager.set_production_cut("phantom", "all", 2 * mm)
-    sim.physics_manager.set_production_cut(crystal.name, "all", 2 * mm)
+    set_nema001_physics(sim, crystal)
 
     # digitizer : probably not correct
-    if rad == "Lu177":
-        digit = add_digitizer_lu177_wip(sim, crystal.name, "digitizer", False)
-    elif rad == "Tc99m":
-        digit = add_digitizer_tc99m_wip(sim, crystal.name, "digitizer", False)
-    else:
-        digit = add_digitizer_tc99m_wip(sim, crystal.name, "digitizer", False) # to be set for other radionuclide
-    
-    proj = digit.find_module("projection")
-    proj.output_filename = f"{simu_name}_projection.mhd"
-    print(f"Projection size: {proj.size}")
-    print(f"Projection spacing: {proj.spacing} mm")
-    print(f"Projection output: {proj.get_output_path()}")
-    digit_blur = digit.find_module("digitizer_sp_blur")
+    # (tags and line library are computed offline from the singles)
+    store_singles = store_singles or tags or lines is not None
+    digit_blur = add_nema001_digitizer(
+        sim, crystal, simu_name, rad, store_singles, tags
+    )
+    if tags:
+        add_interaction_tagging(sim, [head], [colli], [crystal], simu_name)
 
     # add stat actor
-    stats = sim.add_actor("SimulationStatisticsActor", "stats")
-    stats.track_types_flag = True
-    stats.output_filename = f"{simu_name}_stats.txt"
+    add_nema001_stats(sim, simu_name)
 
     # timing
     sim.run_timing_intervals = [[0, time]]
 
     return head, glass_tube, digit_blur
 
-def set_nema001_simulation_2sources(sim, simu_name, scatter, collimator, rad):
+def set_nema001_simulation_2sources(
+    sim,
+    simu_name,
+    scatter,
+    collimator,
+    rad,
+    number_of_threads=30,
+    store_singles=False,
+    acceptance_angle=False,
+    skip_policy="SkipEvents",
+    tags=False,
+    lines=None,
+):
 
     # main options
     # sim.visu = True
     sim.visu_type = "vrml_file_only"
     sim.visu_filename = "spatial_resolution.wrl"
-    sim.number_of_threads = 30
-    sim.progress_bar = True
-    sim.output_dir = Path("planar_spatial_res") / simu_name
+    set_nema001_options(sim, simu_name, number_of_threads)
 
     # units
     sec = gate.g4_units.s
     min = gate.g4_units.min
-    mm = gate.g4_units.mm
     cm = gate.g4_units.cm
-    m = gate.g4_units.m
     Bq = gate.g4_units.Bq
 
     # acquisition param
@@ -122,11 +193,6 @@ def set_nema001_simulation_2sources(sim, simu_name, scatter, collimator, rad):
         activity = 100 * Bq
         sim.number_of_threads = 1
 
-    # world
-    world = sim.world
-    world.size = [2 * m, 2 * m, 2 * m]
-    world.material = "G4_AIR"
-
     # spect head
     head, colli, crystal = nm670.add_spect_head(
         sim,
@@ -151,37 +217,165 @@ def set_nema001_simulation_2sources(sim, simu_name, scatter, collimator, rad):
     #setup for 2 sources
     container = sim.volume_manager.get_volume(f"phantom_source_container")
     container2 = sim.volume_manager.get_volume(f"phantom_source2_container")
-    src, src2 = add_2sources_spatial_resolution(sim, "source", "source2", container, container2, rad) #, [head.name] # to add for acceptance angle
+    aa_volumes = [head.name] if acceptance_angle else None
+    src, src2 = add_2sources_spatial_resolution(
+        sim,
+        "source",
+        "source2",
+        container,
+        container2,
+        rad,
+        aa_volumes,
+        skip_policy,
+        lines,
+    )
     src.activity = activity
     src2.activity = activity
 
+    # physics
+    set_nema001_physics(sim, crystal)
+
+    # digitizer : probably not correct
+    # (tags and line library are computed offline from the singles)
+    store_singles = store_singles or tags or lines is not None
+    digit_blur = add_nema001_digitizer(
+        sim, crystal, simu_name, rad, store_singles, tags
+    )
+    if tags:
+        add_interaction_tagging(sim, [head], [colli], [crystal], simu_name)
+
+    # add stat actor
+    add_nema001_stats(sim, simu_name)
+
+    # timing
+    sim.run_timing_intervals = [[0, time]]
+
+    return head, glass_tube, glass_tube2, digit_blur
+
+def set_nema001_phsp_record_simulation(
+    sim, simu_name, scatter, rad, plane_distance, number_of_threads=30
+):
+    """
+    Stage 1 of the phase-space mode: same source, phantom, plates and table as
+    set_nema001_simulation, but without detector. The photons entering a thin
+    plane placed like the collimator face at plane_distance are stored.
+    The plane must not overlap the phantom or the PMMA plates.
+    """
+
+    # main options
+    set_nema001_options(sim, simu_name, number_of_threads)
+
+    # units
+    min = gate.g4_units.min
+    mm = gate.g4_units.mm
+    cm = gate.g4_units.cm
+    Bq = gate.g4_units.Bq
+
+    # acquisition param
+    time = 5 * min
+    activity = 3e7 * Bq / sim.number_of_threads
+
+    # phantom + (fake) table
+    glass_tube, top_plates = add_nema001_phantom(sim, scatter)
+
+    # the plane (1 mm thick, towards the head along y) must be in front of
+    # the glass tube and of the top PMMA plates
+    front = glass_tube.rmax
+    if top_plates is not None:
+        # (the thickness of the plates is along y after their rotation)
+        front = top_plates.translation[1] + top_plates.size[2] / 2
+    if plane_distance - 1 * mm <= front:
+        raise ValueError(
+            f"The phase-space plane (d={plane_distance / mm} mm) overlaps the "
+            f"phantom or the PMMA plates (up to {front / mm} mm), use a larger "
+            f"plane distance"
+        )
+
+    # source
+    container = sim.volume_manager.get_volume(f"phantom_source_container")
+    src = add_source_spatial_resolution(sim, "source", container, rad)
+    src.activity = activity
+
+    # phase-space plane, placed (and oriented) like the spect head: thin
+    # along y, as the PMMA plates
+    plane = sim.add_volume("Box", "phsp_plane")
+    plane.size = [60 * cm, 60 * cm, 1 * mm]
+    plane.material = "G4_AIR"
+    plane.color = [0, 1, 0, 1]
+    plane.rotation = Rotation.from_euler("x", 90, degrees=True).as_matrix()
+    nm670.rotate_gantry(plane, radius=plane_distance - 0.5 * mm, start_angle_deg=0)
+
+    phsp = sim.add_actor("PhaseSpaceActor", "phsp")
+    phsp.attached_to = plane.name
+    phsp.attributes = ["KineticEnergy", "PrePosition", "PreDirection", "Weight"]
+    phsp.steps_to_store = "entering"
+    phsp.output_filename = f"{simu_name}_phsp.root"
+    f = sim.add_filter("ParticleFilter", "gamma_filter")
+    f.particle = "gamma"
+    phsp.filters.append(f)
+
+    # physics
+    set_nema001_physics(sim)
+
+    # add stat actor
+    add_nema001_stats(sim, simu_name)
+
+    # timing
+    sim.run_timing_intervals = [[0, time]]
+
+    return glass_tube, phsp
+
+
+def set_nema001_phsp_replay_simulation(
+    sim, simu_name, collimator, rad, phsp_filename, nb_entries, number_of_threads=30
+):
+    """
+    Stage 2 of the phase-space mode: only the spect head, the source is the
+    stored phase-space (each entry used once, split between the threads).
+    """
+
+    # main options
+    set_nema001_options(sim, simu_name, number_of_threads)
+
+    # units
+    min = gate.g4_units.min
+    mm = gate.g4_units.mm
+
+    # spect head
+    head, colli, crystal = nm670.add_spect_head(
+        sim,
+        "spect",
+        collimator_type=collimator,
+        rotation_deg=15,
+        crystal_size="5/8",
+        debug=sim.visu,
+    )
+
+    # phase-space source
+    n = nb_entries // sim.number_of_threads
+    source = sim.add_source("PhaseSpaceSource", "phsp_source")
+    source.phsp_file = phsp_filename
+    source.position_key = "PrePosition"
+    source.direction_key = "PreDirection"
+    source.energy_key = "KineticEnergy"
+    source.weight_key = "Weight"
+    source.particle = "gamma"
+    source.global_flag = True
+    source.n = n
+    source.entry_start = [i * n for i in range(sim.number_of_threads)]
+
     # physics
     sim.physics_manager.physics_list_name = "G4EmStandardPhysics_option3"
     sim.physics_manager.set_production_cut("world", "all", 10 * mm)
-    sim.physics_manager.set_production_cut("phantom", "all", 2 * mm)
     sim.physics_manager.set_production_cut(crystal.name, "all", 2 * mm)
 
     # digitizer : probably not correct
-    if rad == "Lu177":
-        digit = add_digitizer_lu177_wip(sim, crystal.name, "digitizer", False)
-    elif rad == "Tc99m":
-        digit = add_digitizer_tc99m_wip(sim, crystal.name, "digitizer", False)
-    else:
-        digit = add_digitizer_tc99m_wip(sim, crystal.name, "digitizer", False) # to be set for other radionuclide
-        
-    proj = digit.find_module("projection")
-    proj.output_filename = f"{simu_name}_projection.mhd"
-    print(f"Projection size: {proj.size}")
-    print(f"Projection spacing: {proj.spacing} mm")
-    print(f"Projection output: {proj.get_output_path()}")
-    digit_blur = digit.find_module("digitizer_sp_blur")
+    digit_blur = add_nema001_digitizer(sim, crystal, simu_name, rad)
 
     # add stat actor
-    stats = sim.add_actor("SimulationStatisticsActor", "stats")
-    stats.track_types_flag = True
-    stats.output_filename = f"{simu_name}_stats.txt"
+    add_nema001_stats(sim, simu_name)
 
-    # timing
-    sim.run_timing_intervals = [[0, time]]
+    # timing (same as the recorded acquisition)
+    sim.run_timing_intervals = [[0, 5 * min]]
 
-    return head, glass_tube, glass_tube2, digit_blur
\ No newline at end of file
+    return head, digit_blur
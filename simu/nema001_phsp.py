@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+import opengate as gate
+import opengate.contrib.spect.ge_discovery_nm670 as nm670
+from scipy.spatial.transform import Rotation
+from nema001_helpers import (
+    set_nema001_phsp_record_simulation,
+    set_nema001_phsp_replay_simulation,
+)
+import click
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def go():
+    """
+    Two-stage nema001 simulation: the photons leaving the phantom are recorded
+    once in a phase-space file (record), then replayed in front of the spect
+    head for each collimator/distance (replay).
+    """
+    pass
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--source_orientation", "-s", default="X", help="X or Y")
+@click.option("--scatter", "-sc", default=False, help="Set PMMA plates")
+@click.option("--radionuclide", "-rad", default="Tc99m", help="Tc99m, Lu177, ...")
+@click.option(
+    "--plane_distance",
+    "-p",
+    default=100.0,
+    help="Distance (mm) between the source and the phase-space plane, must be "
+    "smaller than all the distances of the replay (and outside the phantom)",
+)
+@click.option("--threads", "-t", default=30, help="Nb of threads")
+def record(source_orientation, scatter, radionuclide, plane_distance, threads):
+    """
+    Record the photons entering the phase-space plane
+    """
+    simu_name = f"nema001_{source_orientation}_{radionuclide}_phsp"
+    if scatter:
+        simu_name += "_scatter"
+    sim = gate.Simulation()
+    glass_tube, phsp = set_nema001_phsp_record_simulation(
+        sim, simu_name, scatter, radionuclide, plane_distance, threads
+    )
+    if source_orientation == "X":
+        glass_tube.rotation = Rotation.from_euler("Y", 90, degrees=True).as_matrix()
+    sim.run()
+    print(sim.actor_manager.get_actor("stats"))
+    print(f"Phase space written to {phsp.get_output_path()}")
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--phsp", required=True, help="Phase-space file (root) of the record")
+@click.option(
+    "--plane_distance", "-p", default=100.0, help="Same value as for the record"
+)
+@click.option("--distance", "-d", default=100.0, help="Distance source-detector in mm")
+@click.option("--fwhm_blur", default=4.6, help="FWHM spatial blur in digitizer")
+@click.option("--collimator", "-col", default="lehr", help="lehr, megp, hegp")
+@click.option("--radionuclide", "-rad", default="Tc99m", help="Tc99m or Lu177")
+@click.option("--threads", "-t", default=30, help="Nb of threads")
+def replay(phsp, plane_distance, distance, fwhm_blur, collimator, radionuclide, threads):
+    """
+    Replay a recorded phase space in front of the spect head
+    """
+    import uproot
+
+    if distance < plane_distance:
+        raise ValueError(
+            f"The detector (d={distance} mm) must be behind the phase-space plane "
+            f"(d={plane_distance} mm)"
+        )
+    with uproot.open(phsp) as f:
+        nb_entries = f[f.keys()[0]].num_entries
+    print(f"Phase space {phsp}: {nb_entries} photons")
+
+    simu_name = (
+        f"{Path(phsp).stem}_{collimator}_blur_{fwhm_blur:.2f}_d_{distance:.2f}"
+    )
+    sim = gate.Simulation()
+    head, digit_blur = set_nema001_phsp_replay_simulation(
+        sim,
+        simu_name,
+        collimator,
+        radionuclide,
+        str(Path(phsp).resolve()),
+        nb_entries,
+        threads,
+    )
+    digit_blur.blur_fwhm = fwhm_blur
+
+    # camera distance, as in nema001_spatial_resolution
+    pos, crystal_distance, psd = nm670.compute_plane_position_and_distance_to_crystal(
+        collimator
+    )
+    nm670.rotate_gantry(head, radius=distance + pos, start_angle_deg=0)
+
+    sim.run()
+    print(sim.actor_manager.get_actor("stats"))
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
@@ -8,6 +8,17 @@ from opengate.contrib.spect.siemens_intevo import (
     compute_plane_position_and_distance_to_crystal,
 )
 from spect_helpers import *
+from cache_helpers import get_simulation_key, find_cached_result, add_cached_result
+from spectral_helpers import get_library_lines, write_line_library
+from profile_helpers import (
+    PhaseTimer,
+    run_profiled,
+    get_profile_report,
+    write_profile_report,
+)
+from stats_helpers import read_stats_file
+from parallel_helpers import get_available_cores
+from pathlib import Path
 import click
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
@@ -33,16 +44,125 @@ CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 @click.option(
     "--radionuclide", "-rad", default="Tc99m", help="Set the radionuclide type : Tc99m, Lu177 or other radionuclide contained in ICRP 107 database"
 )
+@click.option(
+    "--store_singles",
+    is_flag=True,
+    default=False,
+    help="Also write the un-blurred singles for offline re-digitization",
+)
+@click.option(
+    "--acceptance_angle",
+    "-aa",
+    is_flag=True,
+    default=False,
+    help="Only track the gammas emitted towards the spect head",
+)
+@click.option(
+    "--skip_policy",
+    default="SkipEvents",
+    help="Acceptance angle: SkipEvents or ZeroEnergy",
+)
+@click.option(
+    "--tags",
+    is_flag=True,
+    default=False,
+    help="Store the singles tagged by source and interaction history",
+)
+@click.option(
+    "--line_library",
+    default=None,
+    help="Emit the gamma lines of these radionuclides (e.g. Lu177,I131) with the "
+    "same probability and store the singles, see spectral.py",
+)
+@click.option(
+    "--threads",
+    "-t",
+    default=None,
+    type=int,
+    help="Nb of threads (default: all the available cores), the total activity "
+    "does not depend on it",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help="Write the wall/CPU time of each phase in {simu_name}_profile.json",
+)
+@click.option(
+    "--no_cache",
+    is_flag=True,
+    default=False,
+    help="Always run, even if the same configuration is found in the cache",
+)
+def go(
+    source_orientation,
+    fwhm_blur,
+    distance,
+    source_config,
+    scatter,
+    collimator,
+    radionuclide,
+    store_singles,
+    acceptance_angle,
+    skip_policy,
+    tags,
+    line_library,
+    threads,
+    profile,
+    no_cache,
+):
+    run_simulation(
+        source_orientation,
+        fwhm_blur,
+        distance,
+        source_config,
+        scatter,
+        collimator,
+        radionuclide,
+        number_of_threads=threads,
+        store_singles=store_singles,
+        acceptance_angle=acceptance_angle,
+        skip_policy=skip_policy,
+        use_cache=not no_cache,
+        tags=tags,
+        line_library=line_library.split(",") if line_library else None,
+        profile=profile,
+    )
 
-def go(source_orientation, fwhm_blur, distance, source_config, scatter, collimator, radionuclide):
-    run_simulation(source_orientation, fwhm_blur, distance, source_config, scatter, collimator, radionuclide)
+def run_simulation(
+    source_orientation,
+    fwhm_blur,
+    distance,
+    source_config,
+    scatter,
+    collimator,
+    radionuclide,
+    number_of_threads=None,
+    simu_name=None,
+    store_singles=False,
+    output_dir=None,
+    random_seed="auto",
+    time_slice=None,
+    acceptance_angle=False,
+    skip_policy="SkipEvents",
+    use_cache=True,
+    tags=False,
+    line_library=None,
+    profile=False,
+):
 
-def run_simulation(source_orientation, fwhm_blur, distance, source_config, scatter, collimator, radionuclide):
+    # the activity is divided between the threads, the total is the same
+    if number_of_threads is None:
+        number_of_threads = get_available_cores()
 
     # folders
-    simu_name = f"nema001_{source_orientation}_blur_{fwhm_blur:.2f}_d_{distance:.2f}"
+    if simu_name is None:
+        simu_name = f"nema001_{source_orientation}_blur_{fwhm_blur:.2f}_d_{distance:.2f}"
 
     # create the simulation
+    timer = PhaseTimer() if profile else None
+    if timer is not None:
+        timer.start("build")
     sim = gate.Simulation()
 
     # main options
@@ -56,11 +176,41 @@ def run_simulation(source_orientation, fwhm_blur, distance, source_config, scatt
     distance = distance + pos
     print("final radius =", distance)
 
+    # line library: all the lines of these radionuclides, same probability
+    lines = None
+    if line_library is not None:
+        lines = get_library_lines(line_library)
+        print(f"Line library: {len(lines)} lines of {line_library}")
+
     # create simulation
     if source_config == "1_source":
-        head, glass_tube, digit_blur = set_nema001_simulation(sim, simu_name, scatter, collimator, radionuclide)
+        head, glass_tube, digit_blur = set_nema001_simulation(
+            sim,
+            simu_name,
+            scatter,
+            collimator,
+            radionuclide,
+            number_of_threads,
+            store_singles,
+            acceptance_angle,
+            skip_policy,
+            tags,
+            lines,
+        )
     if source_config == "2_sources":
-        head, glass_tube, glass_tube2, digit_blur = set_nema001_simulation_2sources(sim, simu_name, scatter, collimator, radionuclide)
+        head, glass_tube, glass_tube2, digit_blur = set_nema001_simulation_2sources(
+            sim,
+            simu_name,
+            scatter,
+            collimator,
+            radionuclide,
+            number_of_threads,
+            store_singles,
+            acceptance_angle,
+            skip_policy,
+            tags,
+            lines,
+        )
 
     # orientation of the linear source
     # Mode 1 source
@@ -81,12 +231,79 @@ def run_simulation(source_orientation, fwhm_blur, distance, source_config, scatt
     # digitizer
     digit_blur.blur_fwhm = fwhm_blur
 
+    # seed and output (for sub-simulations)
+    sim.random_seed = random_seed
+    if output_dir is not None:
+        sim.output_dir = output_dir
+
+    # only simulate one slice of the acquisition time (index, nb_slices)
+    if time_slice is not None:
+        index, nb_slices = time_slice
+        start, end = sim.run_timing_intervals[0]
+        step = (end - start) / nb_slices
+        sim.run_timing_intervals = [[start + index * step, start + (index + 1) * step]]
+
+    # outputs (with the acquisition time and total activity, for normalization)
+    start, end = sim.run_timing_intervals[0]
+    outputs = {
+        "acquisition_time": (end - start) / g4_units.s,
+        "activity": get_total_activity(sim) / g4_units.Bq,
+        "simu_name": simu_name,
+        "output_dir": str(sim.output_dir),
+        "projection": str(Path(sim.output_dir) / f"{simu_name}_projection.mhd"),
+        "stats": str(Path(sim.output_dir) / f"{simu_name}_stats.txt"),
+        "singles": (
+            str(Path(sim.output_dir) / f"{simu_name}_singles.root")
+            if store_singles or tags or lines is not None
+            else None
+        ),
+    }
+    if lines is not None:
+        outputs["lines"] = str(Path(sim.output_dir) / f"{simu_name}_lines.json")
+    if tags:
+        outputs["sources"] = str(Path(sim.output_dir) / f"{simu_name}_sources.json")
+        outputs["interactions"] = str(Path(sim.output_dir) / simu_name)
+    if profile:
+        outputs["profile"] = str(Path(sim.output_dir) / f"{simu_name}_profile.json")
+
+    # skip the run if the same configuration has already been simulated
+    cache_root = Path(sim.output_dir).parent
+    key = get_simulation_key(sim, {"fwhm_blur": fwhm_blur})
+    if use_cache:
+        cached = find_cached_result(cache_root, key)
+        if cached is not None:
+            print(f"Same configuration found in cache: {cached['output_dir']}")
+            cached["acquisition_time"] = outputs["acquisition_time"]
+            cached["activity"] = outputs["activity"]
+            return cached
+
     # go
-    sim.run()
+    if lines is not None:
+        Path(sim.output_dir).mkdir(parents=True, exist_ok=True)
+        write_line_library(outputs["lines"], lines, line_library)
+    if tags:
+        Path(sim.output_dir).mkdir(parents=True, exist_ok=True)
+        write_source_regions(sim, outputs["sources"], r"source2?_container$")
+    if timer is not None:
+        run_profiled(sim, timer)
+    else:
+        sim.run()
 
     # print
     stats = sim.actor_manager.get_actor("stats")
     print(stats)
+    if acceptance_angle:
+        sources = ["source"] if source_config == "1_source" else ["source", "source2"]
+        skipped, zero = add_acceptance_angle_stats(sim, outputs["stats"], sources)
+        print(f"Acceptance angle: {skipped} skipped and {zero} zero energy events")
+    if timer is not None:
+        report = get_profile_report(sim, timer, read_stats_file(outputs["stats"]))
+        write_profile_report(outputs["profile"], report)
+        print(f"Profile written to {outputs['profile']}")
+
+    # (also when the cache is bypassed, to replace the previous entry)
+    add_cached_result(cache_root, key, outputs)
+    return outputs
 
 
 # --------------------------------------------------------------------------
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+import click
+from parallel_helpers import (
+    split_cores,
+    run_in_processes,
+    get_seeds,
+    get_available_cores,
+)
+from mhd_helpers import sum_mhd_images
+from stats_helpers import read_stats_file, write_stats_file, merge_stats
+from uncertainty_helpers import write_uncertainty_maps
+from checkpoint_helpers import Checkpoint
+from scaling_helpers import read_scaling_model, choose_layout
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+def run_split(parameters, number_of_threads, simu_name, output_dir, seed, time_slice):
+    # imported here: opengate is only needed in the worker processes
+    from nema001_spatial_resolution import run_simulation
+
+    return run_simulation(
+        number_of_threads=number_of_threads,
+        simu_name=simu_name,
+        output_dir=output_dir,
+        random_seed=seed,
+        time_slice=time_slice,
+        **parameters,
+    )
+
+
+def run_split_simulations(
+    parameters,
+    simu_name,
+    slices,
+    seeds,
+    work_dir,
+    nb_processes,
+    nb_threads,
+    checkpoint=None,
+):
+    """
+    Run the sub-simulations, one process for each time slice (index, nb_slices)
+    with its own seed. Return the outputs of all sub-simulations, in order.
+    With a checkpoint, the slices already done are not run again and each
+    finished slice is recorded as soon as it is done.
+    """
+    outputs = [None] * len(slices)
+    tasks = []
+    indices = []
+    for i, ((index, nb_slices), seed) in enumerate(zip(slices, seeds)):
+        if checkpoint is not None and checkpoint.is_done(index):
+            done = checkpoint.get(index)
+            if Path(done["projection"]).exists():
+                outputs[i] = done
+                continue
+        indices.append(i)
+        tasks.append(
+            {
+                "parameters": parameters,
+                "number_of_threads": nb_threads,
+                "simu_name": simu_name,
+                "output_dir": str(Path(work_dir) / f"split_{index:03d}"),
+                "seed": seed,
+                "time_slice": (index, nb_slices),
+            }
+        )
+    if len(tasks) < len(slices):
+        print(f"{len(slices) - len(tasks)} sub-simulations already done")
+    for j, outcome in run_in_processes(run_split, tasks, nb_processes):
+        i = indices[j]
+        if outcome["status"] != "done":
+            raise RuntimeError(f"Sub-simulation {i} failed: {outcome['error']}")
+        outputs[i] = outcome["result"]
+        if checkpoint is not None:
+            checkpoint.add(slices[i][0], outcome["result"])
+        print(f"Sub-simulation {i} done in {outcome['elapsed']:.1f} s")
+    return outputs
+
+
+def merge_split_outputs(outputs, simu_name, output_dir, uncertainty=False):
+    """
+    Sum the projections (exact counts, geometry checked) and merge the stats
+    of the sub-simulations into the same files as a single simulation.
+    With uncertainty, the sub-simulations are used as batches for the
+    per-pixel variance and relative uncertainty maps of the sum.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    proj = sum_mhd_images(
+        [o["projection"] for o in outputs], output_dir / f"{simu_name}_projection.mhd"
+    )
+    stats = merge_stats([read_stats_file(o["stats"]) for o in outputs])
+    stats_filename = output_dir / f"{simu_name}_stats.txt"
+    write_stats_file(stats_filename, stats)
+    merged = {
+        "simu_name": simu_name,
+        "output_dir": str(output_dir),
+        "projection": str(proj),
+        "stats": str(stats_filename),
+    }
+    if uncertainty:
+        variance, relative = write_uncertainty_maps(
+            [o["projection"] for o in outputs], proj
+        )
+        merged["variance"] = str(variance)
+        merged["uncertainty"] = str(relative)
+    return merged
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--source_orientation", "-s", default="X", help="X or Y")
+@click.option("--fwhm_blur", default=4.6, help="FWHM spatial blur in digitizer")
+@click.option("--distance", "-d", default=0.0, help="Distance source-detector in mm")
+@click.option("--source_config", "-c", default="1_source", help="1_source or 2_sources")
+@click.option("--scatter", "-sc", default=False, help="Set PMMA plates")
+@click.option("--collimator", "-col", default="lehr", help="lehr, megp, hegp or plexi")
+@click.option("--radionuclide", "-rad", default="Tc99m", help="Tc99m, Lu177, ...")
+@click.option("--nb_splits", "-n", default=None, type=int, help="Nb of sub-sims")
+@click.option("--cores", default=None, type=int, help="Nb of cores (default: all)")
+@click.option("--seed", default=None, type=int, help="Base seed (default: random)")
+@click.option(
+    "--scaling_model",
+    default=None,
+    help="Scaling model (json, see scaling_study.py) used to choose the nb of "
+    "processes and threads",
+)
+@click.option(
+    "--uncertainty",
+    "-u",
+    is_flag=True,
+    default=False,
+    help="Also write the per-pixel variance/uncertainty maps (sub-sims as batches)",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Only run the sub-simulations not done by a previous (interrupted) job",
+)
+def go(
+    source_orientation,
+    fwhm_blur,
+    distance,
+    source_config,
+    scatter,
+    collimator,
+    radionuclide,
+    nb_splits,
+    cores,
+    seed,
+    scaling_model,
+    uncertainty,
+    resume,
+):
+    parameters = {
+        "source_orientation": source_orientation,
+        "fwhm_blur": fwhm_blur,
+        "distance": distance,
+        "source_config": source_config,
+        "scatter": scatter,
+        "collimator": collimator,
+        "radionuclide": radionuclide,
+    }
+    simu_name = f"nema001_{source_orientation}_blur_{fwhm_blur:.2f}_d_{distance:.2f}"
+    output_dir = Path("planar_spatial_res") / simu_name
+
+    # layout
+    if cores is None:
+        cores = get_available_cores()
+    if scaling_model is not None:
+        # (the nema001 acquisition is 5 min in one run)
+        layout = choose_layout(
+            read_scaling_model(scaling_model), 300, 1, cores, max_processes=nb_splits
+        )
+        if nb_splits is None:
+            nb_splits = layout["processes"]
+        nb_processes, nb_threads = layout["processes"], layout["threads"]
+        print(f"Predicted wall time {layout['wall_time']:.0f} s")
+    else:
+        if nb_splits is None:
+            nb_splits = cores
+        nb_processes, nb_threads = split_cores(nb_splits, cores)
+    print(
+        f"{nb_splits} sub-simulations, {nb_processes} processes x {nb_threads} threads"
+    )
+
+    # go
+    slices = [(i, nb_splits) for i in range(nb_splits)]
+    checkpoint = Checkpoint(
+        output_dir / "checkpoint.json",
+        # (the nb of threads changes the seeds of the threads, the nb of
+        # processes does not change the results)
+        {**parameters, "nb_splits": nb_splits, "nb_threads": nb_threads},
+        seed,
+        resume,
+    )
+    seeds = get_seeds(checkpoint.seed, nb_splits)
+    outputs = run_split_simulations(
+        parameters,
+        simu_name,
+        slices,
+        seeds,
+        output_dir,
+        nb_processes,
+        nb_threads,
+        checkpoint,
+    )
+    merged = merge_split_outputs(outputs, simu_name, output_dir, uncertainty)
+    print(f"Merged projection: {merged['projection']}")
+    print(f"Merged stats: {merged['stats']}")
+    if uncertainty:
+        print(f"Relative uncertainty: {merged['uncertainty']}")
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
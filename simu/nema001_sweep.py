@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import itertools
+import json
+import os
+import time
+from pathlib import Path
+import click
+from parallel_helpers import split_cores, run_in_processes, get_available_cores
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+# default values, same as nema001_spatial_resolution
+default_parameters = {
+    "source_orientation": "X",
+    "fwhm_blur": 4.6,
+    "distance": 0.0,
+    "source_config": "1_source",
+    "scatter": False,
+    "collimator": "lehr",
+    "radionuclide": "Tc99m",
+}
+
+
+def get_sweep_simu_name(p):
+    # the name must be unique for all points of the sweep
+    name = (
+        f"nema001_{p['source_orientation']}_blur_{p['fwhm_blur']:.2f}"
+        f"_d_{p['distance']:.2f}_{p['collimator']}_{p['radionuclide']}"
+    )
+    if p["source_config"] == "2_sources":
+        name += "_2sources"
+    if p["scatter"]:
+        name += "_scatter"
+    return name
+
+
+def build_parameter_sets(grid, parameters_file):
+    """
+    Build the list of parameter sets, either from a json file (a list of dict,
+    missing keys get the default values) or from the cartesian product of
+    the grid values.
+    """
+    if parameters_file is not None:
+        with open(parameters_file) as f:
+            points = json.load(f)
+        return [{**default_parameters, **p} for p in points]
+    keys = list(default_parameters.keys())
+    values = [grid[k] if grid[k] else [default_parameters[k]] for k in keys]
+    return [dict(zip(keys, v)) for v in itertools.product(*values)]
+
+
+def run_sweep_point(parameters, number_of_threads, simu_name, use_cache=True):
+    # imported here: opengate is only needed in the worker processes
+    from nema001_spatial_resolution import run_simulation
+
+    return run_simulation(
+        number_of_threads=number_of_threads,
+        simu_name=simu_name,
+        use_cache=use_cache,
+        **parameters,
+    )
+
+
+def write_manifest(filename, manifest):
+    # write to a temporary file first, the manifest is always readable
+    tmp = Path(f"{filename}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, filename)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--source_orientation", "-s", multiple=True, help="X or Y (repeatable)")
+@click.option("--fwhm_blur", multiple=True, type=float, help="FWHM (repeatable)")
+@click.option("--distance", "-d", multiple=True, type=float, help="mm (repeatable)")
+@click.option("--source_config", "-c", multiple=True, help="1_source or 2_sources")
+@click.option("--scatter", "-sc", multiple=True, type=bool, help="(repeatable)")
+@click.option("--collimator", "-col", multiple=True, help="(repeatable)")
+@click.option("--radionuclide", "-rad", multiple=True, help="(repeatable)")
+@click.option(
+    "--parameters",
+    "-p",
+    default=None,
+    help="Json file with a list of parameter sets (instead of the grid options)",
+)
+@click.option("--cores", default=None, type=int, help="Nb of cores (default: all)")
+@click.option(
+    "--processes", "-j", default=None, type=int, help="Nb of concurrent simulations"
+)
+@click.option("--threads", "-t", default=None, type=int, help="Nb of threads per sim")
+@click.option(
+    "--manifest",
+    "-m",
+    default="planar_spatial_res/sweep_manifest.json",
+    help="Output manifest (json)",
+)
+@click.option(
+    "--no_cache", is_flag=True, default=False, help="Run even if found in the cache"
+)
+def go(
+    source_orientation,
+    fwhm_blur,
+    distance,
+    source_config,
+    scatter,
+    collimator,
+    radionuclide,
+    parameters,
+    cores,
+    processes,
+    threads,
+    manifest,
+    no_cache,
+):
+    grid = {
+        "source_orientation": source_orientation,
+        "fwhm_blur": fwhm_blur,
+        "distance": distance,
+        "source_config": source_config,
+        "scatter": scatter,
+        "collimator": collimator,
+        "radionuclide": radionuclide,
+    }
+    points = build_parameter_sets(grid, parameters)
+    run_sweep(points, manifest, cores, processes, threads, not no_cache)
+
+
+def run_sweep(
+    points,
+    manifest_filename,
+    cores=None,
+    processes=None,
+    threads=None,
+    use_cache=True,
+):
+    # cores layout
+    if cores is None:
+        cores = get_available_cores()
+    nb_processes, nb_threads = split_cores(len(points), cores)
+    if processes is not None:
+        nb_processes = processes
+        nb_threads = max(1, cores // nb_processes)
+    if threads is not None:
+        nb_threads = threads
+    print(f"Sweep: {len(points)} simulations")
+    print(f"Layout: {nb_processes} concurrent simulations x {nb_threads} threads")
+
+    # manifest
+    manifest_filename = Path(manifest_filename)
+    manifest_filename.parent.mkdir(parents=True, exist_ok=True)
+    manifest = {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "processes": nb_processes,
+        "threads": nb_threads,
+        "simulations": [],
+    }
+    tasks = []
+    for p in points:
+        simu_name = get_sweep_simu_name(p)
+        manifest["simulations"].append(
+            {"simu_name": simu_name, "parameters": p, "status": "pending"}
+        )
+        tasks.append(
+            {
+                "parameters": p,
+                "number_of_threads": nb_threads,
+                "simu_name": simu_name,
+                "use_cache": use_cache,
+            }
+        )
+    write_manifest(manifest_filename, manifest)
+
+    # go
+    for i, outcome in run_in_processes(run_sweep_point, tasks, nb_processes):
+        entry = manifest["simulations"][i]
+        entry["status"] = outcome["status"]
+        entry["elapsed"] = outcome.get("elapsed")
+        if outcome["status"] == "done":
+            entry["outputs"] = outcome["result"]
+        else:
+            entry["error"] = outcome["error"]
+        print(f"{entry['simu_name']}: {entry['status']}")
+        write_manifest(manifest_filename, manifest)
+
+    n = sum(1 for e in manifest["simulations"] if e["status"] == "done")
+    print(f"Done {n}/{len(points)}, manifest written to {manifest_filename}")
+    return manifest
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+from pathlib import Path
+import numpy as np
+from mhd_helpers import memmap_mhd, get_mhd_geometry
+from projection_helpers import ChunkedProjections, is_chunked_projection
+
+
+def get_line_orientation(img):
+    """
+    Axis of the image (0 = rows/Y, 1 = columns/X) along which the line source
+    lies: the sum along this axis gives the sharpest profile.
+    """
+    sharpness = []
+    for axis in (0, 1):
+        m = img.sum(axis=axis, dtype=np.float64)
+        sharpness.append(m.max() / max(m.mean(), 1e-12))
+    return int(np.argmax(sharpness))
+
+
+def locate_sources(marginal, nb_sources=1, min_distance=20):
+    """
+    Index of the nb_sources highest peaks of the summed profile, at least
+    min_distance pixels from each other
+    """
+    m = np.array(marginal, dtype=np.float64)
+    centers = []
+    for i in range(nb_sources):
+        c = int(np.argmax(m))
+        if m[c] <= 0:
+            break
+        centers.append(c)
+        m[max(0, c - min_distance) : c + min_distance + 1] = 0
+    return sorted(centers)
+
+
+def get_line_profiles(img, line_axis, center, half_width, band=1):
+    """
+    All the profiles perpendicular to the line source, (nb_profiles, 2*half_width+1).
+    Consecutive rows along the line are summed by bands of 'band' pixels.
+    Return the profiles, the index of their first pixel and the index of the
+    centre of each band along the line.
+    """
+    if line_axis == 1:
+        img = img.T
+    start = max(0, center - half_width)
+    stop = min(img.shape[1], center + half_width + 1)
+    p = np.asarray(img[:, start:stop], dtype=np.float64)
+    nb = p.shape[0] // band
+    p = p[: nb * band].reshape(nb, band, -1).sum(axis=1)
+    band_centers = np.arange(nb) * band + (band - 1) / 2
+    return p, start, band_centers
+
+
+def get_peaks(profiles):
+    """
+    NEMA peak: parabola through the maximum pixel and its two neighbours,
+    for all profiles at once. Return the peak position (pixel) and value.
+    """
+    n, length = profiles.shape
+    rows = np.arange(n)
+    i = np.clip(np.argmax(profiles, axis=1), 1, length - 2)
+    y0 = profiles[rows, i - 1]
+    y1 = profiles[rows, i]
+    y2 = profiles[rows, i + 1]
+    d = y0 - 2 * y1 + y2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta = np.where(d != 0, 0.5 * (y0 - y2) / d, 0)
+    delta = np.clip(delta, -0.5, 0.5)
+    peak_pos = i + delta
+    peak_value = y1 - 0.25 * (y0 - y2) * delta
+    return peak_pos, peak_value
+
+
+def get_widths(profiles, peak_pos, peak_value, fraction):
+    """
+    Full width at 'fraction' of the peak value (0.5 = FWHM, 0.1 = FWTM), with
+    a linear interpolation between the pixels around each crossing, for all
+    profiles at once. NaN when the profile does not cross the level.
+    """
+    n, length = profiles.shape
+    rows = np.arange(n)
+    level = fraction * peak_value
+    idx = np.arange(length)
+    imax = np.round(peak_pos).astype(int)[:, None]
+    below = profiles < level[:, None]
+
+    # last pixel below the level on the left, first one on the right
+    left = np.where(below & (idx < imax), idx, -1).max(axis=1)
+    right = np.where(below & (idx > imax), idx, length).min(axis=1)
+    ok = (left >= 0) & (right < length)
+    left = np.clip(left, 0, length - 2)
+    right = np.clip(right, 1, length - 1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        yl0 = profiles[rows, left]
+        yl1 = profiles[rows, left + 1]
+        xl = left + (level - yl0) / (yl1 - yl0)
+        yr0 = profiles[rows, right - 1]
+        yr1 = profiles[rows, right]
+        xr = right - 1 + (yr0 - level) / (yr0 - yr1)
+    return np.where(ok, xr - xl, np.nan)
+
+
+def analyse_line_source(
+    img,
+    spacing,
+    line_axis=None,
+    nb_sources=1,
+    half_width=60,
+    band=1,
+    min_peak_fraction=0.2,
+):
+    """
+    Peak position, FWHM and FWTM (mm) of all the profiles along the line
+    source(s) of one projection (2D array). Profiles whose peak is below
+    min_peak_fraction of the highest peak (beyond the source ends) are
+    flagged as not valid.
+    spacing is in (x, y) order.
+    Return a dict of 1D arrays (one element per profile).
+    """
+    if line_axis is None:
+        line_axis = get_line_orientation(img)
+    # spacing perpendicular to / along the line
+    sp_perp = spacing[0] if line_axis == 0 else spacing[1]
+    sp_line = spacing[1] if line_axis == 0 else spacing[0]
+    marginal = img.sum(axis=line_axis, dtype=np.float64)
+    centers = locate_sources(marginal, nb_sources, min_distance=half_width // 2)
+
+    results = {k: [] for k in ["source", "position", "peak", "fwhm", "fwtm", "valid"]}
+    for s, c in enumerate(centers):
+        p, start, band_centers = get_line_profiles(img, line_axis, c, half_width, band)
+        peak_pos, peak_value = get_peaks(p)
+        fwhm = get_widths(p, peak_pos, peak_value, 0.5) * sp_perp
+        fwtm = get_widths(p, peak_pos, peak_value, 0.1) * sp_perp
+        valid = peak_value >= min_peak_fraction * peak_value.max()
+        valid &= ~np.isnan(fwhm)
+        results["source"].append(np.full(len(p), s))
+        results["position"].append(band_centers * sp_line)
+        results["peak"].append((peak_pos + start) * sp_perp)
+        results["fwhm"].append(fwhm)
+        results["fwtm"].append(fwtm)
+        results["valid"].append(valid)
+    results = {k: np.concatenate(v) if v else np.array([]) for k, v in results.items()}
+    results["line_axis"] = line_axis
+    return results
+
+
+def analyse_projection_file(filename, slices=None, **kwargs):
+    """
+    Analyse the given slices (default: all) of a projection stack (mhd, or
+    chunked projections where only the needed slices of the first head are
+    read). Return one result dict (see analyse_line_source) per slice.
+    """
+    if is_chunked_projection(filename):
+        with ChunkedProjections(filename) as proj:
+            if slices is None:
+                slices = range(proj.nb_angles * proj.nb_ene_win)
+            images = (proj.get(0, *divmod(s, proj.nb_ene_win)) for s in slices)
+            return analyse_slices(filename, slices, images, proj.spacing, **kwargs)
+    img, header = memmap_mhd(filename)
+    spacing, _, _ = get_mhd_geometry(header)
+    if img.ndim == 2:
+        img = img[np.newaxis]
+    if slices is None:
+        slices = range(img.shape[0])
+    return analyse_slices(filename, slices, (img[s] for s in slices), spacing, **kwargs)
+
+
+def analyse_slices(filename, slices, images, spacing, **kwargs):
+    results = []
+    for s, img in zip(slices, images):
+        r = analyse_line_source(img, spacing, **kwargs)
+        r["filename"] = str(filename)
+        r["slice"] = s
+        results.append(r)
+    return results
+
+
+def summarize_results(results):
+    """
+    Mean/std of the FWHM and FWTM over the valid profiles, per slice and source
+    """
+    summary = []
+    for r in results:
+        for s in np.unique(r["source"]).astype(int):
+            m = (r["source"] == s) & r["valid"]
+            summary.append(
+                {
+                    "filename": r["filename"],
+                    "slice": int(r["slice"]),
+                    "source": int(s),
+                    "line_axis": int(r["line_axis"]),
+                    "nb_profiles": int(m.sum()),
+                    "peak_mean": float(np.mean(r["peak"][m])) if m.any() else None,
+                    "fwhm_mean": float(np.mean(r["fwhm"][m])) if m.any() else None,
+                    "fwhm_std": float(np.std(r["fwhm"][m])) if m.any() else None,
+                    "fwtm_mean": float(np.nanmean(r["fwtm"][m])) if m.any() else None,
+                    "fwtm_std": float(np.nanstd(r["fwtm"][m])) if m.any() else None,
+                }
+            )
+    return summary
+
+
+def write_profiles_csv(filename, results):
+    keys = ["source", "position", "peak", "fwhm", "fwtm", "valid"]
+    with open(filename, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["filename", "slice"] + keys)
+        for r in results:
+            for s, pos, peak, fwhm, fwtm, valid in zip(*[r[k] for k in keys]):
+                w.writerow(
+                    [r["filename"], r["slice"], int(s)]
+                    + [f"{v:.4f}" for v in (pos, peak, fwhm, fwtm)]
+                    + [int(valid)]
+                )
+
+
+def write_summary_json(filename, summary):
+    with open(filename, "w") as f:
+        json.dump(summary, f, indent=2)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import traceback
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def get_available_cores():
+    """
+    Nb of cores this process may use (cpu affinity, e.g. set by a batch
+    system), not the nb of cores of the host
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def split_cores(nb_tasks, nb_cores=None, max_threads=None):
+    """
+    Split the available cores between concurrent simulations (processes) and
+    the number of threads of each simulation.
+    Geant4 MT scales poorly for our scenarios, so we favor processes: as many
+    concurrent simulations as possible, and the remaining cores are given as
+    threads to each of them.
+    Return (nb_processes, nb_threads).
+    """
+    if nb_cores is None:
+        nb_cores = get_available_cores()
+    nb_tasks = max(1, nb_tasks)
+    nb_processes = max(1, min(nb_tasks, nb_cores))
+    nb_threads = max(1, nb_cores // nb_processes)
+    if max_threads is not None:
+        nb_threads = max(1, min(nb_threads, max_threads))
+    return nb_processes, nb_threads
+
+
+def _run_task(func, kwargs):
+    # executed in the worker process
+    t = time.time()
+    try:
+        result = func(**kwargs)
+        return {"status": "done", "result": result, "elapsed": time.time() - t}
+    except Exception as e:
+        return {
+            "status": "failed",
+            "error": f"{type(e).__name__}: {e}",
+            "traceback": traceback.format_exc(),
+            "elapsed": time.time() - t,
+        }
+
+
+def run_in_processes(func, tasks, nb_processes):
+    """
+    Run func(**kwargs) for all kwargs in tasks, each one in a new process
+    (Geant4 can only be run once per process), with at most nb_processes
+    concurrent processes.
+    The tasks are submitted in the given order and consumed by the workers as
+    soon as they are free, so long tasks should be placed first.
+    Yield (task index, outcome) as soon as each task is finished. The outcome
+    is a dict with 'status' ('done' or 'failed'), 'elapsed' and 'result' or
+    'error'.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=nb_processes, mp_context=ctx, max_tasks_per_child=1
+    ) as executor:
+        futures = {
+            executor.submit(_run_task, func, kwargs): i
+            for i, kwargs in enumerate(tasks)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                outcome = future.result()
+            except Exception as e:
+                # the worker process itself died (segfault in Geant4, etc)
+                outcome = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+            yield i, outcome
+
+
+def get_seeds(seed, n):
+    """
+    Return n distinct and reproducible seeds for independent sub-simulations.
+    If seed is None, the seeds are random.
+    """
+    ss = np.random.SeedSequence(seed)
+    return [int(s.generate_state(1)[0] % 2**31) for s in ss.spawn(n)]
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import resource
+from pathlib import Path
+
+
+class PhaseTimer:
+    """
+    Wall and CPU time of consecutive named phases (build, initialization,
+    transport, output). The CPU time is the one of the whole process, so it
+    includes all the Geant4 threads: cpu / wall close to the number of
+    threads means that the threads are busy.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.current = None
+        self.start_wall = None
+        self.start_cpu = None
+
+    def start(self, name):
+        self.stop()
+        self.current = name
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    def stop(self):
+        if self.current is None:
+            return
+        p = self.phases.setdefault(self.current, {"wall": 0.0, "cpu": 0.0})
+        p["wall"] += time.perf_counter() - self.start_wall
+        p["cpu"] += time.process_time() - self.start_cpu
+        self.current = None
+
+    def as_dict(self):
+        phases = {k: dict(v) for k, v in self.phases.items()}
+        for p in phases.values():
+            p["cpu_per_wall"] = p["cpu"] / p["wall"] if p["wall"] > 0 else None
+        return phases
+
+
+def add_phase_hooks(sim, timer):
+    """
+    Switch the timer to 'transport' when the initialization is done and to
+    'output' when the runs are done (user hooks of the simulation engine)
+    """
+    sim.user_hook_after_init = lambda engine: timer.start("transport")
+    if hasattr(sim, "user_hook_after_run"):
+        sim.user_hook_after_run = lambda engine: timer.start("output")
+
+
+def get_digitizer_depths(sim):
+    """
+    Position of each digitizer actor in its chain: 1 for the hits collection,
+    then 1 + the position of its input (the energy windows channels are
+    produced by the windows actor). Other actors are not in the result.
+    """
+    actors = sim.actor_manager.actors
+    producers = {}
+    inputs = {}
+    for a in actors.values():
+        producers[a.name] = a.name
+        for c in getattr(a, "channels", None) or []:
+            producers[c["name"]] = a.name
+        i = getattr(a, "input_digi_collection", None)
+        if i is not None:
+            inputs[a.name] = [i]
+        i = getattr(a, "input_digi_collections", None)
+        if i is not None:
+            inputs[a.name] = list(i)
+    depths = {}
+
+    def depth(name):
+        if name not in depths:
+            if type(actors[name]).__name__ == "DigitizerHitsCollectionActor":
+                depths[name] = 1
+            elif name in inputs:
+                d = [depth(producers[i]) for i in inputs[name] if i in producers]
+                depths[name] = 1 + max(d, default=0)
+        return depths.get(name)
+
+    for name in actors:
+        depth(name)
+    return depths
+
+
+def remove_actors(sim, names):
+    for name in names:
+        sim.actor_manager.actors.pop(name)
+
+
+def disable_outputs(sim, keep=("stats",)):
+    # nothing written (except the stats), to measure the output cost
+    for a in sim.actor_manager.actors.values():
+        if a.name not in keep and hasattr(a, "write_to_disk"):
+            a.write_to_disk = False
+
+
+def get_actor_types(sim):
+    return {a.name: type(a).__name__ for a in sim.actor_manager.actors.values()}
+
+
+def run_profiled(sim, timer=None):
+    """
+    Run the simulation with the phase timer, return the timer. Start the
+    timer (phase 'build') before creating the simulation to also measure the
+    geometry/actors creation.
+    """
+    if timer is None:
+        timer = PhaseTimer()
+    add_phase_hooks(sim, timer)
+    timer.start("initialization")
+    sim.run()
+    timer.stop()
+    return timer
+
+
+def get_profile_report(sim, timer, stats):
+    """
+    Structured report of a profiled run: phases (wall, cpu), events, time per
+    event after the initialization (transport and output), runs, actors and
+    digitizer chain positions
+    """
+    events = stats.get("NumberOfEvents")
+    phases = timer.as_dict()
+    # everything after the initialization (the output phase is empty when
+    # the engine has no hook after the runs)
+    after = [phases[k] for k in ["transport", "output"] if k in phases]
+    transport = {
+        "wall": sum(p["wall"] for p in after) if after else None,
+        "cpu": sum(p["cpu"] for p in after) if after else None,
+    }
+    return {
+        "phases": phases,
+        "events": events,
+        "pps": stats.get("PPS"),
+        "threads": sim.number_of_threads,
+        "nb_runs": len(sim.run_timing_intervals),
+        "us_per_event": (
+            1e6 * transport["wall"] / events if events and transport["wall"] else None
+        ),
+        "cpu_us_per_event": (
+            1e6 * transport["cpu"] / events if events and transport["cpu"] else None
+        ),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "actors": get_actor_types(sim),
+        "digitizer_depths": get_digitizer_depths(sim),
+    }
+
+
+def write_profile_report(filename, report):
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2, default=float)
+
+
+def read_profile_report(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def get_stage_costs(reports):
+    """
+    Cost (wall and CPU time per event after the initialization, in us) of
+    each digitizer module, actor, output and dynamic geometry, from the
+    reports of the ablation variants (see simulation_profile.py): differences
+    between the reference and the variant without the stage. The run_{k}
+    variants (one run interval alone) give the cost of each run.
+    """
+    ref = reports["reference"]
+
+    def diff(a, b, key):
+        if a is None or b is None or a[key] is None or b[key] is None:
+            return None
+        return a[key] - b[key]
+
+    def cost(a, b):
+        return {
+            "wall_us_per_event": diff(a, b, "us_per_event"),
+            "cpu_us_per_event": diff(a, b, "cpu_us_per_event"),
+        }
+
+    costs = {}
+    # digitizer modules: depth k minus depth k-1 (all heads at once)
+    depths = ref["digitizer_depths"]
+    max_depth = max(depths.values(), default=0)
+    for k in range(1, max_depth + 1):
+        a = ref if k == max_depth else reports.get(f"digitizer_depth_{k}")
+        b = reports.get(f"digitizer_depth_{k - 1}")
+        names = sorted(n for n, d in depths.items() if d == k)
+        types = sorted({ref["actors"][n] for n in names})
+        costs[f"digitizer_{k}_{'_'.join(types)}"] = {"actors": names, **cost(a, b)}
+    # other actors
+    for name, r in reports.items():
+        if name.startswith("without_"):
+            costs[name[len("without_") :]] = cost(ref, r)
+    # output (the phase after the runs is also in the reference report)
+    if "no_output" in reports:
+        costs["output"] = cost(ref, reports["no_output"])
+    # geometry updates and run overhead (nb_runs - 1 changes)
+    if "static_geometry" in reports and ref["nb_runs"] > 1:
+        c = cost(ref, reports["static_geometry"])
+        costs["dynamic_geometry"] = c
+        costs["dynamic_geometry"]["nb_runs"] = ref["nb_runs"]
+    # geometry navigation and physics (no digitizer at all)
+    if "digitizer_depth_0" in reports:
+        r = reports["digitizer_depth_0"]
+        costs["transport"] = {
+            "wall_us_per_event": r["us_per_event"],
+            "cpu_us_per_event": r["cpu_us_per_event"],
+        }
+    # run intervals simulated alone
+    runs = {k: r for k, r in reports.items() if k.startswith("run_")}
+    if runs:
+        costs["runs"] = {
+            k: {
+                "wall_us_per_event": r["us_per_event"],
+                "cpu_us_per_event": r["cpu_us_per_event"],
+                "events": r["events"],
+            }
+            for k, r in sorted(runs.items(), key=lambda x: int(x[0][4:]))
+        }
+    return costs
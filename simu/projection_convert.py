@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+from pathlib import Path
+import click
+from mhd_helpers import read_mhd_header
+from projection_helpers import convert_mhd_to_chunked
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+def get_size(filenames):
+    size = 0
+    for f in filenames:
+        header = read_mhd_header(f)
+        size += os.path.getsize(f)
+        size += os.path.getsize(Path(f).parent / header["ElementDataFile"])
+    return size
+
+
+def get_tree_conversions(tree):
+    """
+    All the projection stacks of the folder: {name}_projection.mhd alone, or
+    else the single head {name}_projection_{i}.mhd together (head order), in
+    {name}_projection.zip
+    """
+    stacks = {}
+    for f in Path(tree).glob("**/*_projection*.mhd"):
+        m = re.fullmatch(r"(.*_projection)(?:_(\d+))?\.mhd", f.name)
+        if m is None:
+            continue
+        head = -1 if m.group(2) is None else int(m.group(2))
+        stacks.setdefault((f.parent, m.group(1)), []).append((head, f))
+    conversions = []
+    for (folder, name), files in sorted(stacks.items()):
+        files = sorted(files)
+        if files[0][0] == -1:
+            files = files[:1]
+        conversions.append(([f for _, f in files], folder / f"{name}.zip"))
+    return conversions
+
+
+def remove_mhd(filenames):
+    for f in filenames:
+        header = read_mhd_header(f)
+        os.remove(Path(f).parent / header["ElementDataFile"])
+        os.remove(f)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument("mhd_files", nargs=-1)
+@click.option("--output", "-o", default=None, help="Output chunked file (.zip)")
+@click.option("--nb_ene_win", "-n", required=True, type=int, help="Nb of windows")
+@click.option(
+    "--tree",
+    "-r",
+    "trees",
+    multiple=True,
+    help="Convert all the *_projection.mhd and *_projection_{i}.mhd found in this "
+    "folder",
+)
+@click.option(
+    "--remove", is_flag=True, default=False, help="Remove the mhd/raw files"
+)
+def go(mhd_files, output, nb_ene_win, trees, remove):
+    """
+    Convert projection stacks (mhd, one per head in head order) to the chunked
+    format: integer counts, one compressed chunk per (head, angle, window)
+    """
+    conversions = []
+    if mhd_files:
+        if output is None:
+            raise click.UsageError("--output is required with mhd files")
+        conversions.append((list(mhd_files), output))
+    for tree in trees:
+        conversions += get_tree_conversions(tree)
+
+    for filenames, output in conversions:
+        t = time.time()
+        size = get_size(filenames)
+        meta = convert_mhd_to_chunked(filenames, nb_ene_win, output)
+        new_size = os.path.getsize(output)
+        print(
+            f"{output}: {meta['nb_heads']} heads x {meta['nb_angles']} angles x "
+            f"{meta['nb_ene_win']} windows, {meta['dtype']}, "
+            f"{size / 1e6:.1f} MB -> {new_size / 1e6:.1f} MB in {time.time() - t:.1f} s"
+        )
+        if remove:
+            remove_mhd(filenames)
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import zipfile
+from pathlib import Path
+import numpy as np
+from mhd_helpers import memmap_mhd, get_mhd_geometry
+
+# Chunked projections: a zip archive with one compressed npy member per
+# (head, angle, window) projection and the geometry in meta.json.
+# Each member can be read without decoding the others.
+chunked_suffix = ".zip"
+meta_filename = "meta.json"
+
+
+def get_chunk_name(head, angle, window):
+    return f"h{head:02d}/a{angle:04d}/w{window:02d}.npy"
+
+
+def get_count_dtype(stacks):
+    """
+    Smallest unsigned integer type that holds the counts, float32 if the
+    values are not integer counts (e.g. weighted or scaled projections)
+    """
+    vmax = 0
+    for s in stacks:
+        for z in range(s.shape[0]):
+            img = np.asarray(s[z])
+            if img.min() < 0 or not np.all(np.mod(img, 1) == 0):
+                return np.float32
+            vmax = max(vmax, img.max())
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if vmax <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def write_chunked_projections(
+    filename, stacks, nb_ene_win, spacing, origin=None, direction=None, level=6
+):
+    """
+    Write the projection stacks (one per head, slice = angle * nb_ene_win +
+    window, as written by the DigitizerProjectionActor) in the chunked format.
+    The counts are stored with the smallest integer type.
+    """
+    dtype = get_count_dtype(stacks)
+    nb_angles = stacks[0].shape[0] // nb_ene_win
+    meta = {
+        "nb_heads": len(stacks),
+        "nb_angles": nb_angles,
+        "nb_ene_win": nb_ene_win,
+        "size": [int(stacks[0].shape[2]), int(stacks[0].shape[1])],
+        "spacing": [float(s) for s in spacing],
+        "origin": [float(o) for o in origin] if origin is not None else None,
+        "direction": [float(d) for d in direction] if direction is not None else None,
+        "dtype": np.dtype(dtype).str,
+    }
+    with zipfile.ZipFile(
+        filename, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=level
+    ) as z:
+        z.writestr(meta_filename, json.dumps(meta, indent=2))
+        for h, stack in enumerate(stacks):
+            for a in range(nb_angles):
+                for w in range(nb_ene_win):
+                    buffer = io.BytesIO()
+                    np.save(buffer, np.asarray(stack[a * nb_ene_win + w], dtype=dtype))
+                    z.writestr(get_chunk_name(h, a, w), buffer.getvalue())
+    return meta
+
+
+def convert_mhd_to_chunked(mhd_filenames, nb_ene_win, output_filename, level=6):
+    """
+    Convert the mhd projection stacks (one per head, in head order)
+    """
+    stacks = []
+    for f in mhd_filenames:
+        img, header = memmap_mhd(f)
+        stacks.append(img)
+    spacing, origin, direction = get_mhd_geometry(header)
+    return write_chunked_projections(
+        output_filename, stacks, nb_ene_win, spacing, origin, direction, level
+    )
+
+
+class ChunkedProjections:
+    """
+    Read access to a chunked projection file, only the requested
+    (head, angle, window) projections are decompressed.
+    """
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.zip = zipfile.ZipFile(self.filename, "r")
+        self.meta = json.loads(self.zip.read(meta_filename))
+        self.nb_heads = self.meta["nb_heads"]
+        self.nb_angles = self.meta["nb_angles"]
+        self.nb_ene_win = self.meta["nb_ene_win"]
+        self.spacing = self.meta["spacing"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def get(self, head, angle, window):
+        with self.zip.open(get_chunk_name(head, angle, window)) as f:
+            return np.load(io.BytesIO(f.read()))
+
+    def get_window(self, head, window, angles=None):
+        # (nb_angles, y, x) projections of one energy window
+        if angles is None:
+            angles = range(self.nb_angles)
+        return np.stack([self.get(head, a, window) for a in angles])
+
+    def get_stack(self, head):
+        # same layout as the mhd written by the DigitizerProjectionActor
+        return np.stack(
+            [
+                self.get(head, a, w)
+                for a in range(self.nb_angles)
+                for w in range(self.nb_ene_win)
+            ]
+        )
+
+
+def is_chunked_projection(filename):
+    return Path(filename).suffix == chunked_suffix
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import scipy.sparse
+from scipy.ndimage import gaussian_filter
+from concurrent.futures import ThreadPoolExecutor
+from mhd_helpers import memmap_mhd, get_mhd_geometry
+from projection_helpers import ChunkedProjections
+
+
+def get_gantry_angles(nb_angles, nb_heads=2, start_angle_deg=0, step_angle_deg=None):
+    """
+    Angles (deg, around the Z axis) of all the projections, with the same
+    parameters as rotate_gantry: head i is at start + r * step + i * 360 / nb_heads
+    (test003: 2 opposite heads, 180 deg each). Order: all angles of head 0,
+    then head 1, etc.
+    """
+    if step_angle_deg is None:
+        step_angle_deg = 360 / nb_heads / nb_angles
+    angles = []
+    for h in range(nb_heads):
+        for r in range(nb_angles):
+            angles.append(start_angle_deg + r * step_angle_deg + h * 360 / nb_heads)
+    return np.array(angles)
+
+
+def read_projections(filenames, window, nb_ene_win):
+    """
+    Projections of one energy window of the stacks (one mhd per head, or one
+    chunked file), as (nb_heads * nb_angles, rows, cols) in the same order as
+    get_gantry_angles. Return the projections and the pixel spacing.
+    """
+    if len(filenames) == 1 and str(filenames[0]).endswith(".zip"):
+        with ChunkedProjections(filenames[0]) as proj:
+            p = [proj.get_window(h, window) for h in range(proj.nb_heads)]
+            return np.concatenate(p).astype(np.float32), proj.spacing
+    p = []
+    for f in filenames:
+        img, header = memmap_mhd(f)
+        nb_angles = img.shape[0] // nb_ene_win
+        view = img[: nb_angles * nb_ene_win].reshape(
+            (nb_angles, nb_ene_win) + img.shape[1:]
+        )
+        p.append(np.asarray(view[:, window], dtype=np.float32))
+    spacing, _, _ = get_mhd_geometry(header)
+    return np.concatenate(p), spacing[:2]
+
+
+def get_rotation_matrix(angle_deg, n, spacing):
+    """
+    Sparse bilinear interpolation matrix (n*n, n*n) that samples a (y, x)
+    slice of the volume on the grid (v, u) of the detector at this angle:
+    u along the detector normal (towards the detector), v along the detector.
+    """
+    a = np.deg2rad(angle_deg)
+    c = (np.arange(n) - (n - 1) / 2) * spacing
+    v, u = np.meshgrid(c, c, indexing="ij")
+    # world position of each (v, u) sample
+    x = u * np.cos(a) - v * np.sin(a)
+    y = u * np.sin(a) + v * np.cos(a)
+    fx = x / spacing + (n - 1) / 2
+    fy = y / spacing + (n - 1) / 2
+    x0 = np.floor(fx).astype(np.int64)
+    y0 = np.floor(fy).astype(np.int64)
+    wx = fx - x0
+    wy = fy - y0
+    rows = np.arange(n * n).reshape(n, n)
+    all_rows, all_cols, all_w = [], [], []
+    for dy, dx, w in [
+        (0, 0, (1 - wy) * (1 - wx)),
+        (0, 1, (1 - wy) * wx),
+        (1, 0, wy * (1 - wx)),
+        (1, 1, wy * wx),
+    ]:
+        xi = x0 + dx
+        yi = y0 + dy
+        ok = (xi >= 0) & (xi < n) & (yi >= 0) & (yi < n) & (w > 0)
+        all_rows.append(rows[ok])
+        all_cols.append(yi[ok] * n + xi[ok])
+        all_w.append(w[ok])
+    return scipy.sparse.csr_matrix(
+        (
+            np.concatenate(all_w).astype(np.float32),
+            (np.concatenate(all_rows), np.concatenate(all_cols)),
+        ),
+        shape=(n * n, n * n),
+    )
+
+
+class RotationProjector:
+    """
+    Rotation-based projector/backprojector for a circular orbit around Z.
+    The volume is stored as (nz, n, n) = (z, y, x) with the same spacing as
+    the projection pixels, the projections as (nb_proj, nz, n) = (z, v).
+    The rotation of each angle is a precomputed sparse interpolation matrix
+    and the backprojection is its exact transpose.
+    Optional depth-dependent collimator response (gaussian, sigma in mm
+    at distance d from the detector: sigma0 + alpha * d, as the Zeng
+    projector of RTK), applied incrementally by slabs of planes.
+    Optional attenuation: mu (nz, n, n) linear attenuation map in 1/mm.
+    """
+
+    def __init__(
+        self,
+        angles_deg,
+        n,
+        nz,
+        spacing,
+        radius=None,
+        sigma0=None,
+        alpha=None,
+        slab=4,
+        nb_threads=None,
+        mu=None,
+    ):
+        self.n = n
+        self.nz = nz
+        self.spacing = spacing
+        self.angles = np.asarray(angles_deg)
+        self.nb_threads = nb_threads
+        self.rotations = [get_rotation_matrix(a, n, spacing) for a in self.angles]
+        self.psf = sigma0 is not None and alpha is not None and radius is not None
+        self.mu = None
+        if mu is not None:
+            self.mu = np.ascontiguousarray(
+                np.asarray(mu, dtype=np.float32).reshape(nz, -1).T
+            )
+        if self.psf:
+            # slabs of planes along u, from the farthest to the nearest
+            u = (np.arange(n) - (n - 1) / 2) * spacing
+            self.slabs = [list(range(i, min(i + slab, n))) for i in range(0, n, slab)]
+            d = np.array([radius - u[s].mean() for s in self.slabs])
+            sigma = np.maximum(sigma0 + alpha * d, 0) / spacing
+            self.sigmas = sigma
+            self.incremental = np.sqrt(np.maximum(sigma[:-1] ** 2 - sigma[1:] ** 2, 0))
+        if not self.psf and self.mu is None:
+            # rotation + sum along u in one matrix
+            s = scipy.sparse.kron(
+                scipy.sparse.eye(n), np.ones((1, n), dtype=np.float32)
+            ).tocsr()
+            self.rotations = [(s @ r).tocsr() for r in self.rotations]
+        # transposes in csr format, faster for the backprojection
+        self.transposes = [r.T.tocsr() for r in self.rotations]
+
+    def _map(self, func, indices):
+        with ThreadPoolExecutor(self.nb_threads) as executor:
+            return list(executor.map(func, indices))
+
+    @property
+    def fused(self):
+        return not self.psf and self.mu is None
+
+    def get_attenuation(self, i):
+        # fraction of the photons emitted in each (v, u, z) voxel that reach
+        # the detector (on the +u side), half of the voxel itself is crossed
+        m = (self.rotations[i] @ self.mu).reshape(self.n, self.n, self.nz)
+        c = np.cumsum(m[:, ::-1, :], axis=1)[:, ::-1, :]
+        return np.exp(-(c - 0.5 * m) * self.spacing)
+
+    def forward_one(self, vol, i):
+        # vol is (n*n, nz): (y, x) flattened, z last
+        r = self.rotations[i] @ vol
+        if self.fused:
+            return r.T
+        r = r.reshape(self.n, self.n, self.nz)  # v, u, z
+        if self.mu is not None:
+            r = r * self.get_attenuation(i)
+        if not self.psf:
+            return r.sum(axis=1).T
+        acc = None
+        for k, s in enumerate(self.slabs):
+            plane = r[:, s, :].sum(axis=1)
+            if acc is None:
+                acc = plane
+            else:
+                acc = gaussian_filter(acc, self.incremental[k - 1]) + plane
+        acc = gaussian_filter(acc, self.sigmas[-1])
+        return acc.T
+
+    def back_one(self, proj, i):
+        # proj is (nz, n): z, v
+        p = np.ascontiguousarray(proj.T)
+        if self.fused:
+            return self.transposes[i] @ p
+        r = np.zeros((self.n, self.n, self.nz), dtype=np.float32)
+        if self.psf:
+            b = gaussian_filter(p, self.sigmas[-1])
+            for k in range(len(self.slabs) - 1, -1, -1):
+                r[:, self.slabs[k], :] = b[:, None, :]
+                if k > 0:
+                    b = gaussian_filter(b, self.incremental[k - 1])
+        else:
+            r[:] = p[:, None, :]
+        if self.mu is not None:
+            r *= self.get_attenuation(i)
+        return self.transposes[i] @ r.reshape(self.n * self.n, self.nz)
+
+    def forward(self, vol, indices):
+        """
+        Projections (len(indices), nz, n) of the volume (nz, n, n)
+        """
+        v = np.ascontiguousarray(vol.reshape(self.nz, -1).T)
+        return np.array(self._map(lambda i: self.forward_one(v, i), indices))
+
+    def back(self, projections, indices):
+        """
+        Backprojection (nz, n, n) of the projections (len(indices), nz, n)
+        """
+        v = np.zeros((self.n * self.n, self.nz), dtype=np.float32)
+        for part in self._map(
+            lambda j: self.back_one(projections[j], indices[j]), range(len(indices))
+        ):
+            v += part
+        return np.ascontiguousarray(v.T).reshape(self.nz, self.n, self.n)
+
+
+def get_subsets(nb_projections, nb_subsets):
+    # interleaved subsets, projections well spread around the orbit
+    return [list(range(s, nb_projections, nb_subsets)) for s in range(nb_subsets)]
+
+
+def osem(projector, projections, nb_iterations, nb_subsets, verbose=True):
+    """
+    Ordered-subset expectation maximization. projections is
+    (nb_proj, nz, n), ordered as the angles of the projector.
+    """
+    projections = np.asarray(projections, dtype=np.float32)
+    subsets = get_subsets(len(projections), nb_subsets)
+    x = np.ones((projector.nz, projector.n, projector.n), dtype=np.float32)
+    sensitivity = []
+    for s in subsets:
+        ones = np.ones((len(s),) + projections.shape[1:], dtype=np.float32)
+        sensitivity.append(projector.back(ones, s))
+    for it in range(nb_iterations):
+        for k, s in enumerate(subsets):
+            fp = projector.forward(x, s)
+            ratio = np.divide(
+                projections[s], fp, out=np.zeros_like(fp), where=fp > 0
+            )
+            bp = projector.back(ratio, s)
+            x = np.divide(
+                x * bp, sensitivity[k], out=np.zeros_like(x), where=sensitivity[k] > 0
+            )
+        if verbose:
+            print(f"Iteration {it + 1}/{nb_iterations} done")
+    return x
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import click
+from pathlib import Path
+from redigitizer_helpers import *
+from tag_helpers import *
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def go():
+    """
+    Offline re-digitization: the un-blurred singles are stored once by a
+    simulation (e.g. nema001_spatial_resolution --store_singles), the blur,
+    energy windows and projections are then computed in a few seconds.
+    """
+    pass
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.argument("root_files", nargs=-1, required=True)
+@click.option("--output", "-o", required=True, help="Output singles file (npz)")
+def convert(root_files, output):
+    """
+    Convert ROOT singles files (one per head, in head order) to npz
+    """
+    columns = convert_singles_root_to_npz(root_files, output)
+    print(f"{len(columns['energy'])} singles written to {output}")
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.argument("singles_file")
+@click.option("--output", "-o", required=True, help="Output projection (mhd)")
+@click.option(
+    "--preset",
+    "-p",
+    default="Tc99m",
+    help="Digitizer default values: Tc99m, Lu177, I131 or intevo_Lu177",
+)
+@click.option("--spectrum_channel/--no_spectrum_channel", default=False)
+@click.option("--fwhm_blur", default=None, type=float, help="Spatial FWHM in mm")
+@click.option(
+    "--energy_method", default=None, help="Energy blur method: InverseSquare, Linear"
+)
+@click.option("--energy_resolution", default=None, type=float, help="FWHM/E")
+@click.option("--energy_reference", default=None, type=float, help="keV")
+@click.option("--energy_slope", default=None, type=float, help="1/MeV (Linear)")
+@click.option("--nb_runs", default=None, type=int, help="Nb of runs (angles)")
+@click.option(
+    "--nb_heads", default=None, type=int, help="Nb of heads (default: from the file)"
+)
+@click.option("--seed", default=None, type=int, help="Random seed")
+def project(
+    singles_file,
+    output,
+    preset,
+    spectrum_channel,
+    fwhm_blur,
+    energy_method,
+    energy_resolution,
+    energy_reference,
+    energy_slope,
+    nb_runs,
+    nb_heads,
+    seed,
+):
+    """
+    Compute the projections from a npz singles file
+    """
+    # parameters
+    p = get_digitizer_preset(preset, spectrum_channel)
+    if fwhm_blur is not None:
+        p["spatial_blur_fwhm"] = fwhm_blur * mm
+    eb = p["energy_blur"]
+    if energy_method is not None:
+        eb["method"] = energy_method
+    if energy_resolution is not None:
+        eb["resolution"] = energy_resolution
+    if energy_reference is not None:
+        eb["reference_value"] = energy_reference * keV
+    if energy_slope is not None:
+        eb["slope"] = energy_slope / MeV
+    print(f"Energy blur: {eb}")
+    print(f"Spatial blur FWHM: {p['spatial_blur_fwhm']} mm")
+    print(f"Channels: {[c['name'] for c in p['channels']]}")
+
+    # go
+    t = time.time()
+    singles = read_singles(singles_file)
+    projections = redigitize(
+        singles,
+        eb,
+        p["spatial_blur_fwhm"],
+        p["channels"],
+        p["size"],
+        p["spacing"],
+        nb_runs=nb_runs,
+        nb_heads=nb_heads,
+        orientation_matrix=p["orientation_matrix"],
+        limits=p["limits"],
+        seed=seed,
+    )
+    filenames = write_projections(output, projections, p["spacing"])
+    print(f"{len(singles['energy'])} singles processed in {time.time() - t:.1f} s")
+    for f in filenames:
+        print(f"Projection written to {f}")
+
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.argument("singles_file")
+@click.option("--output", "-o", required=True, help="Output projection (mhd)")
+@click.option(
+    "--preset",
+    "-p",
+    default="intevo_Lu177",
+    help="Digitizer default values: Tc99m, Lu177, I131 or intevo_Lu177",
+)
+@click.option("--spectrum_channel/--no_spectrum_channel", default=True)
+@click.option("--sources", "-s", default=None, help="Source regions (json)")
+@click.option(
+    "--interactions",
+    "-i",
+    default=None,
+    help="Prefix of the recorded interaction files ({prefix}_{region}_*.root)",
+)
+@click.option("--collimator", default="melp", help="Collimator for the penetration")
+@click.option(
+    "--acceptance", default=None, type=float, help="Hole diameter / length"
+)
+@click.option("--nb_runs", default=None, type=int, help="Nb of runs (angles)")
+@click.option(
+    "--nb_heads", default=None, type=int, help="Nb of heads (default: from the file)"
+)
+@click.option("--seed", default=None, type=int, help="Random seed")
+def tagged(
+    singles_file,
+    output,
+    preset,
+    spectrum_channel,
+    sources,
+    interactions,
+    collimator,
+    acceptance,
+    nb_runs,
+    nb_heads,
+    seed,
+):
+    """
+    Projections split by source (emission volume) and by interaction history
+    from tagged singles (simulation with tags). One projection per tag:
+    {output}_{tag}.mhd
+    """
+    p = get_digitizer_preset(preset, spectrum_channel)
+    singles = read_singles(singles_file)
+    if "event" not in singles:
+        raise click.UsageError(f"{singles_file} has no tags")
+    if acceptance is None:
+        acceptance = collimator_acceptance[collimator]
+    output = Path(output)
+
+    # tags
+    all_tags = {}
+    if sources is not None:
+        regions = read_source_regions(sources)
+        emission = np.stack(
+            [singles["event_x"], singles["event_y"], singles["event_z"]], axis=1
+        )
+        all_tags["source"] = (
+            get_source_tags(emission, regions),
+            ["other"] + [r["name"] for r in regions],
+        )
+    if interactions is not None:
+        region_events = {
+            region: read_interaction_events(files)
+            for region, files in find_region_files(interactions).items()
+        }
+        print(f"Recorded regions: {list(region_events.keys())}")
+        all_tags["interaction"] = (
+            get_interaction_tags(singles, region_events, acceptance),
+            interaction_classes,
+        )
+
+    # one pass (same blur) for each kind of tags
+    t = time.time()
+    for kind, (tags, names) in all_tags.items():
+        projections = redigitize(
+            singles,
+            p["energy_blur"],
+            p["spatial_blur_fwhm"],
+            p["channels"],
+            p["size"],
+            p["spacing"],
+            nb_runs=nb_runs,
+            nb_heads=nb_heads,
+            orientation_matrix=p["orientation_matrix"],
+            limits=p["limits"],
+            seed=seed,
+            tags=tags,
+            nb_tags=len(names),
+        )
+        for name, proj in zip(names, projections):
+            f = output.with_name(f"{output.stem}_{name}{output.suffix}")
+            write_projections(f, proj, p["spacing"])
+            print(f"{kind} {name}: {int(np.sum(tags == names.index(name)))} singles")
+    print(f"{len(singles['energy'])} singles processed in {time.time() - t:.1f} s")
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
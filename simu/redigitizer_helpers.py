@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+import numpy as np
+from mhd_helpers import write_mhd
+
+# Geant4 internal units (mm, MeV)
+mm = 1.0
+MeV = 1.0
+keV = 1e-3 * MeV
+fwhm_to_sigma = 1.0 / (2.0 * np.sqrt(2.0 * np.log(2.0)))
+
+# columns stored in the singles files
+singles_columns = {
+    "x": np.float32,
+    "y": np.float32,
+    "z": np.float32,
+    "energy": np.float32,
+    "run": np.int32,
+    "head": np.uint8,
+    # optional, only for the tagged singles (see tag_helpers)
+    "gx": np.float32,
+    "gy": np.float32,
+    "gz": np.float32,
+    "event": np.int64,
+    "track": np.int32,
+    "event_x": np.float32,
+    "event_y": np.float32,
+    "event_z": np.float32,
+    # optional, emission energy (line library, see spectral_helpers)
+    "emission_energy": np.float32,
+}
+
+# optional columns: singles column -> ROOT branch
+optional_branches = {
+    "gx": "PostPosition_X",
+    "gy": "PostPosition_Y",
+    "gz": "PostPosition_Z",
+    "event": "EventID",
+    "track": "TrackID",
+    "event_x": "EventPosition_X",
+    "event_y": "EventPosition_Y",
+    "event_z": "EventPosition_Z",
+    "emission_energy": "EventKineticEnergy",
+}
+
+# same values as the add_digitizer_* functions in spect_helpers, the limits
+# are the half-sizes (local x, y, z) of the 5/8" nm670 crystal of the nema001
+# simulations (keep_in_solid_limits)
+wip_projection = {
+    "size": [512, 512],
+    "spacing": [1.1049 * mm, 1.1049 * mm],
+    "limits": [270 * mm, 200 * mm, 7.9375 * mm],
+}
+digitizer_presets = {
+    "Tc99m": {
+        "energy_blur": {
+            "method": "InverseSquare",
+            "resolution": 0.089,
+            "reference_value": 140.57 * keV,
+        },
+        "spatial_blur_fwhm": 7.6 * mm,
+        "channels": [
+            {"name": "spectrum", "min": 3 * keV, "max": 160 * keV},
+            {"name": "scatter", "min": 114 * keV, "max": 126 * keV},
+            {"name": "peak140", "min": 126.45 * keV, "max": 154.55 * keV},
+        ],
+        **wip_projection,
+    },
+    "Lu177": {
+        "energy_blur": {
+            "method": "Linear",
+            "resolution": 0.098,
+            "reference_value": 208 * keV,
+            "slope": 0.052,
+        },
+        "spatial_blur_fwhm": 10.6 * mm,
+        "channels": [
+            {"name": "spectrum", "min": 3 * keV, "max": 250 * keV},
+            {"name": "scatter", "min": 169.1 * keV, "max": 186.9 * keV},
+            {"name": "peak140", "min": 187.2 * keV, "max": 228.8 * keV},
+        ],
+        **wip_projection,
+    },
+    "I131": {
+        "energy_blur": {
+            "method": "InverseSquare",
+            "resolution": 0.089,
+            "reference_value": 140.57 * keV,
+        },
+        "spatial_blur_fwhm": 7.6 * mm,
+        "channels": [
+            {"name": "spectrum", "min": 3 * keV, "max": 800 * keV},
+            {"name": "scatter", "min": 232 * keV, "max": 291 * keV},
+            {"name": "peak364", "min": 291 * keV, "max": 436 * keV},
+        ],
+        **wip_projection,
+    },
+    "intevo_Lu177": {
+        "energy_blur": {
+            "method": "Linear",
+            "resolution": 0.13,
+            "reference_value": 80 * keV,
+            "slope": -0.09 / MeV,
+        },
+        "spatial_blur_fwhm": 3.9 * mm,
+        "channels": [
+            {"name": "spectrum", "min": 3 * keV, "max": 515 * keV},
+            {"name": "scatter1", "min": 96 * keV, "max": 104 * keV},
+            {"name": "peak113", "min": 104.52 * keV, "max": 121.48 * keV},
+            {"name": "scatter2", "min": 122.48 * keV, "max": 133.12 * keV},
+            {"name": "scatter3", "min": 176.46 * keV, "max": 191.36 * keV},
+            {"name": "peak208", "min": 192.4 * keV, "max": 223.6 * keV},
+            {"name": "scatter4", "min": 224.64 * keV, "max": 243.3 * keV},
+        ],
+        "size": [128, 128],
+        "spacing": [4.7951998710632 * mm, 4.7951998710632 * mm],
+        # crystal half-sizes (local x, y, z), keep_in_solid_limits
+        "limits": [4.75 * mm, 266.5 * mm, 193.5 * mm],
+        # Rotation.from_euler("yx", (90, 90), degrees=True).as_matrix()
+        "orientation_matrix": [[0, 0, 1], [1, 0, 0], [0, 1, 0]],
+    },
+}
+
+
+def get_digitizer_preset(name, spectrum_channel=True):
+    """
+    Return a copy of the digitizer parameters, the nema001 simulations use the
+    Tc99m digitizer for the other radionuclides
+    """
+    p = digitizer_presets.get(name, digitizer_presets["Tc99m"])
+    p = {
+        "energy_blur": dict(p["energy_blur"]),
+        "spatial_blur_fwhm": p["spatial_blur_fwhm"],
+        "channels": [dict(c) for c in p["channels"]],
+        "size": list(p["size"]),
+        "spacing": list(p["spacing"]),
+        "orientation_matrix": p.get("orientation_matrix", None),
+        "limits": p.get("limits", None),
+    }
+    if not spectrum_channel:
+        p["channels"].pop(0)
+    return p
+
+
+def convert_singles_root_to_npz(root_filenames, output_filename, tree_names=None):
+    """
+    Convert the ROOT singles written by the adder (one file per head, the
+    head index is the position in the list) into one compact columnar file.
+    The number of heads is also stored: a head may have no singles.
+    """
+    columns = read_singles_root(root_filenames, tree_names)
+    np.savez(output_filename, nb_heads=len(root_filenames), **columns)
+    return columns
+
+
+def get_local_positions(positions, run, rotations, translations):
+    """
+    Local positions (3, n) of world positions (3, n), with the rotation (local
+    to world) and translation of the volume at the run of each position
+    """
+    r = np.asarray(rotations, dtype=np.float64)[run]
+    t = np.asarray(translations, dtype=np.float64)[run]
+    return np.einsum("nji,nj->in", r, positions.T - t)
+
+
+def read_singles_root(root_filenames, tree_names=None, transforms=None):
+    """
+    Columns (see singles_columns) of the ROOT singles, one file per head.
+    The adder PostPositionLocal is the one of the hit with the largest
+    deposit, not the energy-weighted centroid (PostPosition) that the
+    DigitizerProjectionActor bins: with the transforms of the volume of each
+    head (see spect_helpers.get_singles_transforms), the local positions are
+    computed from the centroid instead.
+    """
+    import uproot
+
+    columns = {k: [] for k in singles_columns}
+    position = "PostPosition" if transforms is not None else "PostPositionLocal"
+    for head, filename in enumerate(root_filenames):
+        f = uproot.open(filename)
+        if tree_names is None:
+            # only one tree in the singles files
+            tree = f[f.keys()[0]]
+        else:
+            tree = f[tree_names[head]]
+        branches = [
+            f"{position}_X",
+            f"{position}_Y",
+            f"{position}_Z",
+            "TotalEnergyDeposit",
+            "RunID",
+        ]
+        keys = tree.keys()
+        branches += [
+            b for b in optional_branches.values() if b in keys and b not in branches
+        ]
+        data = tree.arrays(branches, library="np")
+        pos = np.stack([data[f"{position}_{a}"] for a in "XYZ"]).astype(np.float64)
+        if transforms is not None:
+            rotations, translations = transforms[head]
+            pos = get_local_positions(pos, data["RunID"], rotations, translations)
+        columns["x"].append(pos[0])
+        columns["y"].append(pos[1])
+        columns["z"].append(pos[2])
+        columns["energy"].append(data["TotalEnergyDeposit"])
+        columns["run"].append(data["RunID"])
+        columns["head"].append(np.full(len(data["RunID"]), head))
+        for k, b in optional_branches.items():
+            if b in data:
+                columns[k].append(data[b])
+    # the optional columns are kept only if they are in all files
+    for k in optional_branches:
+        if len(columns[k]) != len(columns["run"]):
+            del columns[k]
+    return {k: np.concatenate(v).astype(singles_columns[k]) for k, v in columns.items()}
+
+
+def read_singles(filename):
+    with np.load(filename) as f:
+        return {k: f[k] for k in f.files}
+
+
+def get_nb_heads(singles):
+    # (files converted before the number of heads was stored: from the singles)
+    if "nb_heads" in singles:
+        return int(singles["nb_heads"])
+    head = singles["head"]
+    return int(head.max()) + 1 if len(head) > 0 else 1
+
+
+def get_energy_resolution(energy, method, resolution, reference_value, slope=0):
+    # same models as the DigitizerBlurringActor
+    if method == "InverseSquare":
+        return resolution * np.sqrt(reference_value / energy)
+    if method == "Linear":
+        return slope * (energy - reference_value) + resolution
+    raise ValueError(f"Unknown energy blur method {method}")
+
+
+def blur_energy(energy, rng, method, resolution, reference_value, slope=0):
+    r = get_energy_resolution(energy, method, resolution, reference_value, slope)
+    sigma = r * energy * fwhm_to_sigma
+    return energy + sigma * rng.standard_normal(len(energy))
+
+
+def blur_position(pos, rng, fwhm, limits=None):
+    """
+    Blur the local positions (3, n), then clip them to the crystal half-sizes
+    when given (as keep_in_solid_limits of the spatial blurring actor)
+    """
+    sigma = fwhm * fwhm_to_sigma
+    pos = pos + sigma * rng.standard_normal(pos.shape)
+    if limits is not None:
+        limits = np.asarray(limits, dtype=np.float64)[:, None]
+        pos = np.clip(pos, -limits, limits)
+    return pos
+
+
+def bin_projections(
+    x, y, energy, slot, channels, size, spacing, nb_slots, nb_heads=1, head=None
+):
+    """
+    Bin the singles into the projection stacks with the same layout as the
+    DigitizerProjectionActor: for each head, one slice per (slot, channel),
+    slice index is slot * nb_channels + channel.
+    Return an array (nb_heads, nb_slots * nb_channels, size[1], size[0]).
+    """
+    nb_channels = len(channels)
+    ix = np.floor(x / spacing[0] + size[0] / 2.0).astype(np.int64)
+    iy = np.floor(y / spacing[1] + size[1] / 2.0).astype(np.int64)
+    inside = (ix >= 0) & (ix < size[0]) & (iy >= 0) & (iy < size[1])
+    inside &= (slot >= 0) & (slot < nb_slots)
+    if head is None:
+        head = np.zeros(len(x), dtype=np.int64)
+    pixel = iy * size[0] + ix
+    nb_pixels = size[0] * size[1]
+    n = nb_heads * nb_slots * nb_channels * nb_pixels
+    counts = np.zeros(n, dtype=np.float64)
+    for c, channel in enumerate(channels):
+        mask = inside & (energy >= channel["min"]) & (energy < channel["max"])
+        index = ((head[mask] * nb_slots + slot[mask]) * nb_channels + c) * nb_pixels
+        index += pixel[mask]
+        counts += np.bincount(index, minlength=n)
+    return counts.reshape(
+        (nb_heads, nb_slots * nb_channels, size[1], size[0])
+    ).astype(np.float32)
+
+
+def redigitize(
+    singles,
+    energy_blur,
+    spatial_blur_fwhm,
+    channels,
+    size,
+    spacing,
+    nb_runs=None,
+    orientation_matrix=None,
+    limits=None,
+    seed=None,
+    tags=None,
+    nb_tags=None,
+    nb_heads=None,
+):
+    """
+    Apply energy blur, spatial blur, energy windows and projection binning to
+    the stored (un-blurred) singles, all in vectorized numpy.
+    limits are the crystal half-sizes in the local frame of the singles.
+    nb_heads is the number of heads of the simulation (default: the one of
+    the singles file, see get_nb_heads), there is one projection per head
+    even without singles.
+    With tags (one integer per single, see tag_helpers), the singles are
+    blurred once and binned in one projection per tag, the result has an
+    additional first dimension (nb_tags).
+    """
+    rng = np.random.default_rng(seed)
+    pos = np.stack([singles["x"], singles["y"], singles["z"]]).astype(np.float64)
+    pos = blur_position(pos, rng, spatial_blur_fwhm, limits)
+    if orientation_matrix is not None:
+        # the columns of the detector_orientation_matrix are the local axes of
+        # the image x, y and z (the thickness, see compute_thickness of the
+        # DigitizerProjectionActor): the image coordinates use its transpose
+        pos = np.asarray(orientation_matrix).T @ pos
+    x, y = pos[0], pos[1]
+    energy = singles["energy"].astype(np.float64)
+    energy = blur_energy(energy, rng, **energy_blur)
+    run = singles["run"].astype(np.int64)
+    head = singles["head"].astype(np.int64)
+    if nb_runs is None:
+        nb_runs = int(run.max()) + 1 if len(run) > 0 else 1
+    if nb_heads is None:
+        nb_heads = get_nb_heads(singles)
+    if tags is None:
+        return bin_projections(
+            x, y, energy, run, channels, size, spacing, nb_runs, nb_heads, head
+        )
+    if nb_tags is None:
+        nb_tags = int(tags.max()) + 1 if len(tags) > 0 else 1
+    projections = []
+    for t in range(nb_tags):
+        m = tags == t
+        projections.append(
+            bin_projections(
+                x[m],
+                y[m],
+                energy[m],
+                run[m],
+                channels,
+                size,
+                spacing,
+                nb_runs,
+                nb_heads,
+                head[m],
+            )
+        )
+    return np.stack(projections)
+
+
+def write_projections(output_filename, projections, spacing):
+    """
+    Write one mhd per head, with the same name pattern as the simulations:
+    {name}_{head}.mhd when there are several heads
+    """
+    output_filename = Path(output_filename)
+    nb_heads = projections.shape[0]
+    size = projections.shape[-2:]
+    origin = [
+        -size[1] * spacing[0] / 2.0 + spacing[0] / 2.0,
+        -size[0] * spacing[1] / 2.0 + spacing[1] / 2.0,
+        0,
+    ]
+    filenames = []
+    for h in range(nb_heads):
+        f = output_filename
+        if nb_heads > 1:
+            f = f.with_name(f"{f.stem}_{h}{f.suffix}")
+        write_mhd(f, projections[h], [spacing[0], spacing[1], 1], origin)
+        filenames.append(f)
+    return filenames
+
+
+def project_intevo_singles(
+    root_filenames, output_filename, nb_runs, transforms, seed=None
+):
+    """
+    Projections of the fast intevo digitizer (add_digitizer_intevo_lu177
+    mode="fast"): the energy blur, spatial blur, 7 energy windows and binning
+    of the stored singles in one pass, same layout and file names as the
+    DigitizerProjectionActor ({name}_{head}.mhd when several heads).
+    nb_runs is the number of runs of the simulation (runs without singles
+    give empty slices). transforms (spect_helpers.get_singles_transforms)
+    give the local positions of the centroids, as the full chain.
+    """
+    p = get_digitizer_preset("intevo_Lu177")
+    singles = read_singles_root(root_filenames, transforms=transforms)
+    projections = redigitize(
+        singles,
+        p["energy_blur"],
+        p["spatial_blur_fwhm"],
+        p["channels"],
+        p["size"],
+        p["spacing"],
+        nb_runs=nb_runs,
+        orientation_matrix=p["orientation_matrix"],
+        limits=p["limits"],
+        seed=seed,
+        nb_heads=len(root_filenames),
+    )
+    return write_projections(output_filename, projections, p["spacing"])
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from pathlib import Path
+import numpy as np
+from parallel_helpers import get_available_cores
+
+# wall time model of one simulation (one process), in seconds:
+# wall = init + init_per_thread * t + per_run * R + events * (serial + parallel / t)
+# (t threads, R run intervals). The columns are added to the fit in this
+# order, only when they are not a combination of the previous ones
+model_terms = ["init", "parallel", "serial", "init_per_thread", "per_run"]
+
+
+def get_model_features(threads, runs, events):
+    threads = np.asarray(threads, dtype=np.float64)
+    runs = np.asarray(runs, dtype=np.float64)
+    events = np.asarray(events, dtype=np.float64)
+    return {
+        "init": np.ones_like(threads),
+        "parallel": events / threads,
+        "serial": events,
+        "init_per_thread": threads,
+        "per_run": runs,
+    }
+
+
+def fit_scaling_model(records):
+    """
+    Least squares fit of the wall time model on the measurements (threads,
+    runs, events, wall_time). The terms that cannot be identified from the
+    measurements (e.g. per_run when all have the same number of runs) or
+    that come out negative are set to zero.
+    Also fit the peak memory per process: rss = rss0 + rss_per_thread * t.
+    """
+    features = get_model_features(
+        [r["threads"] for r in records],
+        [r["runs"] for r in records],
+        [r["events"] for r in records],
+    )
+    wall = np.array([r["wall_time"] for r in records], dtype=np.float64)
+    terms = []
+    for term in model_terms:
+        # (columns normalized, nearly collinear columns are not identified,
+        # e.g. init and serial when all the durations are the same)
+        a = np.stack([features[k] for k in terms + [term]], axis=1)
+        a = a / np.linalg.norm(a, axis=0)
+        if np.linalg.matrix_rank(a, tol=1e-2) == len(terms) + 1:
+            terms.append(term)
+    while True:
+        a = np.stack([features[k] for k in terms], axis=1)
+        coef, *_ = np.linalg.lstsq(a, wall, rcond=None)
+        negative = [k for k, c in zip(terms, coef) if c < 0 and k != "init"]
+        if not negative:
+            break
+        terms.remove(negative[0])
+    model = {k: 0.0 for k in model_terms}
+    model.update({k: float(c) for k, c in zip(terms, coef)})
+    model["identified"] = terms
+    predicted = predict_wall_time(
+        model,
+        [r["threads"] for r in records],
+        [r["runs"] for r in records],
+        [r["events"] for r in records],
+    )
+    model["rms_residual"] = float(np.sqrt(np.mean((predicted - wall) ** 2)))
+
+    # memory
+    threads = np.array([r["threads"] for r in records], dtype=np.float64)
+    rss = np.array([r["peak_rss_mb"] for r in records], dtype=np.float64)
+    model["rss0_mb"] = float(rss.mean())
+    model["rss_per_thread_mb"] = 0.0
+    if len(np.unique(threads)) > 1:
+        a = np.stack([np.ones_like(threads), threads], axis=1)
+        (m0, m1), *_ = np.linalg.lstsq(a, rss, rcond=None)
+        model["rss0_mb"], model["rss_per_thread_mb"] = float(m0), max(0.0, float(m1))
+
+    # emitted events per simulated second (same for all the layouts)
+    model["event_rate"] = float(
+        sum(r["events"] for r in records) / sum(r["duration"] for r in records)
+    )
+    return model
+
+
+def predict_wall_time(model, threads, runs, events):
+    f = get_model_features(threads, runs, events)
+    return sum(model[k] * f[k] for k in model_terms)
+
+
+def get_available_memory_mb():
+    # MemAvailable from /proc (Linux only, None when not available)
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def choose_layout(
+    model,
+    duration,
+    runs=1,
+    nb_cores=None,
+    memory_mb=None,
+    split_runs=False,
+    max_processes=None,
+):
+    """
+    Number of processes and threads per process with the shortest predicted
+    wall time for an acquisition of the given duration (s) and number of
+    runs, split between the processes (time slices, or the runs themselves
+    with split_runs as in test003_parallel), on the cores (default: the cores
+    available to this process) and within the memory (default: available
+    memory). Each process simulates 1/p of the events.
+    """
+    if nb_cores is None:
+        nb_cores = get_available_cores()
+    if memory_mb is None:
+        memory_mb = get_available_memory_mb()
+    if max_processes is None:
+        max_processes = nb_cores
+    if split_runs:
+        max_processes = min(max_processes, runs)
+    events = model["event_rate"] * duration
+    best = None
+    for p in range(1, min(nb_cores, max_processes) + 1):
+        for t in range(1, nb_cores // p + 1):
+            rss = model["rss0_mb"] + model["rss_per_thread_mb"] * t
+            if memory_mb is not None and p > 1 and p * rss > memory_mb:
+                continue
+            r = int(np.ceil(runs / p)) if split_runs else runs
+            wall = float(predict_wall_time(model, t, r, events / p))
+            # (with the same time, fewer cores is better)
+            if best is None or wall < best["wall_time"] * (1 - 1e-3):
+                best = {
+                    "processes": p,
+                    "threads": t,
+                    "wall_time": wall,
+                    "pps": events / wall if wall > 0 else None,
+                    "rss_mb": p * rss,
+                }
+    best["cores"] = nb_cores
+    return best
+
+
+def check_activity_normalization(records, nb_sigma=5):
+    """
+    The total activity (all threads) and the emitted events per simulated
+    second must not depend on the number of threads: return the list of the
+    records that differ (message per record)
+    """
+    messages = []
+    activity = np.median([r["total_activity"] for r in records])
+    for r in records:
+        if abs(r["total_activity"] - activity) > 1e-6 * abs(activity):
+            messages.append(
+                f"{r['threads']} threads: total activity {r['total_activity']:.6g} Bq"
+                f" != {activity:.6g} Bq"
+            )
+    # (median: one wrong record does not shift the others)
+    rate = np.median([r["events"] / r["duration"] for r in records])
+    for r in records:
+        expected = rate * r["duration"]
+        z = (r["events"] - expected) / np.sqrt(max(expected, 1))
+        if abs(z) > nb_sigma:
+            messages.append(
+                f"{r['threads']} threads, {r['runs']} runs: {r['events']} events, "
+                f"{expected:.0f} expected ({z:+.1f} sigma)"
+            )
+    return messages
+
+
+def read_scaling_records(filename):
+    filename = Path(filename)
+    if not filename.exists():
+        return []
+    with open(filename) as f:
+        return json.load(f)
+
+
+def write_json(filename, data):
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def read_scaling_model(filename):
+    with open(filename) as f:
+        return json.load(f)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import platform
+from pathlib import Path
+import click
+from parallel_helpers import run_in_processes, get_available_cores
+from benchmark import benchmark_scenarios
+from scaling_helpers import *
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+# production duration (sec) of the nema001 acquisition, always one run
+nema001_duration = 300
+
+
+def run_scaling_point(scenario, number_of_threads, duration_factor, runs, output_dir):
+    # executed in its own process (Geant4 can only be run once per process)
+    import importlib
+    import opengate as gate
+    from spect_helpers import get_total_activity
+    from stats_helpers import read_stats_file
+    from profile_helpers import (
+        PhaseTimer,
+        run_profiled,
+        get_profile_report,
+        read_profile_report,
+    )
+
+    sec = gate.g4_units.s
+    Bq = gate.g4_units.Bq
+    if scenario == "nema001":
+        from nema001_spatial_resolution import run_simulation
+
+        # default configuration, a time slice of the acquisition
+        nb_slices = max(1, round(1 / duration_factor))
+        outputs = run_simulation(
+            "X",
+            4.6,
+            0.0,
+            "1_source",
+            False,
+            "lehr",
+            "Tc99m",
+            number_of_threads=number_of_threads,
+            simu_name="scaling_nema001",
+            output_dir=output_dir,
+            time_slice=(0, nb_slices),
+            use_cache=False,
+            profile=True,
+        )
+        report = read_profile_report(outputs["profile"])
+        total_activity = outputs["activity"]
+        duration = outputs["acquisition_time"]
+    else:
+        module_name, function_name, production_duration = benchmark_scenarios[scenario]
+        set_simulation = getattr(importlib.import_module(module_name), function_name)
+        timer = PhaseTimer()
+        timer.start("build")
+        sim = gate.Simulation()
+        simu_name = f"scaling_{scenario}"
+        duration = production_duration * duration_factor
+        if scenario == "test003":
+            set_simulation(
+                sim, simu_name, number_of_threads, duration * sec, nb_angles=runs
+            )
+        else:
+            set_simulation(sim, simu_name, number_of_threads, duration * sec)
+            # same time in several runs (static geometry)
+            start, end = sim.run_timing_intervals[0]
+            step = (end - start) / runs
+            sim.run_timing_intervals = [
+                [start + i * step, start + (i + 1) * step] for i in range(runs)
+            ]
+        sim.output_dir = Path(output_dir)
+        sim.progress_bar = False
+        run_profiled(sim, timer)
+        stats = read_stats_file(Path(output_dir) / f"{simu_name}_stats.txt")
+        report = get_profile_report(sim, timer, stats)
+        total_activity = get_total_activity(sim) / Bq
+
+    phases = report["phases"]
+    return {
+        "scenario": scenario,
+        "threads": number_of_threads,
+        "runs": runs,
+        "duration": duration,
+        "events": report["events"],
+        "pps": report["pps"],
+        "wall_time": sum(p["wall"] for p in phases.values()),
+        "init_time": phases.get("initialization", {}).get("wall"),
+        "cpu_per_wall": sum(p["cpu"] for p in phases.values())
+        / sum(p["wall"] for p in phases.values()),
+        "peak_rss_mb": report["peak_rss_mb"],
+        "total_activity": total_activity,
+    }
+
+
+def get_records_filename(output_dir, scenario):
+    return Path(output_dir) / f"{scenario}_scaling.json"
+
+
+def get_model_filename(output_dir, scenario):
+    return Path(output_dir) / f"{scenario}_scaling_model.json"
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def go():
+    """
+    Thread and run scaling of a scenario: measure the wall time for several
+    nb of threads and of run intervals (one process at a time), fit a model
+    (initialization overhead, per-thread and per-run overhead, serial and
+    parallel cost per event), and choose the nb of processes x threads for
+    this host. The total activity does not depend on the nb of threads, so
+    the layout does not change the results (checked by fit).
+    """
+    pass
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "--scenario",
+    "-s",
+    default="test003",
+    type=click.Choice(list(benchmark_scenarios.keys()) + ["nema001"]),
+)
+@click.option(
+    "--threads",
+    "-t",
+    multiple=True,
+    type=int,
+    default=[1, 2, 4, 8],
+    help="Nb of threads",
+)
+@click.option(
+    "--runs", "-r", multiple=True, type=int, default=[1], help="Nb of run intervals"
+)
+@click.option(
+    "--duration_factor",
+    "-f",
+    multiple=True,
+    type=float,
+    default=[0.05],
+    help="Fraction of the production acquisition time to simulate",
+)
+@click.option("--output_dir", "-o", default="scaling", help="Output folder")
+def measure(scenario, threads, runs, duration_factor, output_dir):
+    """
+    Run the scenario for all the (threads, runs, duration) and append the
+    measurements to {scenario}_scaling.json
+    """
+    cores = get_available_cores()
+    if scenario == "nema001" and runs != (1,):
+        raise click.UsageError("nema001 is always simulated in one run")
+    tasks = []
+    for t in threads:
+        if t > cores:
+            print(f"Warning: {t} threads but {cores} available cores")
+        for r in runs:
+            for f in duration_factor:
+                tasks.append(
+                    {
+                        "scenario": scenario,
+                        "number_of_threads": t,
+                        "duration_factor": f,
+                        "runs": r,
+                        "output_dir": str(
+                            Path(output_dir) / scenario / f"t{t}_r{r}_f{f:g}"
+                        ),
+                    }
+                )
+    filename = get_records_filename(output_dir, scenario)
+    records = read_scaling_records(filename)
+    for i, outcome in run_in_processes(run_scaling_point, tasks, 1):
+        if outcome["status"] != "done":
+            print(f"{tasks[i]} failed: {outcome['error']}")
+            continue
+        r = outcome["result"]
+        r["host"] = platform.node()
+        r["cores"] = cores
+        r["date"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        records.append(r)
+        print(
+            f"{r['threads']:3d} threads {r['runs']:3d} runs: PPS = {r['pps']}  "
+            f"wall = {r['wall_time']:.1f} s  cpu/wall = {r['cpu_per_wall']:.2f}"
+        )
+        # written after each measurement, an interrupted study is not lost
+        write_json(filename, records)
+    print(f"Measurements written to {filename}")
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "--scenario",
+    "-s",
+    default="test003",
+    type=click.Choice(list(benchmark_scenarios.keys()) + ["nema001"]),
+)
+@click.option("--output_dir", "-o", default="scaling", help="Output folder")
+@click.option(
+    "--all_hosts", is_flag=True, default=False, help="Also use the other hosts"
+)
+def fit(scenario, output_dir, all_hosts):
+    """
+    Fit the wall time model on the measurements, check the activity
+    normalization and write {scenario}_scaling_model.json
+    """
+    records = read_scaling_records(get_records_filename(output_dir, scenario))
+    if not all_hosts:
+        records = [r for r in records if r["host"] == platform.node()]
+    if not records:
+        raise click.UsageError(f"No measurement of {scenario} for this host")
+
+    # the layout must not change the results
+    messages = check_activity_normalization(records)
+    for m in messages:
+        print(f"Activity normalization: {m}")
+    if not messages:
+        print("Activity normalization: same total activity for all the layouts")
+
+    model = fit_scaling_model(records)
+    for k in model_terms:
+        status = "" if k in model["identified"] else " (not identified)"
+        print(f"{k:<16} {model[k]:.4g}{status}")
+    print(f"RMS residual {model['rms_residual']:.2f} s")
+    for r in records:
+        w = float(predict_wall_time(model, r["threads"], r["runs"], r["events"]))
+        print(
+            f"{r['threads']:3d} threads {r['runs']:3d} runs: "
+            f"wall {r['wall_time']:8.1f} s  model {w:8.1f} s  "
+            f"PPS {r['events'] / r['wall_time']:10.0f}"
+        )
+    model["scenario"] = scenario
+    model["host"] = platform.node()
+    model["nb_records"] = len(records)
+    model["normalization"] = messages
+    filename = get_model_filename(output_dir, scenario)
+    write_json(filename, model)
+    print(f"Model written to {filename}")
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "--scenario",
+    "-s",
+    default="test003",
+    type=click.Choice(list(benchmark_scenarios.keys()) + ["nema001"]),
+)
+@click.option("--output_dir", "-o", default="scaling", help="Output folder")
+@click.option("--duration", "-d", default=None, type=float, help="Acquisition time (s)")
+@click.option("--runs", "-r", default=None, type=int, help="Nb of run intervals")
+@click.option("--cores", default=None, type=int, help="Nb of cores (default: all)")
+@click.option(
+    "--split_runs",
+    is_flag=True,
+    default=False,
+    help="The runs are split between the processes (as test003_parallel)",
+)
+def layout(scenario, output_dir, duration, runs, cores, split_runs):
+    """
+    Nb of processes x threads with the shortest predicted wall time for the
+    production acquisition on this host
+    """
+    model = read_scaling_model(get_model_filename(output_dir, scenario))
+    if duration is None:
+        duration = (
+            nema001_duration
+            if scenario == "nema001"
+            else benchmark_scenarios[scenario][2]
+        )
+    if runs is None:
+        runs = 60 if scenario == "test003" else 1
+    if cores is None:
+        cores = get_available_cores()
+    best = choose_layout(model, duration, runs, cores, split_runs=split_runs)
+    # the two extreme layouts, for comparison
+    events = model["event_rate"] * duration
+    for p, t in [(1, cores), (cores, 1)]:
+        if split_runs and p > runs:
+            continue
+        r = -(-runs // p) if split_runs else runs
+        w = float(predict_wall_time(model, t, r, events / p))
+        print(f"{p:3d} processes x {t:3d} threads: {w:8.1f} s")
+    print(
+        f"Best: {best['processes']} processes x {best['threads']} threads, "
+        f"{best['wall_time']:.1f} s, {best['rss_mb']:.0f} MB "
+        f"({cores} cores, model of {model['host']})"
+    )
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+import click
+from parallel_helpers import run_in_processes
+from benchmark import benchmark_scenarios
+from profile_helpers import *
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+# set function arguments of the variants that change the runs (only test003
+# has several runs): all the time in one run, one run interval alone
+static_geometry_arguments = {"test003": {"nb_angles": 1}}
+single_run_argument = {"test003": "angle_indices"}
+
+
+def run_profile_variant(
+    scenario,
+    number_of_threads,
+    duration,
+    output_dir,
+    variant,
+    digitizer="full",
+    arguments=None,
+):
+    # executed in its own process (Geant4 can only be run once per process)
+    import importlib
+    import opengate as gate
+    from stats_helpers import read_stats_file
+
+    sec = gate.g4_units.s
+    module_name, function_name, _ = benchmark_scenarios[scenario]
+    set_simulation = getattr(importlib.import_module(module_name), function_name)
+
+    # create the simulation
+    timer = PhaseTimer()
+    timer.start("build")
+    sim = gate.Simulation()
+    simu_name = f"profile_{scenario}"
+    set_simulation(
+        sim,
+        simu_name,
+        number_of_threads,
+        duration * sec,
+        digitizer=digitizer,
+        **(arguments or {}),
+    )
+    sim.output_dir = Path(output_dir)
+    sim.progress_bar = False
+
+    # ablation: the reference without some actors or outputs
+    if variant.startswith("digitizer_depth_"):
+        depth = int(variant[len("digitizer_depth_") :])
+        depths = get_digitizer_depths(sim)
+        remove_actors(sim, [n for n, d in depths.items() if d > depth])
+    if variant.startswith("without_"):
+        remove_actors(sim, [variant[len("without_") :]])
+    if variant == "no_output":
+        disable_outputs(sim)
+
+    # go
+    run_profiled(sim, timer)
+    stats = read_stats_file(Path(output_dir) / f"{simu_name}_stats.txt")
+    report = get_profile_report(sim, timer, stats)
+    report["scenario"] = scenario
+    report["variant"] = variant
+    report["digitizer"] = digitizer
+    write_profile_report(Path(output_dir) / f"{simu_name}_profile.json", report)
+    return report
+
+
+def get_ablation_variants(reference, scenario, runs):
+    """
+    Variants (name, set function arguments) to run after the reference
+    """
+    depths = reference["digitizer_depths"]
+    variants = [
+        (f"digitizer_depth_{k}", None)
+        for k in range(max(depths.values(), default=0) - 1, -1, -1)
+    ]
+    for name in reference["actors"]:
+        if name not in depths and name != "stats":
+            variants.append((f"without_{name}", None))
+    variants.append(("no_output", None))
+    if reference["nb_runs"] > 1 and scenario in static_geometry_arguments:
+        variants.append(("static_geometry", static_geometry_arguments[scenario]))
+    if scenario in single_run_argument:
+        for k in runs:
+            variants.append((f"run_{k}", {single_run_argument[scenario]: [k]}))
+    return variants
+
+
+def print_costs(costs):
+    for name, c in costs.items():
+        if name == "runs":
+            for k, r in c.items():
+                print(f"{k:<45} {r['wall_us_per_event']} us/event (alone)")
+            continue
+        wall = c["wall_us_per_event"]
+        cpu = c["cpu_us_per_event"]
+        if wall is None:
+            print(f"{name:<45} (not measured)")
+            continue
+        print(f"{name:<45} {wall:10.2f} us/event wall {cpu:10.2f} us/event cpu")
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "--scenario",
+    "-s",
+    default="test003",
+    type=click.Choice(list(benchmark_scenarios.keys())),
+    help="Scenario to profile",
+)
+@click.option("--threads", "-t", default=4, help="Nb of threads")
+@click.option(
+    "--duration_factor",
+    "-f",
+    default=0.05,
+    help="Fraction of the production acquisition time to simulate",
+)
+@click.option(
+    "--digitizer",
+    "-d",
+    type=click.Choice(["full", "lean", "fast"]),
+    default="full",
+    help="Digitizer mode (see add_digitizer_intevo_lu177)",
+)
+@click.option(
+    "--ablation/--no_ablation",
+    default=True,
+    help="Also run the variants without each digitizer stage, actor and output",
+)
+@click.option(
+    "--run",
+    "-r",
+    "runs",
+    multiple=True,
+    type=int,
+    help="Also simulate this run interval alone (test003 angle index), can be "
+    "repeated",
+)
+@click.option("--output_dir", "-o", default="profile", help="Output folder")
+def go(scenario, threads, duration_factor, digitizer, ablation, runs, output_dir):
+    """
+    Wall and CPU time of the build, initialization, transport and output
+    phases of a scenario, and (ablation) the cost per event of each digitizer
+    module, actor, output, dynamic geometry and run interval: each variant is
+    the reference simulation without one stage, run one after the other in
+    its own process. Each variant writes {simu_name}_profile.json next to its
+    stats, the summary is written in the output folder.
+    """
+    output_dir = Path(output_dir)
+    duration = benchmark_scenarios[scenario][2] * duration_factor
+    name = f"{scenario}_t{threads}_{digitizer}"
+
+    def run_variants(variants):
+        tasks = [
+            {
+                "scenario": scenario,
+                "number_of_threads": threads,
+                "duration": duration,
+                "output_dir": str(output_dir / name / v),
+                "variant": v,
+                "digitizer": digitizer,
+                "arguments": a,
+            }
+            for v, a in variants
+        ]
+        reports = {}
+        for i, outcome in run_in_processes(run_profile_variant, tasks, 1):
+            v = tasks[i]["variant"]
+            if outcome["status"] != "done":
+                print(f"{v} failed: {outcome['error']}")
+                continue
+            r = outcome["result"]
+            reports[v] = r
+            print(
+                f"{v:<45} {r['events']} events, {r['us_per_event']} us/event wall, "
+                f"{r['cpu_us_per_event']} us/event cpu"
+            )
+        return reports
+
+    # reference first, it gives the actors and the digitizer chains
+    reports = run_variants([("reference", None)])
+    if "reference" not in reports:
+        raise SystemExit(1)
+    for phase, p in reports["reference"]["phases"].items():
+        print(f"{phase:<15} wall {p['wall']:8.2f} s  cpu {p['cpu']:8.2f} s")
+    if ablation or runs:
+        variants = get_ablation_variants(reports["reference"], scenario, runs)
+        if not ablation:
+            variants = [v for v in variants if v[0].startswith("run_")]
+        reports.update(run_variants(variants))
+
+    # summary
+    costs = get_stage_costs(reports)
+    print_costs(costs)
+    filename = output_dir / f"{name}_profile.json"
+    write_profile_report(filename, {"reports": reports, "costs": costs})
+    print(f"Profile written to {filename}")
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
@@ -1,17 +1,68 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import re
+import json
+import numpy as np
 import opengate as gate
 from scipy.spatial.transform import Rotation
 import opengate.contrib.spect.siemens_intevo as intevo
 from opengate.actors.digitizers import Digitizer
 from opengate.sources.utility import get_spectrum
 
+# see add_digitizer_intevo_lu177
+digitizer_modes = ["full", "lean", "fast"]
 
-def add_digitizer_intevo_lu177(sim, name, crystal_name):
+
+def store_digitizer_singles(hits, singles, filename, tags=False, lean=False):
+    """
+    Write the (un-blurred) adder singles for offline re-digitization, see
+    redigitizer_helpers. The local position and the run id are added to the
+    hits attributes so that the singles can be binned into projections, and
+    the emission energy to get the response of each
+    line of a line library source (see spectral_helpers).
+    With tags, the emission position, the event/track ids and the global
+    position are also stored, to tag each single by source and interaction
+    history (see tag_helpers and add_interaction_recording).
+    With lean, the emission energy is not stored (only what the projection
+    needs).
+    """
+    attributes = list(hits.attributes)
+    new_attributes = [
+        "PostPositionLocal",
+        "RunID",
+    ]
+    if not lean:
+        new_attributes.append("EventKineticEnergy")
+    if tags:
+        new_attributes += ["PostPosition", "EventID", "TrackID", "EventPosition"]
+    for att in new_attributes:
+        if att not in attributes:
+            attributes.append(att)
+    hits.attributes = attributes
+    singles.output_filename = filename
+
+
+def add_digitizer_intevo_lu177(
+    sim, name, crystal_name, singles_filename=None, tags=False, mode="full"
+):
     """
     FIXME : to put contrib.spect.siemens_intevo
+
+    mode (see digitizer_modes):
+    - full: the complete chain of actors, return the projection actor
+    - lean: same chain, but only the hits attributes needed by the adder and
+      without the unit efficiency stage, return the projection actor
+    - fast: lean hits and adder only, the singles are written to
+      singles_filename and the blur, energy windows and binning are done
+      after the run in one pass (redigitizer_helpers.project_intevo_singles),
+      return the singles actor
     """
+    if mode not in digitizer_modes:
+        raise ValueError(f"Unknown digitizer mode {mode}, use {digitizer_modes}")
+    if mode == "fast" and singles_filename is None:
+        raise ValueError("The fast digitizer mode needs a singles filename")
+
     # hits
     hits = sim.add_actor("DigitizerHitsCollectionActor", f"hits_{name}")
     hits.attached_to = crystal_name
@@ -23,6 +74,9 @@ def add_digitizer_intevo_lu177(sim, name, crystal_name):
         "PostStepUniqueVolumeID",
         "GlobalTime",
     ]
+    if mode != "full":
+        # the adder only needs the energy, position, volume and time
+        hits.attributes.remove("PostStepUniqueVolumeID")
 
     # singles
     singles = sim.add_actor("DigitizerAdderActor", f"singles_{name}")
@@ -32,14 +86,23 @@ def add_digitizer_intevo_lu177(sim, name, crystal_name):
     singles.policy = "EnergyWeightedCentroidPosition"
     singles.output_filename = ""  # No output
     singles.group_volume = None
-
-    # efficiency actor
-    eff = sim.add_actor("DigitizerEfficiencyActor", f"singles_{name}_eff")
-    eff.attached_to = crystal_name
-    eff.input_digi_collection = singles.name
-    eff.efficiency = 0.86481  # FIXME probably wrong, to evaluate
-    eff.efficiency = 1.0
-    eff.output_filename = ""  # No output
+    if singles_filename is not None:
+        store_digitizer_singles(
+            hits, singles, singles_filename, tags, lean=(mode == "fast")
+        )
+    if mode == "fast":
+        return singles
+
+    # efficiency actor (a unit efficiency only copies the singles)
+    efficiency = 0.86481  # FIXME probably wrong, to evaluate
+    efficiency = 1.0
+    eff = singles
+    if mode == "full" or efficiency != 1.0:
+        eff = sim.add_actor("DigitizerEfficiencyActor", f"singles_{name}_eff")
+        eff.attached_to = crystal_name
+        eff.input_digi_collection = singles.name
+        eff.efficiency = efficiency
+        eff.output_filename = ""  # No output
 
     # energy blur
     keV = gate.g4_units.keV
@@ -101,9 +164,10 @@ def add_digitizer_intevo_lu177(sim, name, crystal_name):
     return proj
 
 
-def add_intevo_two_heads(sim, name, colli_type, radius):
+def add_intevo_two_heads(sim, name, colli_type, radius, collimators=None):
     """
     FIXME : to put contrib.spect.siemens_intevo
+    (the collimator volumes are appended to the optional collimators list)
     """
     heads = []
     crystals = []
@@ -113,6 +177,8 @@ def add_intevo_two_heads(sim, name, colli_type, radius):
         )
         heads.append(head)
         crystals.append(crystal)
+        if collimators is not None:
+            collimators.append(colli)
     # this head translation is not used (only to avoid overlap warning at initialisation)
     heads[0].translation = [radius, 0, 0]
     heads[1].translation = [-radius, 0, 0]
@@ -121,13 +187,23 @@ def add_intevo_two_heads(sim, name, colli_type, radius):
 
 
 def rotate_gantry(
-    head, radius, initial_rotation, start_angle_deg, step_angle_deg, nb_angle
+    head,
+    radius,
+    initial_rotation,
+    start_angle_deg,
+    step_angle_deg,
+    nb_angle,
+    angle_indices=None,
 ):
+    # only a subset of the angles may be set (one run per angle)
+    if angle_indices is None:
+        angle_indices = range(nb_angle)
+
     # compute the nb translation and rotation
     translations = []
     rotations = []
-    current_angle_deg = start_angle_deg
-    for r in range(nb_angle):
+    for r in angle_indices:
+        current_angle_deg = start_angle_deg + r * step_angle_deg
         # print(f'Angle {r} = {current_angle_deg}')
         t, rot = gate.geometry.utility.get_transform_orbiting(
             [radius, 0, 0], "Z", current_angle_deg
@@ -137,12 +213,49 @@ def rotate_gantry(
         rot = rot.as_matrix()
         translations.append(t)
         rotations.append(rot)
-        current_angle_deg += step_angle_deg
 
     # set the motion for the SPECT head
     head.add_dynamic_parametrisation(translation=translations, rotation=rotations)
 
 
+def get_volume_world_transforms(sim, name, nb_runs):
+    """
+    Rotations (local to world) and translations of the volume for each run,
+    composed along its mothers: static placement, or one per run for the
+    dynamic ones (rotate_gantry)
+    """
+    rotations = [np.eye(3)] * nb_runs
+    translations = [np.zeros(3)] * nb_runs
+    while name != sim.world.name:
+        v = sim.volume_manager.get_volume(name)
+        rot = [np.asarray(v.rotation, dtype=np.float64)] * nb_runs
+        tr = [np.asarray(v.translation, dtype=np.float64)] * nb_runs
+        for p in (v.dynamic_params or {}).values():
+            if "rotation" in p:
+                rot = [np.asarray(r, dtype=np.float64) for r in p["rotation"]]
+            if "translation" in p:
+                tr = [np.asarray(t, dtype=np.float64) for t in p["translation"]]
+        translations = [r @ t0 + t for r, t, t0 in zip(rot, tr, translations)]
+        rotations = [r @ r0 for r, r0 in zip(rot, rotations)]
+        name = v.mother
+    return rotations, translations
+
+
+def get_singles_transforms(sim):
+    """
+    World transforms (get_volume_world_transforms) of the volume of each
+    adder (one per head, in head order) at each run, to convert the stored
+    centroid positions of the singles to local positions (see
+    redigitizer_helpers.read_singles_root)
+    """
+    nb_runs = len(sim.run_timing_intervals)
+    return [
+        get_volume_world_transforms(sim, a.attached_to, nb_runs)
+        for a in sim.actor_manager.actors.values()
+        if type(a).__name__ == "DigitizerAdderActor"
+    ]
+
+
 def create_wood_material(sim):
     # https://geant4-forum.web.cern.ch/t/how-to-implement-specific-materials-like-pur-and-paper/9184
     # C18 H13 N3 Na2O8 S2
@@ -274,7 +387,191 @@ def add_phantom_spatial_resolution_2sources(sim, name, scatter):
 
     return glass_tube, glass_tube2
 
-def add_source_spatial_resolution(sim, name, container, rad="Lu177", aa_volumes=None):
+def get_source_activities(sim):
+    """
+    Activity of each source for all the threads: each thread simulates its
+    own decays with the activity of the sources, so the set functions divide
+    the activity by the nb of threads
+    """
+    return {
+        name: getattr(s, "activity", 0) * sim.number_of_threads
+        for name, s in sim.source_manager.sources.items()
+    }
+
+
+def get_total_activity(sim):
+    return sum(get_source_activities(sim).values())
+
+
+def set_source_acceptance_angle(source, volumes, skip_policy="SkipEvents"):
+    """
+    Only track the primaries whose direction intersects one of the volumes.
+    The other events are either skipped (SkipEvents) or tracked with a zero
+    energy (ZeroEnergy); in both cases they still consume acquisition time,
+    so the counts per time (and the projections) are not biased.
+    The volumes may move between runs (add_dynamic_parametrisation), the test
+    uses the position of the volumes of the current run.
+    """
+    source.direction.acceptance_angle.volumes = volumes
+    source.direction.acceptance_angle.intersection_flag = True
+    source.direction.acceptance_angle.skip_policy = skip_policy
+
+
+def get_acceptance_angle_events(sim, source_names=None):
+    """
+    Number of events skipped or tracked with zero energy by the acceptance
+    angle of the sources (default: all sources), after the run
+    """
+    if source_names is None:
+        source_names = list(sim.source_manager.sources.keys())
+    skipped = 0
+    zero = 0
+    for name in source_names:
+        source = sim.source_manager.get_source(name)
+        skipped += source.total_skipped_events
+        zero += source.total_zero_events
+    return skipped, zero
+
+
+def add_acceptance_angle_stats(sim, stats_filename, source_names=None):
+    """
+    Append the acceptance angle counts to the stats file, the number of
+    emitted primaries is NumberOfEvents + SkippedEvents
+    """
+    skipped, zero = get_acceptance_angle_events(sim, source_names)
+    with open(stats_filename, "a") as f:
+        f.write(f"# SkippedEvents = {skipped}\n")
+        f.write(f"# ZeroEnergyEvents = {zero}\n")
+    return skipped, zero
+
+
+def get_head_scatter_volumes(sim, head, collimator, crystal):
+    """
+    Daughter volumes of the spect head other than the collimator and the one
+    that contains the crystal (shielding, back compartment, ...)
+    """
+    crystal_ancestors = set()
+    v = crystal
+    while v.mother is not None and v.name != head.name:
+        crystal_ancestors.add(v.name)
+        v = sim.volume_manager.get_volume(v.mother)
+    return [
+        v.name
+        for v in sim.volume_manager.volumes.values()
+        if v.mother == head.name
+        and v.name != collimator.name
+        and v.name not in crystal_ancestors
+    ]
+
+
+def add_interaction_recording(sim, name, regions, filename_prefix):
+    """
+    Record the steps of the gammas in the given regions
+    {region name: [volume names]} (and their daughters), one root file per
+    volume: {filename_prefix}_{region}_{i}.root. Only the steps that are
+    real interactions (not transportation) are used offline, to classify the
+    tagged singles by interaction history (see tag_helpers).
+    Output size: the filters of opengate cannot select the steps by process,
+    so every step of the gammas is written, i.e. one row per interaction and
+    per boundary crossing (one per septum for the collimators), about 30
+    bytes per row before compression with the 4 attributes kept (the minimum
+    to match the singles): a few hundred bytes per gamma reaching the heads,
+    use it for short acquisitions.
+    """
+    gamma_filter = sim.add_filter("ParticleFilter", f"{name}_gamma_filter")
+    gamma_filter.particle = "gamma"
+    actors = []
+    for region, volumes in regions.items():
+        for i, volume in enumerate(volumes):
+            hc = sim.add_actor("DigitizerHitsCollectionActor", f"{name}_{region}_{i}")
+            hc.attached_to = volume
+            hc.attributes = ["RunID", "EventID", "TrackID", "ProcessDefinedStep"]
+            # Rayleigh scattering deposits no energy
+            hc.keep_zero_edep = True
+            hc.filters.append(gamma_filter)
+            hc.output_filename = f"{filename_prefix}_{region}_{i}.root"
+            actors.append(hc)
+    return actors
+
+
+def add_interaction_tagging(sim, heads, collimators, crystals, filename_prefix):
+    """
+    Record the interactions for the tagged singles in three regions: the
+    phantom (all the volumes outside the heads: phantom, plates, table),
+    the collimators and the other volumes of the heads
+    """
+    head_names = [h.name for h in heads]
+    regions = {
+        "phantom": [
+            v.name
+            for v in sim.volume_manager.volumes.values()
+            if v.mother == sim.world.name and v.name not in head_names
+        ],
+        "collimator": [c.name for c in collimators],
+        "head": [],
+    }
+    for head, colli, crystal in zip(heads, collimators, crystals):
+        regions["head"] += get_head_scatter_volumes(sim, head, colli, crystal)
+    return add_interaction_recording(sim, "tags", regions, filename_prefix)
+
+
+def get_world_transform(sim, volume):
+    """
+    Rotation and translation of a volume in the world frame
+    """
+    rot = np.eye(3)
+    t = np.zeros(3)
+    while volume.name != sim.world.name:
+        r = np.eye(3) if volume.rotation is None else np.array(volume.rotation)
+        t = r @ t + np.array(volume.translation)
+        rot = r @ rot
+        volume = sim.volume_manager.get_volume(volume.mother)
+    return rot, t
+
+
+def write_source_regions(sim, filename, source_volumes):
+    """
+    Shape and world position of the volumes matching the source_volumes regex
+    (spheres and cylinders), to tag the singles by emission volume
+    """
+    pattern = re.compile(source_volumes)
+    regions = []
+    for v in sim.volume_manager.volumes.values():
+        if not pattern.search(v.name):
+            continue
+        rot, t = get_world_transform(sim, v)
+        region = {"name": v.name, "center": t.tolist(), "rotation": rot.tolist()}
+        if hasattr(v, "dz"):
+            region.update({"shape": "tubs", "rmax": v.rmax, "dz": v.dz})
+        else:
+            region.update({"shape": "sphere", "rmax": v.rmax})
+        regions.append(region)
+    regions.sort(key=lambda r: r["name"])
+    with open(filename, "w") as f:
+        json.dump(regions, f, indent=2)
+    return regions
+
+
+def set_line_library_spectrum(source, lines):
+    """
+    Emit the given gamma lines (energies) with the same probability: one
+    simulation gives the response of each line, to be weighted offline for
+    any radionuclide (see spectral_helpers)
+    """
+    source.energy.type = "spectrum_discrete"
+    source.energy.spectrum_energies = list(lines)
+    source.energy.spectrum_weights = [1.0] * len(lines)
+
+
+def add_source_spatial_resolution(
+    sim,
+    name,
+    container,
+    rad="Lu177",
+    aa_volumes=None,
+    skip_policy="SkipEvents",
+    lines=None,
+):
     spectrum = get_spectrum(rad, "gamma")
     source = sim.add_source("GenericSource", name)
     source.attached_to = container.name
@@ -286,13 +583,23 @@ def add_source_spatial_resolution(sim, name, container, rad="Lu177", aa_volumes=
     source.energy.type = "spectrum_discrete"
     source.energy.spectrum_energies = spectrum.energies
     source.energy.spectrum_weights = spectrum.weights
+    if lines is not None:
+        set_line_library_spectrum(source, lines)
     if aa_volumes is not None:
-        source.direction.acceptance_angle.volumes = aa_volumes
-        source.direction.acceptance_angle.intersection_flag = True
-        source.direction.acceptance_angle.skip_policy = "SkipEvents"
+        set_source_acceptance_angle(source, aa_volumes, skip_policy)
     return source
 
-def add_2sources_spatial_resolution(sim, name, name2, container, container2, rad="Lu177", aa_volumes=None):
+def add_2sources_spatial_resolution(
+    sim,
+    name,
+    name2,
+    container,
+    container2,
+    rad="Lu177",
+    aa_volumes=None,
+    skip_policy="SkipEvents",
+    lines=None,
+):
     spectrum = get_spectrum(rad, "gamma")
     source = sim.add_source("GenericSource", name)
     source.attached_to = container.name
@@ -304,10 +611,10 @@ def add_2sources_spatial_resolution(sim, name, name2, container, container2, rad
     source.energy.type = "spectrum_discrete"
     source.energy.spectrum_energies = spectrum.energies
     source.energy.spectrum_weights = spectrum.weights
+    if lines is not None:
+        set_line_library_spectrum(source, lines)
     if aa_volumes is not None:
-        source.direction.acceptance_angle.volumes = aa_volumes
-        source.direction.acceptance_angle.intersection_flag = True
-        source.direction.acceptance_angle.skip_policy = "SkipEvents"
+        set_source_acceptance_angle(source, aa_volumes, skip_policy)
     
     source2 = sim.add_source("GenericSource", name2)
     source2.attached_to = container2.name
@@ -319,10 +626,10 @@ def add_2sources_spatial_resolution(sim, name, name2, container, container2, rad
     source2.energy.type = "spectrum_discrete"
     source2.energy.spectrum_energies = spectrum.energies
     source2.energy.spectrum_weights = spectrum.weights
+    if lines is not None:
+        set_line_library_spectrum(source2, lines)
     if aa_volumes is not None:
-        source2.direction.acceptance_angle.volumes = aa_volumes
-        source2.direction.acceptance_angle.intersection_flag = True
-        source2.direction.acceptance_angle.skip_policy = "SkipEvents"
+        set_source_acceptance_angle(source2, aa_volumes, skip_policy)
 
     return source, source2
 
@@ -362,7 +669,14 @@ def add_PMMA_plates(sim, name="PMMA_plates"):
 
     return top_plates, bottom_plates
 
-def add_digitizer_tc99m_wip(sim, crystal_name, name, spectrum_channel=True):
+def add_digitizer_tc99m_wip(
+    sim,
+    crystal_name,
+    name,
+    spectrum_channel=True,
+    singles_filename=None,
+    tags=False,
+):
     # create main chain
     mm = gate.g4_units.mm
     digitizer = Digitizer(sim, crystal_name, name)
@@ -371,6 +685,10 @@ def add_digitizer_tc99m_wip(sim, crystal_name, name, spectrum_channel=True):
     sc = digitizer.add_module("DigitizerAdderActor", f"{name}_singles")
     sc.group_volume = None
     sc.policy = "EnergyWinnerPosition"
+    if singles_filename is not None:
+        store_digitizer_singles(
+            digitizer.find_module("hits"), sc, singles_filename, tags
+        )
 
     # detection efficiency
     # ea = digitizer.add_module("DigitizerEfficiencyActor", f"{name}_eff")
@@ -414,7 +732,14 @@ def add_digitizer_tc99m_wip(sim, crystal_name, name, spectrum_channel=True):
     # end
     return digitizer
 
-def add_digitizer_lu177_wip(sim, crystal_name, name, spectrum_channel=True):
+def add_digitizer_lu177_wip(
+    sim,
+    crystal_name,
+    name,
+    spectrum_channel=True,
+    singles_filename=None,
+    tags=False,
+):
     # create main chain
     mm = gate.g4_units.mm
     digitizer = Digitizer(sim, crystal_name, name)
@@ -423,6 +748,10 @@ def add_digitizer_lu177_wip(sim, crystal_name, name, spectrum_channel=True):
     sc = digitizer.add_module("DigitizerAdderActor", f"{name}_singles")
     sc.group_volume = None
     sc.policy = "EnergyWinnerPosition"
+    if singles_filename is not None:
+        store_digitizer_singles(
+            digitizer.find_module("hits"), sc, singles_filename, tags
+        )
 
     # detection efficiency
     # ea = digitizer.add_module("DigitizerEfficiencyActor", f"{name}_eff")
@@ -468,7 +797,14 @@ def add_digitizer_lu177_wip(sim, crystal_name, name, spectrum_channel=True):
     return digitizer
 
 
-def add_digitizer_iodine_wip(sim, crystal_name, name, spectrum_channel=True):
+def add_digitizer_iodine_wip(
+    sim,
+    crystal_name,
+    name,
+    spectrum_channel=True,
+    singles_filename=None,
+    tags=False,
+):
     # create main chain
     mm = gate.g4_units.mm
     digitizer = Digitizer(sim, crystal_name, name)
@@ -477,6 +813,10 @@ def add_digitizer_iodine_wip(sim, crystal_name, name, spectrum_channel=True):
     sc = digitizer.add_module("DigitizerAdderActor", f"{name}_singles")
     sc.group_volume = None
     sc.policy = "EnergyWinnerPosition"
+    if singles_filename is not None:
+        store_digitizer_singles(
+            digitizer.find_module("hits"), sc, singles_filename, tags
+        )
 
     # detection efficiency
     # ea = digitizer.add_module("DigitizerEfficiencyActor", f"{name}_eff")
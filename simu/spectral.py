@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import click
+import numpy as np
+from redigitizer_helpers import (
+    read_singles,
+    get_digitizer_preset,
+    write_projections,
+    keV,
+)
+from stats_helpers import read_stats_file
+from spectral_helpers import *
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def go():
+    """
+    Spectral superposition: a line library simulation (e.g.
+    nema001_spatial_resolution --line_library Lu177,I131) emits all the lines
+    with the same probability. The response of each line is computed once
+    from the singles, the projections of any radionuclide (or mixture) are
+    then a weighted sum of the responses.
+    """
+    pass
+
+
+@go.command(context_settings=CONTEXT_SETTINGS)
+@click.argument("singles_file")
+@click.option("--lines", "-l", required=True, help="Line library (json)")
+@click.option("--stats", "-s", required=True, help="Stats file of the simulation")
+@click.option("--output", "-o", required=True, help="Output responses (npz)")
+@click.option(
+    "--preset",
+    "-p",
+    default="Lu177",
+    help="Digitizer (blur, energy windows): Tc99m, Lu177, I131 or intevo_Lu177",
+)
+@click.option("--spectrum_channel/--no_spectrum_channel", default=False)
+@click.option("--nb_runs", default=None, type=int, help="Nb of runs (angles)")
+@click.option(
+    "--nb_heads", default=None, type=int, help="Nb of heads (default: from the file)"
+)
+@click.option("--seed", default=None, type=int, help="Random seed")
+def responses(
+    singles_file,
+    lines,
+    stats,
+    output,
+    preset,
+    spectrum_channel,
+    nb_runs,
+    nb_heads,
+    seed,
+):
+    """
+    Projections per emitted photon of each line of the library
+    """
+    t = time.time()
+    library = read_line_library(lines)
+    singles = read_singles(singles_file)
+    if "emission_energy" not in singles:
+        raise click.UsageError(f"{singles_file} has no emission energy")
+    s = read_stats_file(stats)
+    # with acceptance angle, the skipped events are also emitted photons
+    nb_emitted = s["NumberOfEvents"] + s.get("SkippedEvents", 0)
+    p = get_digitizer_preset(preset, spectrum_channel)
+    r = get_line_responses(singles, library, nb_emitted, p, nb_runs, seed, nb_heads)
+    write_line_responses(output, r, library, p["spacing"], preset)
+    print(f"{len(library)} lines, {nb_emitted} emitted photons")
+    print(f"Responses {r.shape} written to {output} in {time.time() - t:.1f} s")
+
+
+@go.command("recombine", context_settings=CONTEXT_SETTINGS)
+@click.argument("responses_file")
+@click.option(
+    "--rad",
+    "-r",
+    multiple=True,
+    help="Radionuclide and activity in Bq (e.g. Lu177:1e6), can be repeated",
+)
+@click.option(
+    "--line",
+    multiple=True,
+    help="Custom line: energy in keV and yield per decay (e.g. 208:0.1), "
+    "can be repeated, with --activity",
+)
+@click.option("--activity", "-a", default=1e6, help="Activity (Bq) of --line")
+@click.option("--time", "-t", "time_sec", default=300.0, help="Acquisition time (s)")
+@click.option("--output", "-o", required=True, help="Output projection (mhd)")
+def recombine_projections(responses_file, rad, line, activity, time_sec, output):
+    """
+    Projections of the radionuclides (or custom lines) from the responses
+    """
+    r = read_line_responses(responses_file)
+    lines = r["lines"]
+    weights = np.zeros(len(lines))
+    for item in rad:
+        name, a = item.split(":")
+        w, missing = get_line_weights(lines, *get_spectrum_lines(name))
+        if missing > 0:
+            print(f"Warning: {name} lines not in the library ({missing:.4f} /decay)")
+        weights += w * float(a)
+    if line:
+        energies = [float(x.split(":")[0]) * keV for x in line]
+        yields = [float(x.split(":")[1]) for x in line]
+        w, missing = get_line_weights(lines, energies, yields)
+        if missing > 0:
+            print(f"Warning: custom lines not in the library ({missing:.4f} /decay)")
+        weights += w * activity
+    for e, w in zip(lines, weights):
+        if w > 0:
+            print(f"Line {e / keV:8.2f} keV: {w:.4g} photons/s")
+    projections = recombine(r["responses"], weights, 1.0, time_sec)
+    for f in write_projections(output, projections, r["spacing"]):
+        print(f"Projection written to {f}")
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
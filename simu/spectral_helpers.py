@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import numpy as np
+from redigitizer_helpers import redigitize, keV
+
+
+def get_library_lines(radionuclides, min_yield=1e-3, tolerance=0.5 * keV):
+    """
+    Union of the gamma lines (energies, MeV) of the radionuclides (ICRP 107,
+    get_spectrum), without the lines below min_yield per decay. Lines closer
+    than the tolerance are merged.
+    """
+    from opengate.sources.utility import get_spectrum
+
+    energies = []
+    for rad in radionuclides:
+        spectrum = get_spectrum(rad, "gamma")
+        for e, w in zip(spectrum.energies, spectrum.weights):
+            if w >= min_yield:
+                energies.append(float(e))
+    lines = []
+    for e in sorted(energies):
+        if not lines or e - lines[-1] > tolerance:
+            lines.append(e)
+    return lines
+
+
+def write_line_library(filename, lines, radionuclides):
+    with open(filename, "w") as f:
+        json.dump({"lines": lines, "radionuclides": list(radionuclides)}, f, indent=2)
+
+
+def read_line_library(filename):
+    with open(filename) as f:
+        return json.load(f)["lines"]
+
+
+def get_line_tags(emission_energy, lines, tolerance=0.5 * keV):
+    """
+    Index of the library line of each single (from its emission energy),
+    -1 when no line is within the tolerance
+    """
+    lines = np.asarray(lines, dtype=np.float64)
+    emission_energy = np.asarray(emission_energy, dtype=np.float64)
+    order = np.argsort(lines)
+    sorted_lines = lines[order]
+    # nearest of the two neighbours in the sorted lines
+    right = np.minimum(np.searchsorted(sorted_lines, emission_energy), len(lines) - 1)
+    left = np.maximum(right - 1, 0)
+    closer = np.abs(emission_energy - sorted_lines[left]) <= np.abs(
+        sorted_lines[right] - emission_energy
+    )
+    i = np.where(closer, left, right)
+    tags = order[i]
+    tags[np.abs(emission_energy - sorted_lines[i]) > tolerance] = -1
+    return tags
+
+
+def get_line_responses(
+    singles, lines, nb_emitted, preset, nb_runs=None, seed=None, nb_heads=None
+):
+    """
+    Projections per emitted photon of each line (nb_lines, nb_heads, slices,
+    y, x), from the singles of a line library simulation where the lines
+    are emitted with the same probability (nb_emitted / nb_lines photons per
+    line on average). The singles are blurred once, the preset gives the
+    energy windows and the blur.
+    """
+    tags = get_line_tags(singles["emission_energy"], lines)
+    projections = redigitize(
+        singles,
+        preset["energy_blur"],
+        preset["spatial_blur_fwhm"],
+        preset["channels"],
+        preset["size"],
+        preset["spacing"],
+        nb_runs=nb_runs,
+        orientation_matrix=preset["orientation_matrix"],
+        limits=preset["limits"],
+        seed=seed,
+        tags=tags,
+        nb_tags=len(lines),
+        nb_heads=nb_heads,
+    )
+    return projections * (len(lines) / nb_emitted)
+
+
+def get_line_weights(lines, energies, weights, tolerance=0.5 * keV):
+    """
+    Weight of each library line for a spectrum (energies, yields per decay).
+    Return the weights and the total yield of the lines that are not in the
+    library (not simulated, so missing in the recombined projections).
+    """
+    lines = np.asarray(lines)
+    w = np.zeros(len(lines))
+    missing = 0.0
+    for e, y in zip(energies, weights):
+        i = int(np.argmin(np.abs(lines - e)))
+        if abs(lines[i] - e) <= tolerance:
+            w[i] += y
+        else:
+            missing += y
+    return w, missing
+
+
+def recombine(responses, line_weights, activity_Bq, time_sec):
+    """
+    Expected projections of a source of the given activity during the given
+    time: sum over the lines of yield * response per emitted photon
+    """
+    p = np.tensordot(line_weights, responses, axes=(0, 0))
+    return (p * activity_Bq * time_sec).astype(np.float32)
+
+
+def write_line_responses(filename, responses, lines, spacing, preset_name):
+    np.savez_compressed(
+        filename,
+        responses=responses.astype(np.float32),
+        lines=np.asarray(lines),
+        spacing=np.asarray(spacing),
+        preset=preset_name,
+    )
+
+
+def read_line_responses(filename):
+    with np.load(filename) as f:
+        return {
+            "responses": f["responses"],
+            "lines": f["lines"],
+            "spacing": f["spacing"],
+            "preset": str(f["preset"]),
+        }
+
+
+def get_spectrum_lines(rad):
+    """
+    Energies (MeV) and yields per decay of the gamma lines of a radionuclide
+    """
+    from opengate.sources.utility import get_spectrum
+
+    spectrum = get_spectrum(rad, "gamma")
+    return np.asarray(spectrum.energies), np.asarray(spectrum.weights)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+def read_stats_file(filename):
+    """
+    Read the text file written by the SimulationStatisticsActor
+    ('# key = value' lines). Keys are shortened to their first word
+    ('PPS (Primary per sec)' -> 'PPS') and values converted to numbers when
+    possible.
+    """
+    stats = {}
+    with open(filename) as f:
+        for line in f:
+            line = line.strip().lstrip("#").strip()
+            if "=" not in line:
+                continue
+            k, v = line.split("=", 1)
+            k = k.strip().split(" (")[0]
+            v = v.strip()
+            try:
+                v = int(v)
+            except ValueError:
+                try:
+                    v = float(v)
+                except ValueError:
+                    pass
+            stats[k] = v
+    return stats
+
+
+def write_stats_file(filename, stats):
+    """
+    Write stats (dict) with the same '# key = value' layout
+    """
+    with open(filename, "w") as f:
+        for k, v in stats.items():
+            f.write(f"# {k} = {v}\n")
+
+
+def merge_stats(all_stats):
+    """
+    Merge the stats of independent sub-simulations run in parallel: counts are
+    summed, the elapsed time is the longest one and the rates are recomputed.
+    """
+    max_keys = ["ElapsedTime", "ElapsedTimeWoInit"]
+    rate_keys = {
+        "PPS": "NumberOfEvents",
+        "TPS": "NumberOfTracks",
+        "SPS": "NumberOfSteps",
+    }
+    merged = {}
+    for k, v in all_stats[0].items():
+        values = [s[k] for s in all_stats if k in s]
+        if k == "StartDate":
+            merged[k] = min(values)
+        elif k == "EndDate":
+            merged[k] = max(values)
+        elif not all(isinstance(x, (int, float)) for x in values):
+            merged[k] = v
+        elif k in max_keys:
+            merged[k] = max(values)
+        else:
+            merged[k] = sum(values)
+    duration = merged.get("ElapsedTime", 0)
+    for k, n in rate_keys.items():
+        if k in merged and n in merged:
+            merged[k] = round(merged[n] / duration) if duration > 0 else 0
+    return merged
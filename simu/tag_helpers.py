@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+from pathlib import Path
+import numpy as np
+
+# interaction history of the detected photon, by priority
+interaction_classes = [
+    "primary",
+    "penetration",
+    "phantom_scatter",
+    "collimator_scatter",
+    "head_scatter",
+    "secondary",
+]
+
+# regions recorded by add_interaction_recording -> interaction class
+region_classes = {
+    "phantom": "phantom_scatter",
+    "collimator": "collimator_scatter",
+    "head": "head_scatter",
+}
+
+# hole diameter / length, maximum tan of the incidence angle without crossing
+# a septum (nominal values, use the option to set the exact collimator)
+collimator_acceptance = {
+    "melp": 2.94 / 40.64,
+    "lehr": 1.11 / 24.05,
+    "megp": 3.0 / 58.0,
+    "hegp": 4.0 / 66.0,
+}
+
+# steps of the gammas that are not interactions
+transportation_processes = ["Transportation", "CoupledTransportation", "OutOfWorld"]
+
+
+def get_event_keys(run, event):
+    # one integer per (run, event)
+    return (np.asarray(run, dtype=np.int64) << 44) | np.asarray(event, dtype=np.int64)
+
+
+def read_interaction_events(root_filenames):
+    """
+    (run, event) keys of the primary gammas (track 1) that interacted in the
+    volumes recorded by add_interaction_recording
+    """
+    import uproot
+
+    keys = []
+    for filename in root_filenames:
+        f = uproot.open(filename)
+        tree = f[f.keys()[0]]
+        data = tree.arrays(
+            ["RunID", "EventID", "TrackID", "ProcessDefinedStep"], library="np"
+        )
+        process = data["ProcessDefinedStep"].astype(str)
+        m = (data["TrackID"] == 1) & ~np.isin(process, transportation_processes)
+        keys.append(get_event_keys(data["RunID"][m], data["EventID"][m]))
+    if not keys:
+        return np.array([], dtype=np.int64)
+    return np.unique(np.concatenate(keys))
+
+
+def find_region_files(prefix):
+    """
+    Root files of each recorded region: {region: [filenames]}
+    """
+    prefix = Path(prefix)
+    files = {}
+    for region in region_classes:
+        f = sorted(prefix.parent.glob(f"{prefix.name}_{region}_*.root"))
+        if f:
+            files[region] = f
+    return files
+
+
+def read_source_regions(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def get_source_tags(positions, regions):
+    """
+    Index of the source region (see write_source_regions) that contains each
+    emission position (n, 3): 0 outside all regions, i + 1 for region i
+    """
+    tags = np.zeros(len(positions), dtype=np.int64)
+    for i, r in enumerate(regions):
+        # position in the frame of the region
+        local = (np.asarray(positions) - r["center"]) @ np.array(r["rotation"])
+        if r["shape"] == "sphere":
+            inside = np.sum(local**2, axis=1) <= r["rmax"] ** 2
+        else:
+            inside = np.sum(local[:, :2] ** 2, axis=1) <= r["rmax"] ** 2
+            inside &= np.abs(local[:, 2]) <= r["dz"]
+        tags[inside & (tags == 0)] = i + 1
+    return tags
+
+
+def get_hole_axis(local, world):
+    """
+    Direction of the collimator holes in the world frame, from the local and
+    world positions of the singles of one head and one run: the local axis
+    along which the crystal is thin, rotated with the rotation that maps the
+    local to the world positions (Kabsch).
+    """
+    lc = local - local.mean(axis=0)
+    wc = world - world.mean(axis=0)
+    u, _, vt = np.linalg.svd(wc.T @ lc)
+    d = np.sign(np.linalg.det(u @ vt))
+    rot = u @ np.diag([1, 1, d]) @ vt
+    axis = np.zeros(3)
+    axis[np.argmin(lc.std(axis=0))] = 1
+    return rot @ axis
+
+
+def get_incidence_tan(singles):
+    """
+    Tangent of the angle between the emission-to-detection direction and the
+    collimator holes, for each single (NaN when it cannot be computed)
+    """
+    local = np.stack([singles["x"], singles["y"], singles["z"]], axis=1)
+    world = np.stack([singles["gx"], singles["gy"], singles["gz"]], axis=1)
+    emission = np.stack(
+        [singles["event_x"], singles["event_y"], singles["event_z"]], axis=1
+    )
+    d = world.astype(np.float64) - emission
+    d /= np.linalg.norm(d, axis=1)[:, None]
+    tan = np.full(len(d), np.nan)
+    group = singles["head"].astype(np.int64) * (1 << 32) + singles["run"]
+    for g in np.unique(group):
+        m = group == g
+        if m.sum() < 3:
+            continue
+        axis = get_hole_axis(local[m].astype(np.float64), world[m].astype(np.float64))
+        c = np.abs(d[m] @ axis)
+        tan[m] = np.sqrt(np.maximum(1 - c**2, 0)) / np.maximum(c, 1e-12)
+    return tan
+
+
+def get_interaction_tags(singles, region_events, acceptance_tan):
+    """
+    Interaction class (index in interaction_classes) of each single:
+    secondary when the detected photon is not the primary gamma, then
+    the first region (phantom, collimator, head) where the primary interacted,
+    then penetration when the primary reached the crystal without
+    interaction but outside the collimator acceptance, primary otherwise.
+    """
+    tags = np.full(len(singles["run"]), interaction_classes.index("primary"))
+    keys = get_event_keys(singles["run"], singles["event"])
+    free = singles["track"] == 1
+    for region, name in region_classes.items():
+        if region not in region_events:
+            continue
+        m = free & np.isin(keys, region_events[region])
+        tags[m] = interaction_classes.index(name)
+        free &= ~m
+    tan = get_incidence_tan(singles)
+    tags[free & (tan > acceptance_tan)] = interaction_classes.index("penetration")
+    tags[singles["track"] != 1] = interaction_classes.index("secondary")
+    return tags
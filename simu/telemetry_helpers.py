@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import socket
+import threading
+import numpy as np
+from mhd_helpers import memmap_mhd
+
+
+def get_rss_mb(pid="self"):
+    """
+    Resident memory (MB) of a process, read from /proc (Linux only, None
+    when not available)
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_children_rss_mb():
+    # total resident memory of the worker processes of this process
+    import multiprocessing
+
+    rss = [get_rss_mb(p.pid) for p in multiprocessing.active_children()]
+    return sum(r for r in rss if r is not None)
+
+
+def get_window_counts(filename, nb_ene_win):
+    """
+    Counts per (angle, energy window) of a projection stack
+    (slice = angle * nb_ene_win + window)
+    """
+    img, _ = memmap_mhd(filename)
+    nb_angles = img.shape[0] // nb_ene_win
+    counts = np.zeros((nb_angles, nb_ene_win))
+    for s in range(nb_angles * nb_ene_win):
+        counts[divmod(s, nb_ene_win)] = np.sum(img[s], dtype=np.float64)
+    return counts
+
+
+def get_peak_window(window_names):
+    """
+    Index of the main photopeak window: the last window named peak*, the
+    last window when none is
+    """
+    peaks = [i for i, n in enumerate(window_names) if n.startswith("peak")]
+    return peaks[-1] if peaks else len(window_names) - 1
+
+
+class TelemetryWriter:
+    """
+    Machine-readable telemetry: each record is a json line appended to a file
+    (flushed at once, can be followed with tail -f) and/or sent as an UDP
+    datagram to a local port (see telemetry_watch.py).
+    """
+
+    def __init__(self, filename=None, port=None, host="127.0.0.1"):
+        self.file = open(filename, "a") if filename is not None else None
+        self.address = (host, port) if port is not None else None
+        self.socket = None
+        if self.address is not None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def emit(self, record_type, **fields):
+        record = {
+            "type": record_type,
+            "time": time.time(),
+            "elapsed": time.time() - self.start,
+            "pid": os.getpid(),
+            **fields,
+        }
+        line = json.dumps(record, default=float)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line + "\n")
+                self.file.flush()
+            if self.socket is not None:
+                try:
+                    self.socket.sendto(line.encode(), self.address)
+                except OSError:
+                    # nobody listening, the telemetry must not stop the run
+                    pass
+        return record
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.socket is not None:
+            self.socket.close()
+
+
+class TelemetrySampler(threading.Thread):
+    """
+    Background thread that emits a 'sample' record every period (sec) with
+    the fields returned by get_state() and the memory of this process and of
+    its workers
+    """
+
+    def __init__(self, writer, period=10.0, get_state=None):
+        super().__init__(daemon=True)
+        self.writer = writer
+        self.period = period
+        self.get_state = get_state
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.period):
+            state = self.get_state() if self.get_state is not None else {}
+            self.writer.emit(
+                "sample",
+                rss_mb=get_rss_mb(),
+                workers_rss_mb=get_children_rss_mb(),
+                **state,
+            )
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def watch_telemetry(port, host="127.0.0.1"):
+    """
+    Listen to the UDP telemetry and yield the records (dict)
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind((host, port))
+    try:
+        while True:
+            data, _ = s.recvfrom(65536)
+            yield json.loads(data.decode())
+    finally:
+        s.close()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import click
+from telemetry_helpers import watch_telemetry, get_peak_window
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+def format_record(r):
+    if r["type"] == "sample":
+        flag = "  <-- STALLED" if r.get("stalled") else ""
+        return (
+            f"[{r['elapsed']:8.0f} s] {r.get('chunks_done')}/{r.get('chunks_total')} "
+            f"chunks, PPS = {r.get('pps', 0):.0f}, "
+            f"RSS = {r['rss_mb']:.0f} + {r['workers_rss_mb']:.0f} MB{flag}"
+        )
+    if r["type"] == "angle":
+        k = get_peak_window(r["window_names"])
+        peak = [c[k] for c in r["window_counts"]]
+        return (
+            f"[{r['elapsed']:8.0f} s] angle {r['angle_index']} "
+            f"({r['gantry_angles_deg'][0]:.0f} deg): {r['events']:.0f} events in "
+            f"{r['run_time']:.1f} s, counts ({r['window_names'][k]}) = {peak}"
+        )
+    return json.dumps(r)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--port", "-p", default=5005, help="Local UDP port")
+@click.option("--raw", is_flag=True, default=False, help="Print the json records")
+def go(port, raw):
+    """
+    Print the live telemetry sent by test003_parallel (--telemetry_port)
+    """
+    for r in watch_telemetry(port):
+        print(json.dumps(r) if raw else format_record(r), flush=True)
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
@@ -7,19 +7,14 @@ from scipy.spatial.transform import Rotation
 from spect_helpers import add_digitizer_intevo_lu177
 from pathlib import Path
 
-if __name__ == "__main__":
-
-    # folders
-    simu_name = "test001"
 
-    # create the simulation
-    sim = gate.Simulation()
+def set_test001_simulation(
+    sim, simu_name="test001", number_of_threads=2, time=None, digitizer="full"
+):
 
     # main options
-    #sim.visu = True # uncomment to enable visualisation
-    #sim.visu_type = "qt"
     sim.random_seed = "auto"
-    sim.number_of_threads = 2
+    sim.number_of_threads = number_of_threads
     sim.progress_bar = True
     sim.output_dir = Path("./output")
 
@@ -78,22 +73,43 @@ if __name__ == "__main__":
     source2.activity = 1e4 * Bq / sim.number_of_threads
 
     # digitizer : probably not correct
-    proj = add_digitizer_intevo_lu177(sim, head.name, crystal.name)
-    proj.output_filename = f"{simu_name}_projection.mhd"
-    print(f'Projection size: {proj.size}')
-    print(f'Projection spacing: {proj.spacing} mm')
-    print(f'Projection output: {proj.get_output_path()}')
+    # (fast: the projection is computed after the run, see project_intevo_singles)
+    singles_filename = f"{simu_name}_singles.root" if digitizer == "fast" else None
+    proj = add_digitizer_intevo_lu177(
+        sim, head.name, crystal.name, singles_filename, mode=digitizer
+    )
+    if digitizer != "fast":
+        proj.output_filename = f"{simu_name}_projection.mhd"
+        print(f'Projection size: {proj.size}')
+        print(f'Projection spacing: {proj.spacing} mm')
+        print(f'Projection output: {proj.get_output_path()}')
 
     # add stat actor
     stats = sim.add_actor("SimulationStatisticsActor", "stats")
     stats.track_types_flag = True
     stats.output_filename = f"{simu_name}_stats.txt"
 
-    # go
-    time = 300 * sec
+    # timing
+    if time is None:
+        time = 300 * sec
     if sim.visu:
         time = 0.01 * sec
     sim.run_timing_intervals = [[0, time]]
+
+    return stats
+
+
+if __name__ == "__main__":
+
+    # create the simulation
+    sim = gate.Simulation()
+
+    # main options
+    #sim.visu = True # uncomment to enable visualisation
+    #sim.visu_type = "qt"
+    stats = set_test001_simulation(sim, "test001")
+
+    # go
     sim.run()
 
     # print
@@ -6,22 +6,26 @@ import opengate.contrib.phantoms.nemaiec as gate_iec
 import opengate.contrib.spect.siemens_intevo as intevo
 from opengate.sources.base import set_source_rad_energy_spectrum
 from scipy.spatial.transform import Rotation
-from spect_helpers import add_digitizer_intevo_lu177
+from spect_helpers import (
+    add_digitizer_intevo_lu177,
+    add_interaction_tagging,
+    write_source_regions,
+)
 from pathlib import Path
 
-if __name__ == "__main__":
-
-    # folders
-    simu_name = "test002"
 
-    # create the simulation
-    sim = gate.Simulation()
+def set_test002_simulation(
+    sim,
+    simu_name="test002",
+    number_of_threads=4,
+    time=None,
+    tags=False,
+    digitizer="full",
+):
 
     # main options
-    # sim.visu = True # uncomment to enable visualisation
-    sim.visu_type = "vrml"
     sim.random_seed = "auto"
-    sim.number_of_threads = 4
+    sim.number_of_threads = number_of_threads
     sim.progress_bar = True
     sim.output_dir = Path("./output")
 
@@ -71,22 +75,53 @@ if __name__ == "__main__":
         source.direction.acceptance_angle.intersection_flag = True
 
     # digitizer : probably not correct
-    proj = add_digitizer_intevo_lu177(sim, head.name, crystal.name)
-    proj.output_filename = f"{simu_name}_projection.mhd"
-    print(f"Projection size: {proj.size}")
-    print(f"Projection spacing: {proj.spacing} mm")
-    print(f"Projection output: {proj.get_output_path()}")
+    # (fast: the projection is computed after the run, see project_intevo_singles)
+    singles_filename = None
+    if tags or digitizer == "fast":
+        singles_filename = f"{simu_name}_singles.root"
+    proj = add_digitizer_intevo_lu177(
+        sim, head.name, crystal.name, singles_filename, tags, digitizer
+    )
+    if digitizer != "fast":
+        proj.output_filename = f"{simu_name}_projection.mhd"
+        print(f"Projection size: {proj.size}")
+        print(f"Projection spacing: {proj.spacing} mm")
+        print(f"Projection output: {proj.get_output_path()}")
+
+    # singles tagged by sphere and interaction history (see redigitize tagged)
+    if tags:
+        add_interaction_tagging(sim, [head], [colli], [crystal], simu_name)
+        sim.output_dir.mkdir(parents=True, exist_ok=True)
+        write_source_regions(
+            sim, sim.output_dir / f"{simu_name}_sources.json", r"sphere_\d+mm$"
+        )
 
     # add stat actor
     stats = sim.add_actor("SimulationStatisticsActor", "stats")
     stats.track_types_flag = True
     stats.output_filename = f"{simu_name}_stats.txt"
 
-    # go
-    time = 300 * sec
+    # timing
+    if time is None:
+        time = 300 * sec
     if sim.visu:
         time = 0.001 * sec
     sim.run_timing_intervals = [[0, time]]
+
+    return stats
+
+
+if __name__ == "__main__":
+
+    # create the simulation
+    sim = gate.Simulation()
+
+    # main options
+    # sim.visu = True # uncomment to enable visualisation
+    sim.visu_type = "vrml"
+    stats = set_test002_simulation(sim, "test002")
+
+    # go
     sim.run()
 
     # print
@@ -8,19 +8,23 @@ from scipy.spatial.transform import Rotation
 from opengate.sources.base import set_source_rad_energy_spectrum
 from pathlib import Path
 
-if __name__ == "__main__":
 
-    # folders
-    simu_name = "test003"
-
-    # create the simulation
-    sim = gate.Simulation()
+def set_test003_simulation(
+    sim,
+    simu_name="test003",
+    number_of_threads=8,
+    total_time=None,
+    nb_angles=60,
+    angle_indices=None,
+    acceptance_angle=False,
+    skip_policy="SkipEvents",
+    tags=False,
+    digitizer="full",
+):
 
     # main options
-    sim.visu = True  # uncomment to enable visualisation
-    sim.visu_type = "qt"
     sim.random_seed = "auto"
-    sim.number_of_threads = 8
+    sim.number_of_threads = number_of_threads
     sim.progress_bar = True
     sim.output_dir = Path("./output")
     if sim.visu:
@@ -43,7 +47,8 @@ if __name__ == "__main__":
     world.material = "G4_AIR"
 
     # spect heads
-    heads, crystals = add_intevo_two_heads(sim, "spect", "melp", 40 * cm)
+    collimators = []
+    heads, crystals = add_intevo_two_heads(sim, "spect", "melp", 40 * cm, collimators)
 
     # phantom
     phantom = gate_iec.add_iec_phantom(sim, name="phantom")
@@ -68,14 +73,34 @@ if __name__ == "__main__":
     for source in sources:
         set_source_rad_energy_spectrum(source, "lu177")
         source.particle = "gamma"
+        # the heads move at each run, the acceptance angle follows them
+        if acceptance_angle:
+            set_source_acceptance_angle(
+                source, [heads[0].name, heads[1].name], skip_policy
+            )
 
     # digitizer : probably not correct (yet)
+    # (fast: the projections are computed after the run, see project_intevo_singles)
     for i in range(2):
-        proj = add_digitizer_intevo_lu177(sim, heads[i].name, crystals[i].name)
-        proj.output_filename = f"{simu_name}_projection_{i}.mhd"
-        print(f"Projection size: {proj.size}")
-        print(f"Projection spacing: {proj.spacing} mm")
-        print(f"Projection output: {proj.get_output_path()}")
+        singles_filename = None
+        if tags or digitizer == "fast":
+            singles_filename = f"{simu_name}_singles_{i}.root"
+        proj = add_digitizer_intevo_lu177(
+            sim, heads[i].name, crystals[i].name, singles_filename, tags, digitizer
+        )
+        if digitizer != "fast":
+            proj.output_filename = f"{simu_name}_projection_{i}.mhd"
+            print(f"Projection size: {proj.size}")
+            print(f"Projection spacing: {proj.spacing} mm")
+            print(f"Projection output: {proj.get_output_path()}")
+
+    # singles tagged by sphere and interaction history (see redigitize tagged)
+    if tags:
+        add_interaction_tagging(sim, heads, collimators, crystals, simu_name)
+        sim.output_dir.mkdir(parents=True, exist_ok=True)
+        write_source_regions(
+            sim, sim.output_dir / f"{simu_name}_sources.json", r"sphere_\d+mm$"
+        )
 
     # add stat actor
     stats = sim.add_actor("SimulationStatisticsActor", "stats")
@@ -83,26 +108,39 @@ if __name__ == "__main__":
     stats.output_filename = f"{simu_name}_stats.txt"
 
     # set the runs
-    n = 60
-    total_time = 300 * sec
+    n = nb_angles
+    if total_time is None:
+        total_time = 300 * sec
     if sim.visu:
         total_time = 0.001 * sec
-    start_time = 0
+    # (a subset of the angles keeps the time intervals of the full acquisition)
+    if angle_indices is None:
+        angle_indices = range(n)
     step_time = total_time / n
-    end_time = step_time
     sim.run_timing_intervals = []
-    for r in range(n):
-        sim.run_timing_intervals.append([start_time, end_time])
-        start_time = end_time
-        end_time += step_time
+    for r in angle_indices:
+        sim.run_timing_intervals.append([r * step_time, (r + 1) * step_time])
 
     # compute the gantry rotations
     step_angle = 180 / n
     initial_rot = Rotation.from_euler("X", 90, degrees=True)
-    rotate_gantry(heads[0], 40 * cm, initial_rot, 0, step_angle, n)
+    rotate_gantry(heads[0], 40 * cm, initial_rot, 0, step_angle, n, angle_indices)
 
     initial_rot = Rotation.from_euler("ZX", (180, 90), degrees=True)
-    rotate_gantry(heads[1], -40 * cm, initial_rot, 0, step_angle, n)
+    rotate_gantry(heads[1], -40 * cm, initial_rot, 0, step_angle, n, angle_indices)
+
+    return stats
+
+
+if __name__ == "__main__":
+
+    # create the simulation
+    sim = gate.Simulation()
+
+    # main options
+    sim.visu = True  # uncomment to enable visualisation
+    sim.visu_type = "qt"
+    stats = set_test003_simulation(sim, "test003")
 
     # go !
     # sim.running_verbose_level = gate.logger.RUN
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import resource
+from pathlib import Path
+import numpy as np
+import click
+from parallel_helpers import run_in_processes, get_seeds, get_available_cores
+from mhd_helpers import memmap_mhd, get_mhd_geometry, write_mhd_header
+from stats_helpers import read_stats_file, write_stats_file, merge_stats
+from telemetry_helpers import TelemetryWriter, TelemetrySampler, get_window_counts
+from recon_helpers import get_gantry_angles
+from checkpoint_helpers import Checkpoint
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+def get_digitizer_windows(sim, digitizer):
+    """
+    Nb of heads and names of the energy windows of the intevo digitizers of
+    the simulation. The fast digitizer has no energy windows actor, its
+    windows are the ones of project_intevo_singles.
+    """
+    from redigitizer_helpers import get_digitizer_preset
+
+    actors = sim.actor_manager.actors.values()
+    if digitizer == "fast":
+        adders = [a for a in actors if type(a).__name__ == "DigitizerAdderActor"]
+        channels = get_digitizer_preset("intevo_Lu177")["channels"]
+        return len(adders), [c["name"] for c in channels]
+    windows = [a for a in actors if type(a).__name__ == "DigitizerEnergyWindowsActor"]
+    # (the channel names end with the head name, e.g. peak208_spect_0)
+    return len(windows), [c["name"].split("_")[0] for c in windows[0].channels]
+
+
+def run_angle_chunk(
+    simu_name,
+    number_of_threads,
+    total_time,
+    nb_angles,
+    angle_indices,
+    seed,
+    output_dir,
+    acceptance_angle=False,
+    digitizer="full",
+):
+    # executed in its own process (Geant4 can only be run once per process)
+    import opengate as gate
+    from test003_iec_phantom_rotation import set_test003_simulation
+    from spect_helpers import add_acceptance_angle_stats, get_singles_transforms
+    from redigitizer_helpers import project_intevo_singles
+
+    sec = gate.g4_units.s
+    sim = gate.Simulation()
+    set_test003_simulation(
+        sim,
+        simu_name,
+        number_of_threads,
+        total_time * sec,
+        nb_angles,
+        angle_indices,
+        acceptance_angle,
+        digitizer=digitizer,
+    )
+    nb_heads, window_names = get_digitizer_windows(sim, digitizer)
+    sim.random_seed = seed
+    sim.output_dir = Path(output_dir)
+    sim.progress_bar = False
+    sim.run()
+    if digitizer == "fast":
+        project_intevo_singles(
+            [
+                Path(output_dir) / f"{simu_name}_singles_{h}.root"
+                for h in range(nb_heads)
+            ],
+            Path(output_dir) / f"{simu_name}_projection.mhd",
+            len(angle_indices),
+            get_singles_transforms(sim),
+            seed,
+        )
+    stats_filename = Path(output_dir) / f"{simu_name}_stats.txt"
+    if acceptance_angle:
+        add_acceptance_angle_stats(sim, stats_filename)
+
+    # for the telemetry: events, rate and counts per (angle, window) per head
+    stats = read_stats_file(stats_filename)
+    counts = [
+        get_window_counts(
+            Path(output_dir) / f"{simu_name}_projection_{h}.mhd", len(window_names)
+        ).tolist()
+        for h in range(nb_heads)
+    ]
+    return {
+        "angle_indices": list(angle_indices),
+        "output_dir": str(output_dir),
+        "events": stats.get("NumberOfEvents"),
+        "pps": stats.get("PPS"),
+        "nb_heads": nb_heads,
+        "window_names": window_names,
+        "window_counts": counts,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def emit_chunk_telemetry(writer, outcome, nb_angles):
+    """
+    One 'angle' record per angle of a finished chunk: gantry angle of each
+    head, events (of the chunk, shared between its angles), counts per
+    energy window of each head
+    """
+    r = outcome["result"]
+    angles = get_gantry_angles(nb_angles, r["nb_heads"])
+    n = len(r["angle_indices"])
+    for j, a in enumerate(r["angle_indices"]):
+        writer.emit(
+            "angle",
+            angle_index=a,
+            gantry_angles_deg=[angles[a + h * nb_angles] for h in range(r["nb_heads"])],
+            events=r["events"] / n if r["events"] is not None else None,
+            pps=r["pps"],
+            run_time=outcome["elapsed"] / n,
+            window_names=r["window_names"],
+            window_counts=[c[j] for c in r["window_counts"]],
+            worker_peak_rss_mb=r["peak_rss_mb"],
+        )
+
+
+class ChunkProgress:
+    """
+    Progress of the chunks for the periodic telemetry samples. A stall is
+    flagged when no chunk has finished for stall_factor times the median
+    duration of the finished chunks.
+    """
+
+    def __init__(self, nb_chunks, nb_processes, stall_factor=3.0):
+        self.nb_chunks = nb_chunks
+        self.nb_processes = nb_processes
+        self.stall_factor = stall_factor
+        self.durations = []
+        self.events = 0
+        self.start = time.time()
+        self.last = self.start
+
+    def done(self, outcome):
+        self.durations.append(outcome["elapsed"])
+        self.events += outcome["result"].get("events") or 0
+        self.last = time.time()
+
+    def get_state(self):
+        now = time.time()
+        nb_done = len(self.durations)
+        running = min(self.nb_processes, self.nb_chunks - nb_done)
+        stalled = False
+        if self.durations and running > 0:
+            median = float(np.median(self.durations))
+            stalled = now - self.last > self.stall_factor * median
+        return {
+            "chunks_done": nb_done,
+            "chunks_total": self.nb_chunks,
+            "chunks_running": running,
+            "events_done": self.events,
+            "pps": self.events / (now - self.start),
+            "since_last_chunk": now - self.last,
+            "stalled": stalled,
+        }
+
+
+def get_angle_costs(filenames, nb_angles):
+    """
+    Estimate the relative cost of each angle from a previous acquisition with
+    the same nb of angles: the total counts in all windows and heads
+    """
+    costs = np.zeros(nb_angles)
+    for f in filenames:
+        img, _ = memmap_mhd(f)
+        costs += img.reshape((nb_angles, -1)).sum(axis=1)
+    return costs
+
+
+def get_angle_chunks(nb_angles, chunk_size, costs=None):
+    """
+    Split the angles into small chunks of consecutive angles. The chunks are
+    consumed by the workers as soon as they are free (work stealing), the most
+    expensive chunks are scheduled first when the costs are known.
+    """
+    chunks = [
+        list(range(i, min(i + chunk_size, nb_angles)))
+        for i in range(0, nb_angles, chunk_size)
+    ]
+    if costs is not None:
+        chunks.sort(key=lambda c: -costs[c].sum())
+    return chunks
+
+
+def assemble_angle_chunks(chunk_filenames, chunks, nb_angles, nb_ene_win, output):
+    """
+    Write the projections of all chunks in angle order, with the same layout as
+    a single simulation (slice = angle * nb_ene_win + window)
+    """
+    img, header = memmap_mhd(chunk_filenames[0])
+    spacing, origin, direction = get_mhd_geometry(header)
+    shape = (nb_angles * nb_ene_win,) + img.shape[1:]
+    output = Path(output)
+    raw_filename = output.with_suffix(".raw")
+    write_mhd_header(output, shape, img.dtype, spacing, origin, direction)
+    out = np.memmap(raw_filename, dtype=img.dtype, mode="w+", shape=shape)
+    for f, chunk in zip(chunk_filenames, chunks):
+        img, _ = memmap_mhd(f)
+        for j, a in enumerate(chunk):
+            out[a * nb_ene_win : (a + 1) * nb_ene_win] = img[
+                j * nb_ene_win : (j + 1) * nb_ene_win
+            ]
+    out.flush()
+    return output
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--output_folder", "-o", default="output", help="Output folder")
+@click.option("--simu_name", "-n", default="test003", help="Simulation name")
+@click.option("--nb_angles", default=60, help="Number of angles")
+@click.option("--total_time", default=300.0, help="Acquisition time in sec")
+@click.option("--chunk_size", default=1, help="Nb of consecutive angles per task")
+@click.option("--cores", default=None, type=int, help="Nb of cores (default: all)")
+@click.option("--threads", "-t", default=1, help="Nb of threads per worker")
+@click.option("--seed", default=None, type=int, help="Base seed (default: random)")
+@click.option(
+    "--previous",
+    default=None,
+    help="Simulation name of a previous acquisition in the output folder, "
+    "used to schedule the most active angles first",
+)
+@click.option(
+    "--acceptance_angle",
+    "-aa",
+    is_flag=True,
+    default=False,
+    help="Only track the gammas emitted towards the heads",
+)
+@click.option(
+    "--digitizer",
+    type=click.Choice(["full", "lean", "fast"]),
+    default="full",
+    help="Digitizer mode (see add_digitizer_intevo_lu177)",
+)
+@click.option(
+    "--telemetry",
+    default=None,
+    help="Append the telemetry records (json lines) to this file",
+)
+@click.option(
+    "--telemetry_port",
+    default=None,
+    type=int,
+    help="Also send the telemetry records to this local UDP port",
+)
+@click.option("--telemetry_period", default=10.0, help="Telemetry sample period (s)")
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Only run the angles not done by a previous (interrupted) job",
+)
+def go(
+    output_folder,
+    simu_name,
+    nb_angles,
+    total_time,
+    chunk_size,
+    cores,
+    threads,
+    seed,
+    previous,
+    acceptance_angle,
+    digitizer,
+    telemetry,
+    telemetry_port,
+    telemetry_period,
+    resume,
+):
+    output_folder = Path(output_folder)
+    work_dir = output_folder / f"{simu_name}_chunks"
+
+    # schedule
+    costs = None
+    if previous is not None:
+        costs = get_angle_costs(
+            sorted(output_folder.glob(f"{previous}_projection_[0-9]*.mhd")), nb_angles
+        )
+    chunks = get_angle_chunks(nb_angles, chunk_size, costs)
+    if cores is None:
+        cores = get_available_cores()
+    nb_processes = max(1, cores // threads)
+    print(f"{len(chunks)} chunks, {nb_processes} workers x {threads} threads")
+
+    # finished chunks are recorded, a restarted job reuses the same seeds
+    checkpoint = Checkpoint(
+        work_dir / "checkpoint.json",
+        {
+            "simu_name": simu_name,
+            "nb_angles": nb_angles,
+            "total_time": total_time,
+            "chunk_size": chunk_size,
+            "acceptance_angle": acceptance_angle,
+            "digitizer": digitizer,
+            # (the nb of threads changes the seeds of the threads, the nb of
+            # processes does not change the results)
+            "threads": threads,
+        },
+        seed,
+        resume,
+    )
+
+    # go
+    seeds = get_seeds(checkpoint.seed, len(chunks))
+    tasks = []
+    for chunk in chunks:
+        tasks.append(
+            {
+                "simu_name": simu_name,
+                "number_of_threads": threads,
+                "total_time": total_time,
+                "nb_angles": nb_angles,
+                "angle_indices": chunk,
+                # the seed depends on the angles, not on the scheduling
+                "seed": seeds[chunk[0] // chunk_size],
+                "output_dir": str(work_dir / f"angles_{chunk[0]:03d}"),
+                "acceptance_angle": acceptance_angle,
+                "digitizer": digitizer,
+            }
+        )
+    pending = [
+        i
+        for i, t in enumerate(tasks)
+        if not checkpoint.is_done(chunks[i][0])
+        or not (Path(t["output_dir"]) / f"{simu_name}_stats.txt").exists()
+    ]
+    if len(pending) < len(tasks):
+        print(f"{len(tasks) - len(pending)} chunks already done")
+    writer = None
+    if telemetry is not None or telemetry_port is not None:
+        writer = TelemetryWriter(telemetry, telemetry_port)
+        progress = ChunkProgress(len(pending), nb_processes)
+        sampler = TelemetrySampler(writer, telemetry_period, progress.get_state)
+        sampler.start()
+    pending_tasks = [tasks[i] for i in pending]
+    try:
+        for j, outcome in run_in_processes(
+            run_angle_chunk, pending_tasks, nb_processes
+        ):
+            i = pending[j]
+            if outcome["status"] != "done":
+                if writer is not None:
+                    writer.emit(
+                        "failed", angle_indices=chunks[i], error=outcome["error"]
+                    )
+                raise RuntimeError(f"Angles {chunks[i]} failed: {outcome['error']}")
+            checkpoint.add(chunks[i][0], outcome["result"])
+            print(f"Angles {chunks[i]} done in {outcome['elapsed']:.1f} s")
+            if writer is not None:
+                progress.done(outcome)
+                emit_chunk_telemetry(writer, outcome, nb_angles)
+    finally:
+        if writer is not None:
+            sampler.stop()
+            writer.emit("end", **progress.get_state())
+            writer.close()
+
+    # reassemble (heads and windows of the digitizer, same for all the chunks)
+    r = checkpoint.get(chunks[0][0])
+    nb_heads, nb_ene_win = r["nb_heads"], len(r["window_names"])
+    for h in range(nb_heads):
+        files = [
+            Path(t["output_dir"]) / f"{simu_name}_projection_{h}.mhd" for t in tasks
+        ]
+        f = assemble_angle_chunks(
+            files,
+            chunks,
+            nb_angles,
+            nb_ene_win,
+            output_folder / f"{simu_name}_projection_{h}.mhd",
+        )
+        print(f"Projection written to {f}")
+    stats = merge_stats(
+        [
+            read_stats_file(Path(t["output_dir"]) / f"{simu_name}_stats.txt")
+            for t in tasks
+        ]
+    )
+    write_stats_file(output_folder / f"{simu_name}_stats.txt", stats)
+    print(f"PPS = {stats.get('PPS')}")
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
@@ -2,49 +2,114 @@
 # -*- coding: utf-8 -*-
 
 from pathlib import Path
-import itk
 import numpy as np
+import click
+from mhd_helpers import memmap_mhd, get_mhd_geometry, write_mhd, write_mhd_header
+from projection_helpers import ChunkedProjections
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
-if __name__ == "__main__":
-    # folders
-    output_folder = Path("output")
-    simu_name = "test003"
 
-    # image
-    nb_heads = 2
+def extract_projections(input_filenames, windows, nb_ene_win, output_filenames):
+    """
+    Extract the projections of the given energy windows from the multi-window
+    stacks (one per head). The input stacks are memory-mapped and the output
+    written through a memory-mapped file in the native dtype: the images are
+    never fully loaded in memory.
+    For each window, the output contains all projections of the first head,
+    then all projections of the second head, etc.
+    """
+    # map all heads
     images = []
-    for i in range(nb_heads):
-        img_filename = output_folder / f"{simu_name}_projection_{i}.mhd"
-        # read itk image
-        img = itk.imread(img_filename)
-        img_array = itk.GetArrayFromImage(img)
-        images.append(img_array)
-
-    # get number of energy windows and nb of projections
+    headers = []
+    for f in input_filenames:
+        img, header = memmap_mhd(f)
+        images.append(img)
+        headers.append(header)
     im = images[0]
-    print(f'Images shape: {im.shape}')
-    nb_ene_win = 7
-    nb_projections = int(im.shape[0] / nb_ene_win)
-    print(f'{nb_ene_win=}')
-    print(f'{nb_projections=}')
-
-    # build a 3D images with all angles and only one energy window
-    w = 2  # 2 is peak 113
-
-    # create an empty 3D image
-    img_3d = np.zeros((nb_projections * nb_heads, im.shape[1], im.shape[2]))
-    print(f'Images shape: {img_3d.shape}')
-
-    # fill the 3D image with the projections
-    p = 0
-    for i in range(nb_heads):
-        im = images[i]
-        for j in range(nb_projections):
-            img_3d[p] = im[j * nb_ene_win]
-            p += 1
-
-    # write final image
-    output_filename = output_folder / f"{simu_name}_3d_image.mhd"
-    img_3d_itk = itk.GetImageFromArray(img_3d)
-    itk.imwrite(img_3d_itk, output_filename)
-    print(f'Output image written to {output_filename}')
\ No newline at end of file
+    nb_projections = im.shape[0] // nb_ene_win
+    print(f"Images shape: {im.shape}")
+    print(f"{nb_ene_win=}")
+    print(f"{nb_projections=}")
+
+    # slices are ordered by projection then energy window
+    spacing, origin, direction = get_mhd_geometry(headers[0])
+    shape = (nb_projections * len(images), im.shape[1], im.shape[2])
+    for w, output_filename in zip(windows, output_filenames):
+        output_filename = Path(output_filename)
+        raw_filename = output_filename.with_suffix(".raw")
+        write_mhd_header(
+            output_filename, shape, im.dtype, spacing, origin, direction, raw_filename
+        )
+        out = np.memmap(raw_filename, dtype=im.dtype, mode="w+", shape=shape)
+        for i, img in enumerate(images):
+            view = img[: nb_projections * nb_ene_win].reshape(
+                (nb_projections, nb_ene_win) + img.shape[1:]
+            )
+            out[i * nb_projections : (i + 1) * nb_projections] = view[:, w]
+        out.flush()
+        del out
+        print(f"Output image (window {w}) written to {output_filename}")
+
+
+def extract_chunked_projections(filename, windows, heads, output_filenames):
+    """
+    Same as extract_projections from a chunked projection file: only the
+    projections of the requested heads and windows are read.
+    """
+    with ChunkedProjections(filename) as proj:
+        spacing = proj.spacing
+        origin = proj.meta["origin"]
+        direction = proj.meta["direction"]
+        for w, output_filename in zip(windows, output_filenames):
+            img = np.concatenate([proj.get_window(h, w) for h in heads])
+            write_mhd(output_filename, img, spacing, origin, direction)
+            print(f"Output image (window {w}) written to {output_filename}")
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--output_folder", "-o", default="output", help="Simulation folder")
+@click.option("--simu_name", "-n", default="test003", help="Simulation name")
+@click.option("--nb_heads", default=2, help="Number of heads")
+@click.option(
+    "--head", "heads", multiple=True, type=int, help="Head(s) to extract (default all)"
+)
+@click.option("--nb_ene_win", default=7, help="Number of energy windows")
+@click.option(
+    "--window",
+    "-w",
+    "windows",
+    multiple=True,
+    type=int,
+    default=[2],
+    help="Energy window(s) to extract (2 is peak 113)",
+)
+@click.option(
+    "--chunked",
+    is_flag=True,
+    default=False,
+    help="Read {simu_name}_projection.zip (see projection_convert)",
+)
+def go(output_folder, simu_name, nb_heads, heads, nb_ene_win, windows, chunked):
+    output_folder = Path(output_folder)
+    if not heads:
+        heads = range(nb_heads)
+    if len(windows) == 1:
+        output_filenames = [output_folder / f"{simu_name}_3d_image.mhd"]
+    else:
+        output_filenames = [
+            output_folder / f"{simu_name}_3d_image_w{w}.mhd" for w in windows
+        ]
+    if chunked:
+        filename = output_folder / f"{simu_name}_projection.zip"
+        extract_chunked_projections(filename, windows, heads, output_filenames)
+        return
+    input_filenames = [
+        output_folder / f"{simu_name}_projection_{i}.mhd" for i in heads
+    ]
+    extract_projections(input_filenames, windows, nb_ene_win, output_filenames)
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
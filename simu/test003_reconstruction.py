@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+from pathlib import Path
+import numpy as np
+import click
+from mhd_helpers import write_mhd
+from recon_helpers import get_gantry_angles, read_projections, RotationProjector, osem
+
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--output_folder", "-o", default="output", help="Simulation folder")
+@click.option("--simu_name", "-n", default="test003", help="Simulation name")
+@click.option("--window", "-w", default=2, help="Energy window (2 is peak 113)")
+@click.option("--nb_ene_win", default=7, help="Number of energy windows")
+@click.option("--nb_heads", default=2, help="Number of heads")
+@click.option(
+    "--chunked",
+    is_flag=True,
+    default=False,
+    help="Read {simu_name}_projection.zip (see projection_convert)",
+)
+@click.option("--radius", default=400.0, help="Radius of the orbit (mm)")
+@click.option("--start_angle", default=0.0, help="Start angle of the gantry (deg)")
+@click.option(
+    "--axial_axis",
+    default=0,
+    help="Axis of the projection images along the rotation axis (0 = rows)",
+)
+@click.option("--flip", is_flag=True, default=False, help="Flip the transaxial axis")
+@click.option("--iterations", "-i", default=3, help="Nb of OSEM iterations")
+@click.option("--subsets", "-s", default=10, help="Nb of subsets")
+@click.option(
+    "--psf", is_flag=True, default=False, help="Depth-dependent collimator response"
+)
+@click.option("--sigma0", default=0.9, help="PSF sigma at the detector (mm)")
+@click.option("--alpha", default=0.025, help="PSF sigma slope with the distance")
+@click.option("--threads", "-t", default=None, type=int, help="Nb of threads")
+@click.option("--output", default=None, help="Output image (mhd)")
+def go(
+    output_folder,
+    simu_name,
+    window,
+    nb_ene_win,
+    nb_heads,
+    chunked,
+    radius,
+    start_angle,
+    axial_axis,
+    flip,
+    iterations,
+    subsets,
+    psf,
+    sigma0,
+    alpha,
+    threads,
+    output,
+):
+    """
+    OSEM reconstruction of the test003 projections, the geometry is the one
+    of rotate_gantry in set_test003_simulation
+    """
+    t = time.time()
+    output_folder = Path(output_folder)
+    if chunked:
+        filenames = [output_folder / f"{simu_name}_projection.zip"]
+    else:
+        filenames = [
+            output_folder / f"{simu_name}_projection_{i}.mhd" for i in range(nb_heads)
+        ]
+    projections, spacing = read_projections(filenames, window, nb_ene_win)
+    if axial_axis == 1:
+        projections = projections.transpose(0, 2, 1)
+    if flip:
+        projections = projections[:, :, ::-1]
+    nb_proj, nz, n = projections.shape
+    angles = get_gantry_angles(nb_proj // nb_heads, nb_heads, start_angle)
+    print(f"{nb_proj} projections {nz}x{n}, spacing {spacing[0]} mm")
+
+    # projector
+    if psf:
+        projector = RotationProjector(
+            angles, n, nz, spacing[0], radius, sigma0, alpha, nb_threads=threads
+        )
+    else:
+        projector = RotationProjector(angles, n, nz, spacing[0], nb_threads=threads)
+    print(f"Projector ready in {time.time() - t:.1f} s")
+
+    # go
+    img = osem(projector, projections, iterations, subsets)
+    if output is None:
+        name = f"{simu_name}_recon_w{window}_i{iterations}s{subsets}.mhd"
+        output = output_folder / name
+    s = spacing[0]
+    origin = [-(n - 1) / 2 * s, -(n - 1) / 2 * s, -(nz - 1) / 2 * s]
+    write_mhd(output, img, [s, s, s], origin)
+    print(f"Reconstruction written to {output} in {time.time() - t:.1f} s")
+
+
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    go()
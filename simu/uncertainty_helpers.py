@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+import numpy as np
+from mhd_helpers import memmap_mhd, get_mhd_geometry, write_mhd_header, check_same_geometry
+
+
+class BatchAccumulator:
+    """
+    Running sum and sum of squares of independent batches (sub-simulations
+    of the same acquisition), the memory does not depend on the number of
+    batches. The variance of the total is estimated by the batch method:
+    var(total) = n / (n - 1) * sum_b (x_b - mean) ** 2
+    """
+
+    def __init__(self, shape):
+        self.nb_batches = 0
+        self.sum = np.zeros(shape, dtype=np.float64)
+        self.sum2 = np.zeros(shape, dtype=np.float64)
+
+    def add(self, batch):
+        batch = np.asarray(batch, dtype=np.float64)
+        self.sum += batch
+        self.sum2 += batch**2
+        self.nb_batches += 1
+
+    @property
+    def variance(self):
+        # variance of the total (sum of the batches), per pixel
+        n = self.nb_batches
+        if n < 2:
+            raise ValueError(f"At least 2 batches are needed, got {n}")
+        return np.maximum(self.sum2 - self.sum**2 / n, 0) * n / (n - 1)
+
+    @property
+    def relative_uncertainty(self):
+        # sqrt(variance) / total, 0 where there is no count
+        return np.divide(
+            np.sqrt(self.variance),
+            self.sum,
+            out=np.zeros_like(self.sum),
+            where=self.sum > 0,
+        )
+
+
+def get_uncertainty_filenames(projection):
+    # variance and relative uncertainty maps, next to the (merged) projection
+    projection = Path(projection)
+    return (
+        projection.with_name(f"{projection.stem}_variance.mhd"),
+        projection.with_name(f"{projection.stem}_uncertainty.mhd"),
+    )
+
+
+def write_uncertainty_maps(batch_filenames, projection):
+    """
+    Per-pixel variance and relative uncertainty of the sum of the batch
+    projections (same geometry), computed slice by slice. The maps are
+    written (float32) next to the projection, see get_uncertainty_filenames.
+    """
+    images = []
+    headers = []
+    for f in batch_filenames:
+        img, header = memmap_mhd(f)
+        images.append(img)
+        headers.append(header)
+    check_same_geometry(headers)
+    spacing, origin, direction = get_mhd_geometry(headers[0])
+    shape = images[0].shape
+    outputs = []
+    for f in get_uncertainty_filenames(projection):
+        write_mhd_header(f, shape, np.float32, spacing, origin, direction)
+        outputs.append(
+            np.memmap(f.with_suffix(".raw"), dtype=np.float32, mode="w+", shape=shape)
+        )
+    for z in range(shape[0]):
+        acc = BatchAccumulator(shape[1:])
+        for img in images:
+            acc.add(img[z])
+        outputs[0][z] = acc.variance
+        outputs[1][z] = acc.relative_uncertainty
+    for o in outputs:
+        o.flush()
+    return get_uncertainty_filenames(projection)